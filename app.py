@@ -4,7 +4,10 @@
 # Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
 
 from server import *
+from store import open_store
+from metrics import metrics
 from typing import List
+import argparse
 
 p1 = """
 #include<iostream>
@@ -199,6 +202,24 @@ def complete_unit() -> List[Part]:
 	return [intro]+bugs
 
 if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='interactive C++ debugging unit')
+	parser.add_argument('--prewarm', action='store_true', help='compile and run all RunStep programs with common flags at startup')
+	parser.add_argument('--store', choices=['json', 'log', 'sqlite'], default='json', help='how student data is stored')
+	parser.add_argument('--store-path', help='student log directory or sqlite file (defaults to the student directory for json)')
+	parser.add_argument('--write-behind', action='store_true', help='write student data from a background thread')
+	parser.add_argument('--watch-static', action='store_true', help='reload changed css/js files (for development)')
+	parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+						help='a thread per request or a single asyncio event loop with asynchronous subprocesses')
+	parser.add_argument('--max-procs', type=int, help='concurrent compiles/runs per process with the asyncio engine (default: number of cpus / --workers)')
+	parser.add_argument('--workers', type=int, default=1, help='number of server processes sharing the port (needs --store sqlite)')
+	parser.add_argument('--executors', type=int, default=0,
+						help='start compilers and programs from this many small helper processes instead of the server')
+	parser.add_argument('--compile-workers', nargs='+', metavar='HOST:PORT',
+						help='compile and run on these worker.py daemons (needs CPPUNIT_WORKER_KEY)')
+	parser.add_argument('--request-log', help='append one JSON line with timings per request to this file')
+	args = parser.parse_args()
+	if args.workers > 1 and args.store != 'sqlite':
+		parser.error('--workers needs a store that can be shared between processes (--store sqlite)')
 	address = ("localhost", 12345)
 	#student_dir = 'students_demo'
 	student_dir = 'students'
@@ -206,6 +227,27 @@ if __name__ == '__main__':
 	compiler_dir = 'compiler'
 	code_mirror = 'codemirror-5.45.0'
 	lib_dirs = [os.path.join('ext', code_mirror, dd) for dd in ['lib', 'mode/clike']] + ['style']
-	app = App(unit,	student_dir=student_dir, compiler_dir=compiler_dir)
-	serv = Server(address=address, app=app, student_dir=student_dir, lib_dirs=lib_dirs, app_dir=app_dir)
-	serv.serve_forever()
+	shared = args.workers > 1
+	def serve(worker=0):
+		# everything with threads, subprocesses or database connections is created after forking
+		if args.request_log is not None: metrics.open_log(args.request_log)
+		store = open_store(args.store, args.store_path or os.path.join(app_dir, student_dir), write_behind=args.write_behind,
+						   shared=shared)
+		app = App(unit,	student_dir=student_dir, compiler_dir=compiler_dir, store=store, executors=args.executors,
+				  compile_workers=args.compile_workers, processes=args.workers)
+		# every process would repeat the same builds, only the first one prewarms
+		prewarm = args.prewarm and worker == 0
+		if args.engine == 'asyncio':
+			from aserver import AsyncServer
+			serv = AsyncServer(address=address, app=app, student_dir=student_dir, lib_dirs=lib_dirs, app_dir=app_dir,
+							   prewarm=prewarm, watch_static=args.watch_static, max_procs=args.max_procs or app.scheduler.workers,
+							   reuse_port=shared)
+		else:
+			serv = Server(address=address, app=app, student_dir=student_dir, lib_dirs=lib_dirs, app_dir=app_dir, prewarm=prewarm,
+						  watch_static=args.watch_static, reuse_port=shared)
+		try:
+			serv.serve_forever()
+		finally:
+			store.close()
+	if shared: serve_workers(args.workers, serve)
+	else:      serve()
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import asyncio, copy, gzip, json, os, time
+from contextlib import asynccontextmanager
+from email.utils import formatdate
+from http import HTTPStatus
+from compiler import Compiler, WorkersUnavailable, unavailable
+from metrics import metrics, current_request
+from jobs import RunJob
+from scheduler import QueueFull
+from workspace import QuotaExceeded
+from server import (Error, Success, Redirect, Stream, Static, Busy, is_error,
+					route_GET, parse_content, accepts_gzip, setup_server, endpoint, check_response, is_admin, http_chunk)
+
+class AsyncCompiler:
+	""" `Compiler.compile_and_run` on asyncio subprocesses, sharing the compiler's cache,
+	    workspaces and precompiled headers. At most `max_procs` builds run at once and
+	    a build is cancelled (its processes killed) once nobody waits for it anymore. """
+	def __init__(self, comp: Compiler, max_procs: int = None, max_queue: int = 256):
+		self.comp = comp
+		self.max_procs = max_procs or (comp.workers.capacity() if comp.workers is not None else os.cpu_count()) or 1
+		self.max_queue = max_queue
+		self.procs = asyncio.Semaphore(self.max_procs)
+		self.pending = {}  # cache key -> [task, number of waiters]
+		self.cancelled = 0
+
+	async def _build(self, key, compiler, flags, source, on_line):
+		comp = self.comp
+		async with self.procs:
+			if comp.workers is not None:
+				cwd, result = None, await comp.workers.call_async(comp.workers.compile_and_run, key, compiler, flags, source,
+																  on_line=on_line)
+			else:
+				cwd, result = await comp._drive_async(comp._compile_and_run_steps(compiler, flags, source, on_line))
+		comp.cache.put(key, cwd, result)
+		return result
+
+	async def compile_and_run(self, compiler, flags, source, on_line=None):
+		""" raises QueueFull if too many builds are waiting """
+		comp = self.comp
+		if not comp.check_args(compiler, flags): return None
+		key = comp.cache_key(compiler, flags, source)
+		entry = self.pending.get(key)
+		if entry is None:
+			rr = comp.cache.get(key)
+			if rr is not None: return rr
+			if len(self.pending) >= self.max_queue:
+				raise QueueFull(self.retry_after())
+			task = asyncio.ensure_future(self._build(key, compiler, flags, source, on_line))
+			entry = self.pending[key] = [task, 0]
+			task.add_done_callback(lambda _: self.pending.pop(key, None))
+		entry[1] += 1
+		try:
+			result = await asyncio.shield(entry[0])
+		except asyncio.CancelledError:
+			if entry[1] == 1 and not entry[0].done():
+				# the last client waiting for this build went away
+				entry[0].cancel()
+				self.cancelled += 1
+			raise
+		except QuotaExceeded as ee:
+			print(f"ERROR: {ee}")
+			return unavailable("The server is out of space for compiling programs right now, please try again in a minute.")
+		except WorkersUnavailable as ee:
+			print(f"ERROR: {ee}")
+			return unavailable("The compile servers are not reachable right now, please try again in a minute.")
+		finally:
+			entry[1] -= 1
+		return copy.deepcopy(result)
+
+	async def rerun(self, compiler, flags, source, args=None, stdin=None, options=None, on_line=None):
+		""" see `Compiler.rerun` """
+		comp = self.comp
+		if not comp.check_args(compiler, flags): return None
+		if comp.workers is not None:
+			async with self.procs:
+				return await comp.workers.call_async(comp.rerun, compiler, flags, source, args, stdin, options, on_line=on_line)
+		key = comp.cache_key(compiler, flags, source)
+		pinned = comp._pin_rerun(key)
+		if pinned is None:
+			rr = await self.compile_and_run(compiler, flags, source)
+			pinned = comp.cache.pin(key)
+			if pinned is None: return rr
+		cwd, result = pinned
+		if cwd is None: return result
+		try:
+			async with self.procs:
+				return await comp._drive_async(comp._rerun_steps(cwd, result, compiler, flags, args, stdin, options, on_line))
+		finally:
+			comp.cache.unpin(cwd)
+
+	async def check(self, compiler, flags, source):
+		""" see `Compiler.check`, cancelling it kills the compiler """
+		comp = self.comp
+		if comp.workers is not None:
+			return await asyncio.get_running_loop().run_in_executor(comp.workers.threads, comp.check, compiler, flags, source)
+		key = comp.cache_key(compiler, flags, source)
+		rr = comp.checks.get(key)
+		if rr is not None: return rr['check']
+		result = await comp._drive_async(comp._check_steps(compiler, flags, source))
+		comp.checks.put(key, None, {'check': result})
+		return result
+
+	def retry_after(self) -> int:
+		return max(1, len(self.pending) // self.max_procs)
+
+	def stats(self) -> dict:
+		return {'max_procs': self.max_procs, 'pending': len(self.pending), 'cancelled': self.cancelled}
+
+async def until_disconnected(reader, interval: float = 0.2):
+	""" returns once the client has closed its end of the connection """
+	while not reader.at_eof():
+		await asyncio.sleep(interval)
+
+async def chunks_from_thread(chunks):
+	""" a blocking iterator (e.g. reading from the store) consumed on the thread pool """
+	it = iter(chunks)
+	while True:
+		chunk = await asyncio.to_thread(next, it, None)
+		if chunk is None: return
+		yield chunk
+
+class AsyncServer:
+	""" Serves `App` with asyncio instead of a thread per request: compiles and runs are
+	    awaited as subprocesses, everything else runs on the default thread pool.
+	    Same URL scheme and responses as `server.Handler`. """
+	server_version = 'AsyncServer'
+	# idle keep-alive connections are closed after this many seconds
+	timeout = 30
+	# dynamic responses smaller than this are not worth compressing
+	gzip_min_size = 1024
+
+	def __init__(self, address, app, student_dir, lib_dirs, app_dir, prewarm=False, watch_static=False,
+				 max_procs: int = None, max_queue: int = 256, per_student: int = 1, reuse_port: bool = False):
+		setup_server(self, app, student_dir, lib_dirs, app_dir, prewarm=prewarm, watch_static=watch_static)
+		self.address = address
+		self.reuse_port = reuse_port
+		self.max_procs = max_procs
+		self.max_queue = max_queue
+		self.per_student = per_student
+		self.students = {}  # student -> [asyncio.Semaphore, number of users]
+		self.tasks = set()
+		self.checking = {}  # student -> task of its newest check
+		self.check_slots = None
+		self.acomp = None   # created on the event loop
+		self.loop = None
+		self.server = None
+
+	@asynccontextmanager
+	async def student_slot(self, student: str):
+		""" at most `per_student` runs of one student proceed at once """
+		slot = self.students.get(student)
+		if slot is None: slot = self.students[student] = [asyncio.Semaphore(self.per_student), 0]
+		slot[1] += 1
+		try:
+			async with slot[0]:
+				yield
+		finally:
+			slot[1] -= 1
+			if slot[1] == 0: del self.students[student]
+
+	# commands that are awaited instead of being run by App.exec
+
+	async def run(self, student, part, step, content, reader):
+		app = self.app
+		ret = app.run_args(part, step, content)
+		if is_error(ret): return ret
+		compiler, flags, main_src = ret.dat
+		work = asyncio.ensure_future(self.compile_and_run(student, part, step, compiler, flags, main_src))
+		if not await self.unless_disconnected(work, reader): return None
+		try:
+			rr = work.result()
+		except QueueFull as ee:
+			return Busy(ee.retry_after)
+		if rr is None: return Error(f'Invalid compile and run command: {content}')
+		return Redirect('/'.join(['', student.uid, part.uid, step.uid]))
+
+	async def rerun(self, student, part, step, content, reader):
+		app = self.app
+		ret = app.rerun_args(student, part, step, content)
+		if is_error(ret): return ret
+		compiler, flags, main_src, inputs = ret.dat
+		async def work():
+			async with self.student_slot(student.uid):
+				rr = await self.acomp.rerun(compiler, flags, main_src, **inputs)
+			if rr is None: return None
+			return await asyncio.to_thread(app.record_run, student, part, step, compiler, flags, main_src, dict(rr, input=inputs))
+		work = asyncio.ensure_future(work())
+		if not await self.unless_disconnected(work, reader): return None
+		try:
+			rr = work.result()
+		except QueueFull as ee:
+			return Busy(ee.retry_after)
+		if rr is None: return Error(f'Invalid run command: {content}')
+		return Redirect('/'.join(['', student.uid, part.uid, step.uid]))
+
+	async def compare(self, student, part, step, content, reader):
+		ret = self.app.compare_args(part, step, content)
+		if is_error(ret): return ret
+		configs, main_src = ret.dat
+		if len(self.acomp.pending) + len(configs) > self.max_queue:
+			return Busy(self.acomp.retry_after())
+		work = asyncio.ensure_future(self.compare_all(student, part, step, configs, main_src))
+		if not await self.unless_disconnected(work, reader): return None
+		try:
+			work.result()
+		except QueueFull as ee:
+			return Busy(ee.retry_after)
+		return Redirect('/'.join(['', student.uid, part.uid, step.uid]))
+
+	async def compare_all(self, student, part, step, configs, main_src):
+		async def build(compiler, flags):
+			start = time.perf_counter()
+			rr = await self.acomp.compile_and_run(compiler, flags, main_src)
+			return rr, time.perf_counter() - start
+		# the builds share the student's slot and run in parallel up to `max_procs`
+		async with self.student_slot(student.uid):
+			results = await asyncio.gather(*(build(compiler, flags) for compiler, flags in configs))
+		return await asyncio.to_thread(self.app.record_compare, student, part, step, configs, main_src, results)
+
+	async def check(self, student, part, step, content, reader):
+		app = self.app
+		ret = app.check_args(part, step, content)
+		if is_error(ret): return ret
+		compiler, flags, source = ret.dat
+		rr = app.comp.cached_check(compiler, flags, source)
+		if rr is not None: return check_response(rr)
+		# the student's previous check is about code that changed since, it is answered as superseded
+		previous = self.checking.get(student.uid)
+		if previous is not None: previous.cancel()
+		work = self.checking[student.uid] = asyncio.ensure_future(self.check_later(compiler, flags, source))
+		try:
+			if not await self.unless_disconnected(work, reader): return None
+		finally:
+			if self.checking.get(student.uid) is work: del self.checking[student.uid]
+		return check_response(None if work.cancelled() else work.result())
+
+	async def check_later(self, compiler, flags, source):
+		await asyncio.sleep(self.app.check_delay)
+		async with self.check_slots:
+			return await self.acomp.check(compiler, flags, source)
+
+	async def unless_disconnected(self, work, reader) -> bool:
+		""" waits for `work`, which is cancelled if the client goes away first; returns whether it finished """
+		disconnected = asyncio.ensure_future(until_disconnected(reader))
+		try:
+			await asyncio.wait([work, disconnected], return_when=asyncio.FIRST_COMPLETED)
+		finally:
+			disconnected.cancel()
+		if not work.done():
+			work.cancel()
+			return False
+		return True
+
+	async def run_async(self, student, part, step, content, reader):
+		ret = self.app.run_args(part, step, content)
+		if is_error(ret): return ret
+		compiler, flags, main_src = ret.dat
+		if len(self.acomp.pending) >= self.max_queue:
+			return Busy(self.acomp.retry_after())
+		job = RunJob(student.uid, part.uid, step.uid)
+		async def work():
+			try:
+				rr = await self.compile_and_run(student, part, step, compiler, flags, main_src, on_line=job.on_line)
+				job.finish('ok' if rr is not None else 'invalid')
+			except BaseException:
+				job.finish('error')
+				raise
+		task = asyncio.ensure_future(work())
+		self.tasks.add(task)
+		task.add_done_callback(self.tasks.discard)
+		self.app.jobs.add(job)
+		url = '/'.join(['', student.uid, part.uid, step.uid, 'stream', job.uid])
+		return Success(json.dumps({'job': job.uid, 'stream': url}), content_type='application/json')
+
+	async def compile_and_run(self, student, part, step, compiler, flags, main_src, on_line=None):
+		async with self.student_slot(student.uid):
+			rr = await self.acomp.compile_and_run(compiler, flags, main_src, on_line=on_line)
+		if rr is None: return None
+		return await asyncio.to_thread(self.app.record_run, student, part, step, compiler, flags, main_src, rr)
+
+	# http
+
+	async def handle_POST(self, pp, content, reader):
+		cmds = {'run': self.run, 'start': self.run_async, 'compare': self.compare, 'rerun': self.rerun, 'check': self.check}
+		if len(pp) == 4 and pp[3] in cmds:
+			ret = await asyncio.to_thread(self.app.parse_student_path, pp[0], (pp[1], pp[2]))
+			if is_error(ret): return ret
+			return await cmds[pp[3]](*ret.dat, content, reader)
+		if len(pp) != 4:
+			return Error(f'Invalid POST path: {pp}')
+		return await asyncio.to_thread(self.app.exec, pp[3], pp[0], (pp[1], pp[2]), content)
+
+	async def handle(self, reader, writer):
+		try:
+			while True:
+				try:
+					head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.timeout)
+				except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+					return
+				request_line, *header_lines = head.decode('latin-1').rstrip('\r\n').split('\r\n')
+				headers = {}
+				for line in header_lines:
+					name, _, value = line.partition(':')
+					headers[name.strip().lower()] = value.strip()
+				try:
+					method, path, version = request_line.split(' ')
+				except ValueError:
+					await self.respond(writer, headers, Error(f"bad request: {request_line}"), keep_alive=False)
+					return
+				connection = headers.get('connection', '').lower()
+				keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+				pp = path.split('/')[1:]
+				with metrics.request(method, endpoint(self.app, method, pp), path):
+					if method == 'GET':
+						admin = is_admin(self.app.admin_token, headers.get('authorization'))
+						resp = await asyncio.to_thread(route_GET, self, self.app, pp, path, admin)
+					elif method == 'POST' and 'content-length' in headers:
+						try:
+							with metrics.timed('parse_post'):
+								length = int(headers['content-length'])
+								content = parse_content(await reader.readexactly(length)) if length > 0 else {}
+						except Exception as ee:
+							resp, keep_alive = Error(str(ee)), False
+						else:
+							resp = await self.handle_POST(pp, content, reader)
+					else:
+						# without a length we cannot tell where the next request would start
+						resp, keep_alive = Error(f"unsupported request: {request_line}"), False
+					if resp is None: return  # client is gone
+					if not await self.respond(writer, headers, resp, keep_alive, pp): return
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		finally:
+			writer.close()
+
+	async def respond(self, writer, headers, resp, keep_alive: bool, pp=None) -> bool:
+		""" sends `resp`, returns whether the connection can be reused """
+		compress = False
+		extra = []
+		if isinstance(resp, Error):
+			print(resp)
+			status, body, content_type = 404, self.html_404, 'text/html; charset=utf-8'
+		elif isinstance(resp, Success):
+			status, body, content_type = 200, resp.dat.encode('utf8'), resp.content_type or 'text/html; charset=utf-8'
+			compress = True
+		elif isinstance(resp, Redirect):
+			print(resp)
+			status, body, content_type = 303, self.html_303, 'text/html; charset=utf-8'
+			extra.append(('Location', resp.path))
+		elif isinstance(resp, Busy):
+			print(resp)
+			status, content_type = 503, 'text/html; charset=utf-8'
+			body = f"<html><body><h1>Server busy, please retry in {resp.retry_after}s</h1></body></html>".encode('utf8')
+			extra.append(('Retry-After', str(resp.retry_after)))
+		elif isinstance(resp, Static):
+			return await self.send_static(writer, headers, resp.asset, keep_alive)
+		elif isinstance(resp, Stream):
+			if len(pp) == 5 and pp[3] == 'stream':
+				chunks = self.app.jobs.get(pp[4]).sse_async()
+			else:
+				chunks = chunks_from_thread(resp.chunks)
+			return await self.send_stream(writer, chunks, resp.content_type, keep_alive)
+		else:
+			assert False, f"Invalid response: {resp}"
+		extra.append(('Content-Type', content_type))
+		if compress:
+			extra.append(('Vary', 'Accept-Encoding'))
+			if len(body) >= self.gzip_min_size and accepts_gzip(headers.get('accept-encoding', '')):
+				body = gzip.compress(body, compresslevel=5)
+				extra.append(('Content-Encoding', 'gzip'))
+		extra.append(('Content-Length', str(len(body))))
+		await self.send(writer, status, extra, body, keep_alive)
+		return keep_alive
+
+	async def send(self, writer, status: int, headers: list, body: bytes, keep_alive: bool):
+		request = current_request.get()
+		if request is not None: request['status'] = status
+		lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", f"Server: {self.server_version}",
+				 f"Date: {formatdate(usegmt=True)}"]
+		lines += [f"{name}: {value}" for name, value in headers]
+		if not keep_alive: lines.append("Connection: close")
+		writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+		await writer.drain()
+
+	async def send_static(self, writer, headers, asset, keep_alive: bool) -> bool:
+		use_gzip = asset.gzip is not None and accepts_gzip(headers.get('accept-encoding', ''))
+		not_modified = asset.not_modified({'If-None-Match': headers.get('if-none-match'),
+										   'If-Modified-Since': headers.get('if-modified-since')})
+		data = asset.gzip if use_gzip else asset.data
+		extra = []
+		if not not_modified:
+			extra += [('Content-Type', asset.content_type), ('Content-Length', str(len(data)))]
+			if use_gzip: extra.append(('Content-Encoding', 'gzip'))
+		extra += [('ETag', asset.gzip_etag if use_gzip else asset.etag), ('Last-Modified', asset.last_modified),
+				  ('Cache-Control', self.static.cache_control()), ('Vary', 'Accept-Encoding')]
+		await self.send(writer, 304 if not_modified else 200, extra, b'' if not_modified else data, keep_alive)
+		return keep_alive
+
+	async def send_stream(self, writer, chunks, content_type, keep_alive: bool) -> bool:
+		# the length is not known in advance -> chunked transfer encoding
+		await self.send(writer, 200, [('Content-Type', content_type), ('Cache-Control', 'no-cache'),
+									  ('Transfer-Encoding', 'chunked')], b'', keep_alive)
+		async for chunk in chunks:
+			if len(chunk) == 0: continue  # an empty chunk would end the body
+			writer.write(http_chunk(chunk))
+			await writer.drain()
+		writer.write(b'0\r\n\r\n')
+		await writer.drain()
+		return keep_alive
+
+	async def serve(self):
+		self.acomp = AsyncCompiler(self.app.comp, max_procs=self.max_procs, max_queue=self.max_queue)
+		self.check_slots = asyncio.Semaphore(self.acomp.max_procs)
+		metrics.collect(lambda: [('async_builds_pending', 'gauge', {}, len(self.acomp.pending)),
+								 ('async_builds_cancelled_total', 'counter', {}, self.acomp.cancelled)])
+		host, port = self.address
+		self.loop = asyncio.get_running_loop()
+		self.server = await asyncio.start_server(self.handle, host, port, reuse_port=self.reuse_port or None)
+		self.server_address = self.server.sockets[0].getsockname()
+		async with self.server:
+			try:
+				await self.server.serve_forever()
+			except asyncio.CancelledError:
+				pass  # shutdown
+
+	def serve_forever(self):
+		asyncio.run(self.serve())
+
+	def shutdown(self):
+		""" stops `serve_forever` from another thread """
+		self.loop.call_soon_threadsafe(self.server.close)
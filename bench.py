@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import argparse, os, shutil, tempfile, time, json, threading, http.client, random, urllib.parse, platform
+from concurrent.futures import ThreadPoolExecutor
+from compiler import Compiler
+from executor import Executor
+
+def time_compiles(comp, compiler, flags, source, repeat):
+	times = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		cwd, cc = comp.compile(compiler=compiler, flags=flags, source=source, exe='program')
+		times.append(time.perf_counter() - start)
+		assert cc['ret'] == 0, cc['stderr']
+		comp.workspaces.release(cwd)
+	return sum(times) / len(times)
+
+def bench_pch(args):
+	from app import p1
+	working_dir = tempfile.mkdtemp(prefix='bench_')
+	comp = Compiler(working_dir=working_dir)
+	try:
+		for compiler in args.compilers:
+			for flags in [['-O0'], ['-O2', '-fsanitize=address'], ['-O1', '-g', '-fsanitize=undefined']]:
+				comp.use_pch = True
+				comp.pch.args(compiler, flags, p1)  # build the header outside of the measurement
+				with_pch = time_compiles(comp, compiler, flags, p1, args.repeat)
+				comp.use_pch = False
+				without = time_compiles(comp, compiler, flags, p1, args.repeat)
+				print(f"{compiler:8} {' '.join(flags):30} without pch: {without*1000:7.1f}ms  "
+					  f"with pch: {with_pch*1000:7.1f}ms  saved: {(without - with_pch)*1000:7.1f}ms")
+	finally:
+		comp.workspaces.close()
+		shutil.rmtree(working_dir, ignore_errors=True)
+
+# what a compile & run returns when compiling is stubbed out: a colored sanitizer report like the real thing
+stub_result = {
+	'compile': {'ret': 0, 'stdout': '', 'stderr': ''},
+	'run': {'ret': 1, 'stdout': 'The result is: 42\n',
+			'stderr': '\x1b[1m\x1b[31m==1==ERROR: AddressSanitizer: heap-use-after-free on address 0x602000000010\x1b[1m\x1b[0m\n'
+					  + ''.join(f'    #{ii} 0x4011{ii:02d} in main program.cpp:{10 + ii}\n' for ii in range(8))},
+}
+
+def stub_compile_and_run(compiler, flags, source, on_line=None):
+	return json.loads(json.dumps(stub_result))
+
+async def stub_compile_and_run_async(compiler, flags, source, on_line=None):
+	return stub_compile_and_run(compiler, flags, source)
+
+class TestServer:
+	""" runs `Server` (or `AsyncServer`) with `complete_unit()` and `students` fresh students on a free
+	    localhost port; with `stub` programs are not actually compiled and run """
+	def __init__(self, students: int, engine: str = 'threads', stub: bool = False, executors: int = 0, compile_workers=None,
+				 **server_args):
+		from app import complete_unit, app_dir
+		from server import App, Server
+		self.engine = engine
+		self.tmp = tempfile.mkdtemp(prefix='bench_')
+		student_dir = os.path.join(self.tmp, 'students')
+		os.mkdir(student_dir)
+		self.students = [f'student{ii}' for ii in range(students)]
+		for uid in self.students:
+			with open(os.path.join(student_dir, uid + '.json'), 'w') as ff:
+				json.dump({'uid': uid, 'progress': 0, 'answers': [], 'runs': []}, ff)
+		self.app = App(complete_unit(), student_dir=student_dir, compiler_dir=os.path.join(self.tmp, 'compiler'), executors=executors,
+					   compile_workers=compile_workers)
+		if stub: self.app.comp.compile_and_run = stub_compile_and_run
+		lib_dirs = [os.path.join('ext', 'codemirror-5.45.0', dd) for dd in ['lib', 'mode/clike']] + ['style']
+		if engine == 'asyncio':
+			from aserver import AsyncServer
+			self.server = AsyncServer(address=('localhost', 0), app=self.app, student_dir=student_dir, lib_dirs=lib_dirs,
+									  app_dir=app_dir, **server_args)
+		else:
+			self.server = Server(address=('localhost', 0), app=self.app, student_dir=student_dir, lib_dirs=lib_dirs,
+								 app_dir=app_dir, **server_args)
+			self.server.RequestHandlerClass.log_message = lambda *args: None
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+		if engine == 'asyncio':
+			while getattr(self.server, 'server_address', None) is None: time.sleep(0.01)
+			if stub: self.server.acomp.compile_and_run = stub_compile_and_run_async
+		self.port = self.server.server_address[1]
+
+	def close(self):
+		self.server.shutdown()
+		if self.engine != 'asyncio': self.server.server_close()
+		self.thread.join()
+		self.app.comp.workspaces.close()
+		if self.app.comp.executor is not None: self.app.comp.executor.close()
+		shutil.rmtree(self.tmp, ignore_errors=True)
+
+def page_load(student: str) -> list:
+	""" the requests a browser makes when showing a step for the first time """
+	base = f'/{student}/program1'
+	return [f'{base}/step1', f'{base}/style/app.css', f'{base}/ext/codemirror-5.45.0/lib/codemirror.js',
+			f'{base}/ext/codemirror-5.45.0/lib/codemirror.css', f'{base}/ext/codemirror-5.45.0/mode/clike/clike.js']
+
+def bench_http(args):
+	srv = TestServer(students=1)
+	paths = page_load(srv.students[0]) * args.repeat
+	try:
+		for keep_alive in [False, True]:
+			connections = 0
+			received = 0
+			start = time.perf_counter()
+			conn = None
+			for path in paths:
+				if conn is None:
+					conn = http.client.HTTPConnection('localhost', srv.port)
+					connections += 1
+				headers = {'Accept-Encoding': 'gzip'} if keep_alive else {'Connection': 'close'}
+				conn.request('GET', path, headers=headers)
+				resp = conn.getresponse()
+				received += len(resp.read()) + len(str(resp.headers))
+				if not keep_alive or resp.will_close:
+					conn.close()
+					conn = None
+			elapsed = time.perf_counter() - start
+			name = 'keep-alive + gzip' if keep_alive else 'new connection, plain'
+			print(f"{name:22} {len(paths)} requests: {connections:4} connections, "
+				  f"{received / 1024:8.1f} KiB received, {elapsed * 1000:7.1f}ms")
+	finally:
+		srv.close()
+
+def percentile(sorted_values: list, pp: float) -> float:
+	if len(sorted_values) == 0: return 0.0
+	return sorted_values[min(len(sorted_values) - 1, int(pp / 100 * len(sorted_values)))]
+
+class SimulatedStudent:
+	""" walks through the whole unit over one keep-alive connection, like a browser would """
+	def __init__(self, uid: str, port: int, parts, configs, think: float, seed: int):
+		self.uid = uid
+		self.port = port
+		self.parts = parts
+		self.configs = configs
+		self.think = think
+		self.rand = random.Random(seed)
+		self.times = {}   # endpoint -> list of latencies in seconds
+		self.errors = {}  # endpoint -> number of unexpected responses
+		self.conn = None
+
+	def request(self, endpoint, method, path, form=None, expect=200):
+		if self.conn is None: self.conn = http.client.HTTPConnection('localhost', self.port, timeout=600)
+		body = None if form is None else urllib.parse.urlencode(form, doseq=True)
+		headers = {'Accept-Encoding': 'gzip'}
+		if body is not None: headers['Content-Type'] = 'application/x-www-form-urlencoded'
+		start = time.perf_counter()
+		try:
+			self.conn.request(method, path, body=body, headers=headers)
+			resp = self.conn.getresponse()
+			resp.read()
+			status, location = resp.status, resp.getheader('Location')
+			if resp.will_close: self.conn.close(); self.conn = None
+		except (OSError, http.client.HTTPException):
+			self.conn.close(); self.conn = None
+			status, location = None, None
+		self.times.setdefault(endpoint, []).append(time.perf_counter() - start)
+		if status != expect: self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+		return location
+
+	def pause(self):
+		if self.think > 0: time.sleep(self.rand.uniform(0, 2 * self.think))
+
+	def view(self, path):
+		self.request('view', 'GET', path)
+
+	def walk(self):
+		from server import QuestionStep, RunStep, ModifyStep
+		first = True
+		last = self.parts[-1].pos_to_step[-1]
+		for part in self.parts:
+			for step in part.pos_to_step:
+				path = f'/{self.uid}/{part.uid}/{step.uid}'
+				self.view(path)
+				if first:
+					# the browser fetches the style sheet and the editor once, afterwards they are cached
+					for asset in page_load(self.uid)[1:]: self.request('static', 'GET', asset)
+					first = False
+				self.pause()
+				if isinstance(step, QuestionStep):
+					self.request('answer', 'POST', path + '/answer', {'answer': f'an answer by {self.uid}'}, expect=303)
+					self.view(path)
+					self.pause()
+				if isinstance(step, RunStep) or isinstance(step, ModifyStep):
+					for _ in range(2):
+						compiler, flags = self.rand.choice(self.configs)
+						form = {'compiler': compiler, 'flag': flags, 'code': part.program}
+						self.request('run', 'POST', path + '/run', form, expect=303)
+						self.view(path)
+						self.pause()
+				if step is not last: self.request('next', 'POST', path + '/next', {}, expect=303)
+		if self.conn is not None: self.conn.close()
+
+def load_configs():
+	""" mix of compilers and flags that students pick, weighted towards sanitizers """
+	configs = []
+	for compiler in ['g++', 'clang++']:
+		configs += [(compiler, []), (compiler, ['-O2']), (compiler, ['-g', '-fsanitize=address']),
+					(compiler, ['-O1', '-g', '-fsanitize=address']), (compiler, ['-g', '-fsanitize=undefined'])]
+	return configs
+
+def bench_load(args):
+	from app import complete_unit
+	srv = TestServer(students=args.students, engine=args.engine, stub=args.stub, executors=args.executors,
+					 compile_workers=args.compile_workers)
+	students = [SimulatedStudent(uid, srv.port, complete_unit(), load_configs(), think=args.think, seed=args.seed + ii)
+				for ii, uid in enumerate(srv.students)]
+	threads = [threading.Thread(target=ss.walk) for ss in students]
+	try:
+		start = time.perf_counter()
+		for tt in threads: tt.start()
+		for tt in threads: tt.join()
+		elapsed = time.perf_counter() - start
+	finally:
+		srv.close()
+	endpoints = {}
+	for name in sorted({name for ss in students for name in ss.times}):
+		times = sorted(tt for ss in students for tt in ss.times.get(name, []))
+		endpoints[name] = {'count': len(times), 'errors': sum(ss.errors.get(name, 0) for ss in students),
+						   'throughput': len(times) / elapsed, 'p50': percentile(times, 50), 'p95': percentile(times, 95),
+						   'p99': percentile(times, 99), 'max': times[-1]}
+	result = {'config': {'students': args.students, 'engine': args.engine, 'stub': args.stub, 'executors': args.executors,
+						 'compile_workers': args.compile_workers, 'think': args.think,
+						 'seed': args.seed, 'cpus': os.cpu_count(), 'python': platform.python_version()},
+			  'elapsed': elapsed, 'requests': sum(ee['count'] for ee in endpoints.values()), 'endpoints': endpoints}
+	baseline = None
+	if args.baseline is not None:
+		with open(args.baseline) as ff: baseline = json.load(ff)['endpoints']
+	print(f"{args.students} students, {args.engine}{' (stub compiler)' if args.stub else ''}: "
+		  f"{result['requests']} requests in {elapsed:.2f}s = {result['requests'] / elapsed:.1f} req/s")
+	print(f"{'endpoint':8} {'count':>6} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+	for name, ee in endpoints.items():
+		line = (f"{name:8} {ee['count']:6} {ee['errors']:6} {ee['throughput']:8.1f} {ee['p50']*1000:8.1f} "
+				f"{ee['p95']*1000:8.1f} {ee['p99']*1000:8.1f} {ee['max']*1000:8.1f}")
+		if baseline is not None and name in baseline and baseline[name]['p95'] > 0:
+			line += f"   p95 vs baseline: {ee['p95'] / baseline[name]['p95']:.2f}x"
+		print(line)
+	if args.json is not None:
+		with open(args.json, 'w') as ff: json.dump(result, ff, indent=2)
+
+def bench_spawn(args):
+	""" runs one compiled program over and over, started by the server process itself or by the executor's
+	    helpers; `ballast` makes the server as large as one that has been up for a while """
+	from app import p1
+	working_dir = tempfile.mkdtemp(prefix='bench_')
+	comp = Compiler(working_dir=working_dir)
+	ballast = bytearray(args.ballast * 1024 * 1024)
+	for ii in range(0, len(ballast), 4096): ballast[ii] = 1
+	try:
+		cwd, cc = comp.compile('g++', ['-O0'], p1, exe='program')
+		assert cc['ret'] == 0, cc['stderr']
+		def run(_=None):
+			start = time.perf_counter()
+			ret = comp.run_program(cwd, 'program', flags=['-O0'], compiler='g++')
+			assert ret.returncode == 0, ret.stderr
+			return time.perf_counter() - start
+		for name, executor in [('server', None), (f'{args.executors} executors', Executor(args.executors))]:
+			comp.executor = executor
+			for _ in range(3): run()
+			times = sorted(run() for _ in range(args.repeat))
+			start = time.perf_counter()
+			with ThreadPoolExecutor(args.threads) as pool: count = len(list(pool.map(run, range(args.repeat * 2))))
+			elapsed = time.perf_counter() - start
+			print(f"{name:14} {args.ballast} MiB server: p50 {percentile(times, 50)*1000:6.2f}ms  p95 {percentile(times, 95)*1000:6.2f}ms  "
+				  f"{count / elapsed:7.1f} runs/s with {args.threads} threads")
+			if executor is not None: executor.close()
+	finally:
+		comp.workspaces.close()
+		shutil.rmtree(working_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='benchmarks for the interactive C++ debugging unit')
+	sub = parser.add_subparsers(dest='cmd', required=True)
+	pch = sub.add_parser('pch', help='per-compile latency with and without precompiled headers')
+	pch.add_argument('--repeat', type=int, default=5)
+	pch.add_argument('--compilers', nargs='+', default=['g++', 'clang++'])
+	pch.set_defaults(fn=bench_pch)
+	web = sub.add_parser('http', help='connections and bytes for page loads with and without keep-alive/gzip')
+	web.add_argument('--repeat', type=int, default=20)
+	web.set_defaults(fn=bench_http)
+	load = sub.add_parser('load', help='simulated students walking through the unit concurrently')
+	load.add_argument('--students', type=int, default=20)
+	load.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+	load.add_argument('--stub', action='store_true', help='do not compile/run, measures the web path only')
+	load.add_argument('--executors', type=int, default=0, help='helper processes that start compilers and programs')
+	load.add_argument('--compile-workers', nargs='+', metavar='HOST:PORT', help='worker.py daemons to compile and run on')
+	load.add_argument('--think', type=float, default=0.0, help='average pause between a student\'s actions in seconds')
+	load.add_argument('--seed', type=int, default=0)
+	load.add_argument('--json', help='save the results to this file')
+	load.add_argument('--baseline', help='results of an earlier run (--json) to compare against')
+	load.set_defaults(fn=bench_load)
+	spawn = sub.add_parser('spawn', help='per-run latency and runs/s when the server or executor helpers start programs')
+	spawn.add_argument('--repeat', type=int, default=200)
+	spawn.add_argument('--threads', type=int, default=4)
+	spawn.add_argument('--executors', type=int, default=4)
+	spawn.add_argument('--ballast', type=int, default=1024, help='MiB of memory the server holds')
+	spawn.set_defaults(fn=bench_spawn)
+	args = parser.parse_args()
+	args.fn(args)
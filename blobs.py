@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import hashlib, json, os, threading
+from collections import OrderedDict
+
+# the texts of a run record that are stored as blobs (`compile` and `run` are the outputs)
+fields = [('source',), ('compile', 'stdout'), ('compile', 'stderr'), ('run', 'stdout'), ('run', 'stderr')]
+
+def blob_id(text: str) -> str:
+	return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def is_ref(value) -> bool:
+	return isinstance(value, dict) and 'blob' in value
+
+def _texts(run: dict):
+	""" (dict, key) of the fields of a (copied) run record that hold texts or blob references """
+	for path in fields:
+		dd = run
+		for name in path[:-1]:
+			dd = dd.get(name) if isinstance(dd, dict) else None
+		if isinstance(dd, dict) and path[-1] in dd: yield dd, path[-1]
+
+def _copy(run: dict) -> dict:
+	run = dict(run)
+	for name in ['compile', 'run']:
+		if isinstance(run.get(name), dict): run[name] = dict(run[name])
+	return run
+
+class Blobs:
+	""" Sources and outputs of run records, stored once per content under their SHA-256.
+	    Most students run the same program with the same flags, so their records share
+	    the same few texts. Blobs are reference counted; `compact` deletes the ones that
+	    are no longer referenced. Backends implement `_read`, `_write`, `_add_ref`,
+	    `_set_refs`, `_delete_unreferenced` and `sync`. """
+	# shorter texts stay in the record
+	min_size = 64
+
+	def __init__(self, cache_bytes: int = 64 * 1024 * 1024):
+		self.cache = OrderedDict()  # id -> text, recently used (students share the same str objects)
+		self.cache_size = 0
+		self.cache_bytes = cache_bytes
+		self.lock = threading.RLock()
+
+	def _cache(self, bid: str, text: str):
+		if bid in self.cache:
+			self.cache.move_to_end(bid)
+			return
+		self.cache[bid] = text
+		self.cache_size += len(text)
+		while self.cache_size > self.cache_bytes and len(self.cache) > 1:
+			_, old = self.cache.popitem(last=False)
+			self.cache_size -= len(old)
+
+	def get(self, bid: str) -> str:
+		with self.lock:
+			text = self.cache.get(bid)
+			if text is not None:
+				self.cache.move_to_end(bid)
+				return text
+		text = self._read(bid)
+		if text is None:
+			print(f"ERROR: missing blob {bid}")
+			return ''
+		with self.lock: self._cache(bid, text)
+		return text
+
+	def put(self, text: str) -> str:
+		""" stores `text` (unless it already exists) and adds a reference to it """
+		bid = blob_id(text)
+		with self.lock:
+			self._write(bid, text)
+			self._add_ref(bid, 1)
+			self._cache(bid, text)
+		return bid
+
+	def pack(self, run: dict) -> dict:
+		""" copy of a run record with its large texts replaced by {'blob': id} references """
+		run = _copy(run)
+		for dd, key in _texts(run):
+			if isinstance(dd[key], str) and len(dd[key]) >= self.min_size:
+				dd[key] = {'blob': self.put(dd[key])}
+		return run
+
+	def unpack(self, run: dict) -> dict:
+		""" the full run record, records without references are returned as they are """
+		if not any(is_ref(dd[key]) for dd, key in _texts(run)): return run
+		run = _copy(run)
+		for dd, key in _texts(run):
+			if is_ref(dd[key]): dd[key] = self.get(dd[key]['blob'])
+		return run
+
+	def references(self, run: dict) -> list:
+		return [dd[key]['blob'] for dd, key in _texts(run) if is_ref(dd[key])]
+
+	def release(self, run: dict):
+		""" drops the references of a packed run record that was overwritten """
+		with self.lock:
+			for bid in self.references(run): self._add_ref(bid, -1)
+
+	def compact(self, references) -> int:
+		""" replaces the reference counts with `references` (id -> count, from all stored records),
+		    then deletes the blobs without references and returns how many there were """
+		with self.lock:
+			self._set_refs(references)
+			for bid in list(self.cache):
+				self.cache_size -= len(self.cache.pop(bid))
+			return self._delete_unreferenced()
+
+	def stats(self) -> dict:
+		with self.lock:
+			return {'cached': len(self.cache), 'cached_bytes': self.cache_size}
+
+	def sync(self): pass
+
+class FileBlobs(Blobs):
+	""" one file per blob in `directory/<first two hex digits>/<id>`; the reference counts
+	    are kept in memory and written to `directory/refs.json` when the store syncs """
+	def __init__(self, directory: str, **kwargs):
+		super().__init__(**kwargs)
+		self.directory = directory
+		if not os.path.isdir(directory): os.makedirs(directory)
+		self.refs_file = os.path.join(directory, 'refs.json')
+		self.refs = {}
+		if os.path.isfile(self.refs_file):
+			with open(self.refs_file) as ff: self.refs = json.load(ff)
+		self.dirty = False
+
+	def filename(self, bid: str) -> str:
+		return os.path.join(self.directory, bid[:2], bid)
+
+	def _read(self, bid: str):
+		try:
+			with open(self.filename(bid), encoding='utf-8') as ff: return ff.read()
+		except FileNotFoundError:
+			return None
+
+	def _write(self, bid: str, text: str):
+		filename = self.filename(bid)
+		if os.path.isfile(filename): return
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		tmp = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+		with open(tmp, 'w', encoding='utf-8') as ff: ff.write(text)
+		os.replace(tmp, filename)
+
+	def _add_ref(self, bid: str, delta: int):
+		self.refs[bid] = self.refs.get(bid, 0) + delta
+		self.dirty = True
+
+	def _set_refs(self, references):
+		self.refs = {bid: count for bid, count in references.items()}
+		# files that are not referenced at all (e.g. the counts were lost) become garbage as well
+		for sub in os.listdir(self.directory):
+			if not os.path.isdir(os.path.join(self.directory, sub)): continue
+			for name in os.listdir(os.path.join(self.directory, sub)):
+				if not name.endswith('.tmp'): self.refs.setdefault(name, 0)
+		self.dirty = True
+
+	def _delete_unreferenced(self) -> int:
+		garbage = [bid for bid, count in self.refs.items() if count <= 0]
+		for bid in garbage:
+			del self.refs[bid]
+			try: os.remove(self.filename(bid))
+			except FileNotFoundError: pass
+		self.dirty = True
+		self.sync()
+		return len(garbage)
+
+	def stats(self) -> dict:
+		with self.lock:
+			return dict(super().stats(), blobs=len(self.refs), unreferenced=sum(1 for cc in self.refs.values() if cc <= 0))
+
+	def sync(self):
+		with self.lock:
+			if not self.dirty: return
+			refs, self.dirty = json.dumps(self.refs), False
+			tmp = f'{self.refs_file}.{os.getpid()}.tmp'
+			with open(tmp, 'w') as ff: ff.write(refs)
+			os.replace(tmp, self.refs_file)
+
+class SqliteBlobs(Blobs):
+	""" a `blobs` table in the store's database, changed in the same transactions as the runs """
+	schema = 'CREATE TABLE IF NOT EXISTS blobs (id TEXT PRIMARY KEY, data TEXT, refs INTEGER)'
+
+	def __init__(self, db, db_lock, **kwargs):
+		super().__init__(**kwargs)
+		self.db = db
+		self.db_lock = db_lock
+
+	def _read(self, bid: str):
+		with self.db_lock:
+			rows = self.db.execute('SELECT data FROM blobs WHERE id = ?', (bid,)).fetchall()
+		return rows[0][0] if len(rows) > 0 else None
+
+	def _write(self, bid: str, text: str):
+		# the reference is added by _add_ref
+		with self.db_lock:
+			self.db.execute('INSERT OR IGNORE INTO blobs VALUES (?, ?, 0)', (bid, text))
+
+	def _add_ref(self, bid: str, delta: int):
+		with self.db_lock:
+			self.db.execute('UPDATE blobs SET refs = refs + ? WHERE id = ?', (delta, bid))
+
+	def _set_refs(self, references):
+		with self.db_lock:
+			self.db.execute('UPDATE blobs SET refs = 0')
+			self.db.executemany('UPDATE blobs SET refs = ? WHERE id = ?', [(count, bid) for bid, count in references.items()])
+
+	def _delete_unreferenced(self) -> int:
+		with self.db_lock:
+			count = self.db.execute('DELETE FROM blobs WHERE refs <= 0').rowcount
+			self.db.commit()
+		return count
+
+	def stats(self) -> dict:
+		with self.db_lock:
+			blobs, unreferenced = self.db.execute('SELECT count(*), count(CASE WHEN refs <= 0 THEN 1 END) FROM blobs').fetchone()
+		return dict(super().stats(), blobs=blobs, unreferenced=unreferenced)
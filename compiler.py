@@ -3,26 +3,500 @@
 
 # Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
 
-import os, subprocess, re, tempfile
+import os, subprocess, re, tempfile, hashlib, shutil, threading, copy, select, selectors, signal, time, asyncio, functools
+from collections import OrderedDict
+from workspace import Workspaces, QuotaExceeded, dir_size
+from metrics import metrics, flag_label
+import sanitizers
 
 def filter_output(stream : str, cwd : str) -> str:
 	return stream.replace(cwd+'/', '').replace(cwd, '')
 
 def ret_to_dict(ret, cwd: str) -> dict:
-	stdout = filter_output(ret.stdout.decode('utf8'), cwd=cwd)
-	stderr = filter_output(ret.stderr.decode('utf-8'), cwd=cwd)
-	return { 'ret': ret.returncode, 'stdout': stdout, 'stderr': stderr }
+	stdout = filter_output(ret.stdout.decode('utf8', errors='replace'), cwd=cwd)
+	stderr = filter_output(ret.stderr.decode('utf-8', errors='replace'), cwd=cwd)
+	dd = { 'ret': ret.returncode, 'stdout': stdout, 'stderr': stderr }
+	truncated = getattr(ret, 'truncated', {})
+	if len(truncated) > 0:
+		dd['truncated'] = truncated
+	limit = getattr(ret, 'limit', None)
+	if limit is not None:
+		dd['limit'] = limit
+		dd['stderr'] += f"\n*** stopped: exceeded the {limit} limit ***\n"
+	return dd
+
+def run_to_dict(ret, cwd: str) -> dict:
+	""" `ret_to_dict` of a program, with the sanitizer reports it printed parsed into `findings` """
+	dd = ret_to_dict(ret, cwd=cwd)
+	dd['findings'] = sanitizers.parse(dd['stderr'])
+	return dd
+
+def unavailable(msg: str) -> dict:
+	""" result of a build that could not be started """
+	return {'compile': {'ret': -1, 'stdout': '', 'stderr': msg}, 'run': {}}
+
+# messages about the student's program, without colors (`check` passes it on stdin)
+diagnostic_re = re.compile(r'^program\.cpp:(\d+):(\d+): (fatal error|error|warning|note): (.*)$')
+
+def check_to_dict(ret) -> dict:
+	""" result of a syntax check: the compiler output and the diagnostics parsed from it """
+	stderr = ret.stderr.decode('utf-8', errors='replace').replace('<stdin>', 'program.cpp')
+	diagnostics = []
+	for line in stderr.splitlines():
+		m = diagnostic_re.match(line)
+		if m is None: continue
+		severity = 'error' if m.group(3) == 'fatal error' else m.group(3)
+		diagnostics.append({'line': int(m.group(1)), 'col': int(m.group(2)), 'severity': severity, 'message': m.group(4)})
+	dd = {'ret': ret.returncode, 'stderr': stderr, 'diagnostics': diagnostics}
+	if getattr(ret, 'limit', None) is not None: dd['limit'] = ret.limit
+	return dd
+
+class WorkersUnavailable(Exception):
+	""" raised by worker.Workers if no compile worker answers """
+
+prlimit = shutil.which('prlimit')
+
+class Limits:
+	""" Resource limits for a child process, None disables a limit.
+	    `address_space` cannot be used with address/memory/thread sanitizers since they
+	    reserve terabytes of virtual memory for their shadow; those builds are limited
+	    through the sanitizer's `hard_rss_limit_mb` option instead. """
+	def __init__(self, wall_time=10.0, cpu_time=5, address_space=512 * 1024 * 1024,
+				 file_size=16 * 1024 * 1024, processes=None, output_head=64 * 1024, output_tail=64 * 1024):
+		self.wall_time = wall_time
+		self.cpu_time = cpu_time
+		self.address_space = address_space
+		self.file_size = file_size
+		self.processes = processes  # note: RLIMIT_NPROC counts all processes of the server's user
+		# how much of the beginning and the end of stdout/stderr is kept
+		self.output_head = output_head
+		self.output_tail = output_tail
+
+	def command(self, cmd: list, sanitized: bool = False) -> list:
+		""" `cmd` started by prlimit, which sets the limits and then execs it (a `preexec_fn` could
+		    deadlock in the child since the server forks from many threads) """
+		assert prlimit is not None, "prlimit (util-linux) is needed to limit compilers and programs"
+		args = [prlimit, '--core=0']
+		if self.cpu_time is not None:
+			# SIGXCPU at the soft limit, SIGKILL one second later
+			args.append(f'--cpu={self.cpu_time}:{self.cpu_time + 1}')
+		if not sanitized and self.address_space is not None: args.append(f'--as={self.address_space}')
+		if self.file_size is not None: args.append(f'--fsize={self.file_size}')
+		if self.processes is not None: args.append(f'--nproc={self.processes}')
+		return args + ['--'] + cmd
+
+	def exceeded(self, returncode: int, stderr: bytes):
+		""" name of the limit that most likely ended a process (other than the wall time) """
+		if returncode in {-signal.SIGXCPU, -signal.SIGKILL} and self.cpu_time is not None: return 'CPU time'
+		if returncode == -signal.SIGXFSZ and self.file_size is not None: return 'file size'
+		if returncode != 0 and any(m in stderr for m in [b'hard rss limit exhausted', b'std::bad_alloc', b'out of memory']):
+			return 'memory'
+		return None
+
+def truncation_marker(omitted: int, total: int) -> bytes:
+	return f"\n... [{omitted} bytes omitted, {total} bytes in total] ...\n".encode('utf-8')
+
+class Capture:
+	""" keeps the first `head` and the last `tail` bytes of a stream """
+	def __init__(self, head: int = None, tail: int = 0):
+		self.head_limit = head
+		self.tail_limit = tail
+		self.head = bytearray()
+		self.tail = bytearray()
+		self.total = 0
+	def write(self, data: bytes):
+		self.total += len(data)
+		if self.head_limit is None or len(self.head) < self.head_limit:
+			room = len(data) if self.head_limit is None else self.head_limit - len(self.head)
+			self.head += data[:room]
+			data = data[room:]
+		if len(data) > 0 and self.tail_limit > 0:
+			self.tail += data
+			if len(self.tail) > self.tail_limit: del self.tail[:len(self.tail) - self.tail_limit]
+	@property
+	def truncated(self) -> bool:
+		return self.total > len(self.head) + len(self.tail)
+	def getvalue(self) -> bytes:
+		if not self.truncated: return bytes(self.head + self.tail)
+		omitted = self.total - len(self.head) - len(self.tail)
+		return bytes(self.head) + truncation_marker(omitted, self.total) + bytes(self.tail)
+
+class OutputLines:
+	""" splits streamed output into complete, path-filtered lines for `on_line(phase, stream, line)`;
+	    stops forwarding a stream after `max_bytes`. Output ('reset', None) means that the process
+	    starts over (its executor helper died), which becomes `on_line('reset', phase, None)`. """
+	def __init__(self, on_line, phase: str, cwd: str, max_bytes: int = 64 * 1024, max_line: int = 4096):
+		self.on_line = on_line
+		self.phase = phase
+		self.cwd = cwd
+		self.max_bytes = max_bytes
+		self.max_line = max_line
+		self.buffers = {}
+		self.sent = {}
+		self.total = {}
+	def _emit(self, stream: str, line: bytes):
+		sent = self.sent.get(stream, 0)
+		if sent >= self.max_bytes: return
+		self.sent[stream] = sent + len(line) + 1
+		self.on_line(self.phase, stream, filter_output(line.decode('utf-8', errors='replace'), cwd=self.cwd))
+		if self.sent[stream] >= self.max_bytes:
+			self.on_line(self.phase, stream, '... [output truncated] ...')
+	def __call__(self, stream: str, data: bytes):
+		if stream == 'reset':
+			if len(self.total) > 0: self.on_line('reset', self.phase, None)
+			self.buffers, self.sent, self.total = {}, {}, {}
+			return
+		self.total[stream] = self.total.get(stream, 0) + len(data)
+		buf = self.buffers.get(stream, b'') + data
+		*lines, buf = buf.split(b'\n')
+		# very long lines are forwarded in pieces
+		while len(buf) > self.max_line:
+			lines.append(buf[:self.max_line])
+			buf = buf[self.max_line:]
+		self.buffers[stream] = buf
+		for line in lines:
+			self._emit(stream, line)
+	def flush(self):
+		for stream, buf in self.buffers.items():
+			if len(buf) > 0: self._emit(stream, buf)
+		for stream, sent in self.sent.items():
+			if sent >= self.max_bytes:
+				self.on_line(self.phase, stream, f'... [{self.total[stream]} bytes in total] ...')
+		self.buffers = {}
+
+def execute(cmd, cwd, env=None, on_output=None, limits=None, sanitized=False, stdin: bytes = None):
+	""" like subprocess.run with captured stdout/stderr, but reports output as it arrives and
+	    enforces `limits`; the returned CompletedProcess has a `limit` attribute naming the
+	    limit that was exceeded (or None) """
+	proc = spawn(cmd, cwd, env=env, limits=limits, sanitized=sanitized, stdin=stdin)
+	metrics.add('subprocesses_in_flight', 1)
+	try:
+		return _communicate(proc, cmd, on_output, limits, stdin)
+	finally:
+		metrics.add('subprocesses_in_flight', -1)
+
+def spawn(cmd, cwd, env=None, limits=None, sanitized=False, stdin: bytes = None):
+	PIPE = subprocess.PIPE
+	if limits is not None: cmd = limits.command(cmd, sanitized)
+	# new session -> the whole process group can be killed on timeout
+	return subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.DEVNULL if stdin is None else PIPE, stderr=PIPE, stdout=PIPE,
+							env=env, start_new_session=True)
+
+def _communicate(proc, cmd, on_output, limits, stdin=None):
+	deadline = None if limits is None or limits.wall_time is None else time.monotonic() + limits.wall_time
+	timed_out = False
+	if limits is None: out = {'stdout': Capture(), 'stderr': Capture()}
+	else: out = {name: Capture(limits.output_head, limits.output_tail) for name in ['stdout', 'stderr']}
+	with selectors.DefaultSelector() as sel:
+		sel.register(proc.stdout, selectors.EVENT_READ, 'stdout')
+		sel.register(proc.stderr, selectors.EVENT_READ, 'stderr')
+		if stdin is not None:
+			sel.register(proc.stdin, selectors.EVENT_WRITE, 'stdin')
+			stdin = memoryview(stdin)
+		while len(sel.get_map()) > 0:
+			timeout = None if deadline is None else deadline - time.monotonic()
+			if timeout is not None and timeout <= 0:
+				timed_out = True
+				break
+			for key, _ in sel.select(timeout):
+				if key.data == 'stdin':
+					# a writable pipe takes at least PIPE_BUF bytes without blocking
+					try:
+						stdin = stdin[os.write(key.fileobj.fileno(), stdin[:select.PIPE_BUF]):]
+					except BrokenPipeError:
+						stdin = stdin[:0]
+					if len(stdin) == 0:
+						sel.unregister(key.fileobj)
+						key.fileobj.close()
+					continue
+				data = os.read(key.fileobj.fileno(), 65536)
+				if len(data) == 0:
+					sel.unregister(key.fileobj)
+					continue
+				out[key.data].write(data)
+				if on_output is not None: on_output(key.data, data)
+	if timed_out or (deadline is not None and proc.poll() is None and not wait_until(proc, deadline)):
+		timed_out = True
+		try: os.killpg(proc.pid, signal.SIGKILL)
+		except ProcessLookupError: pass
+	for ff in [proc.stdin, proc.stdout, proc.stderr]:
+		if ff is not None: ff.close()
+	returncode = proc.wait()
+	ret = subprocess.CompletedProcess(cmd, returncode, out['stdout'].getvalue(), out['stderr'].getvalue())
+	ret.truncated = {name: cc.total for name, cc in out.items() if cc.truncated}
+	if timed_out: ret.limit = 'wall time'
+	elif limits is not None: ret.limit = limits.exceeded(returncode, ret.stderr)
+	else: ret.limit = None
+	return ret
+
+async def execute_async(cmd, cwd, env=None, on_output=None, limits=None, sanitized=False, stdin: bytes = None):
+	""" `execute` for asyncio: cancelling the calling task kills the whole process group """
+	args = cmd if limits is None else limits.command(cmd, sanitized)
+	proc = await asyncio.create_subprocess_exec(*args, cwd=cwd, stdin=subprocess.DEVNULL if stdin is None else subprocess.PIPE,
+												stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, start_new_session=True)
+	metrics.add('subprocesses_in_flight', 1)
+	try:
+		return await _communicate_async(proc, cmd, on_output, limits, stdin)
+	finally:
+		metrics.add('subprocesses_in_flight', -1)
+
+async def _communicate_async(proc, cmd, on_output, limits, stdin=None):
+	if limits is None: out = {'stdout': Capture(), 'stderr': Capture()}
+	else: out = {name: Capture(limits.output_head, limits.output_tail) for name in ['stdout', 'stderr']}
+	async def read(name, stream):
+		while True:
+			data = await stream.read(65536)
+			if len(data) == 0: return
+			out[name].write(data)
+			if on_output is not None: on_output(name, data)
+	async def write():
+		if stdin is None: return
+		try:
+			proc.stdin.write(stdin)
+			await proc.stdin.drain()
+		except (BrokenPipeError, ConnectionResetError):
+			pass
+		proc.stdin.close()
+	async def communicate():
+		await asyncio.gather(write(), read('stdout', proc.stdout), read('stderr', proc.stderr))
+		return await proc.wait()
+	wall_time = None if limits is None else limits.wall_time
+	timed_out = False
+	try:
+		returncode = await asyncio.wait_for(communicate(), wall_time)
+	except asyncio.TimeoutError:
+		timed_out = True
+	finally:
+		if proc.returncode is None:
+			try: os.killpg(proc.pid, signal.SIGKILL)
+			except ProcessLookupError: pass
+	if timed_out: returncode = await proc.wait()
+	ret = subprocess.CompletedProcess(cmd, returncode, out['stdout'].getvalue(), out['stderr'].getvalue())
+	ret.truncated = {name: cc.total for name, cc in out.items() if cc.truncated}
+	if timed_out: ret.limit = 'wall time'
+	elif limits is not None: ret.limit = limits.exceeded(returncode, ret.stderr)
+	else: ret.limit = None
+	return ret
+
+def wait_until(proc, deadline) -> bool:
+	try:
+		proc.wait(timeout=max(0, deadline - time.monotonic()))
+		return True
+	except subprocess.TimeoutExpired:
+		return False
+
+def cacheable(result: dict) -> bool:
+	""" results that hit the wall time limit mostly show how busy the machine was, not what the
+	    program does, so they are built again next time (the other limits do not depend on the load) """
+	return not any(isinstance(ret, dict) and ret.get('limit') == 'wall time' for ret in result.values())
+
+class CompileCache:
+	""" LRU cache of compile-and-run results (and the binaries they were built from).
+	    Identical requests that arrive while a build is in flight wait for that build
+	    instead of starting their own. """
+	def __init__(self, max_bytes: int = 256 * 1024 * 1024, release=None):
+		self.max_bytes = max_bytes
+		self.release = release or (lambda cwd: shutil.rmtree(cwd, ignore_errors=True))
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.entries = OrderedDict()  # key -> (cwd, result, size)
+		self.pending = {}             # key -> threading.Event
+		self.pins = {}                # cwd -> number of users running its binary
+		self.unpinned = set()         # evicted while pinned, released by the last `unpin`
+		self.lock = threading.Lock()
+
+	def get_or_build(self, key, build):
+		while True:
+			with self.lock:
+				if key in self.entries:
+					self.entries.move_to_end(key)
+					self.hits += 1
+					return copy.deepcopy(self.entries[key][1])
+				event = self.pending.get(key)
+				if event is None:
+					event = self.pending[key] = threading.Event()
+					self.misses += 1
+					break
+			# somebody else is building the same thing -> wait and look again
+			event.wait()
+		try:
+			cwd, result = build()
+			if result is not None:
+				self.put(key, cwd, result)
+		finally:
+			# only release waiters once the result is visible in the cache
+			with self.lock:
+				del self.pending[key]
+			event.set()
+		return copy.deepcopy(result)
+
+	def get(self, key, count_miss: bool = True):
+		""" non-blocking lookup, None on a miss (builds in flight are not waited for) """
+		with self.lock:
+			if key not in self.entries:
+				if count_miss: self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return copy.deepcopy(self.entries[key][1])
+
+	def pin(self, key):
+		""" (cwd, result) of a cached build whose directory is kept until `unpin(cwd)`, None on a miss """
+		with self.lock:
+			if key not in self.entries: return None
+			self.entries.move_to_end(key)
+			cwd, result, _ = self.entries[key]
+			if cwd is not None: self.pins[cwd] = self.pins.get(cwd, 0) + 1
+			return cwd, copy.deepcopy(result)
+
+	def unpin(self, cwd):
+		with self.lock:
+			self.pins[cwd] -= 1
+			if self.pins[cwd] > 0: return
+			del self.pins[cwd]
+			if cwd not in self.unpinned: return
+			self.unpinned.discard(cwd)
+		self.release(cwd)
+
+	def _release(self, cwds):
+		with self.lock:
+			pinned = {cwd for cwd in cwds if cwd in self.pins}
+			self.unpinned.update(pinned)
+		for cwd in cwds:
+			if cwd not in pinned: self.release(cwd)
+
+	def put(self, key, cwd, result):
+		if not cacheable(result):
+			if cwd is not None: self.release(cwd)
+			return
+		size = dir_size(cwd) if cwd is not None else 0
+		size += sum(len(ret.get('stdout', '')) + len(ret.get('stderr', '')) for ret in result.values())
+		evicted = []
+		with self.lock:
+			if key in self.entries:
+				evicted.append(self.entries.pop(key))
+				self.size -= evicted[-1][2]
+			self.entries[key] = (cwd, result, size)
+			self.size += size
+			evicted += self._evict(self.max_bytes, keep=1)
+		self._release([old_cwd for old_cwd, _, _ in evicted if old_cwd is not None and old_cwd != cwd])
+
+	def _evict(self, max_bytes: int, keep: int = 0) -> list:
+		evicted = []
+		while self.size > max_bytes and len(self.entries) > keep:
+			_, old = self.entries.popitem(last=False)
+			self.size -= old[2]
+			evicted.append(old)
+		return evicted
+
+	def shrink(self, nbytes: int):
+		""" evict least recently used entries until at least `nbytes` are freed (or the cache is empty) """
+		with self.lock:
+			evicted = self._evict(max(0, self.size - nbytes))
+		self._release([old_cwd for old_cwd, _, _ in evicted if old_cwd is not None])
+
+	def stats(self) -> dict:
+		with self.lock:
+			return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+include_re = re.compile(r'^\s*#\s*include\s*<([^>]+)>\s*$')
+directive_re = re.compile(r'^\s*#')
+
+def system_includes(source: str):
+	""" returns the list of system headers a program includes, or None if it uses any other
+	    preprocessor directive (which could change how those headers are parsed) """
+	headers = []
+	for line in source.splitlines():
+		m = include_re.match(line)
+		if m is not None: headers.append(m.group(1))
+		elif directive_re.match(line): return None
+	return headers
+
+class PrecompiledHeaders:
+	""" builds one precompiled header with the common includes per (compiler, version, flags) """
+	def __init__(self, comp, headers: list):
+		self.comp = comp
+		self.headers = headers
+		self.pch_dir = os.path.join(comp.workspaces.root, 'pch')
+		if not os.path.isdir(self.pch_dir): os.mkdir(self.pch_dir)
+		self.built = {}    # key -> list of extra compiler args or None if the build failed
+		self.pending = {}  # key -> threading.Event
+		self.lock = threading.Lock()
+
+	def compatible(self, source: str) -> bool:
+		includes = system_includes(source)
+		return includes is not None and len(includes) > 0 and all(h in self.headers for h in includes)
+
+	def args(self, compiler, flags, source: str) -> list:
+		""" extra compiler arguments to use the precompiled header for `source`, [] if not possible """
+		if not self.compatible(source): return []
+		key = (compiler, self.comp.versions[compiler], tuple(flags))
+		while True:
+			with self.lock:
+				if key in self.built: return self.built[key] or []
+				event = self.pending.get(key)
+				if event is None:
+					event = self.pending[key] = threading.Event()
+					break
+			event.wait()
+		try:
+			args = self._build(compiler, flags)
+		finally:
+			with self.lock:
+				self.built[key] = args
+				del self.pending[key]
+			event.set()
+		return args or []
+
+	def _build(self, compiler, flags):
+		cwd = tempfile.mkdtemp(prefix=compiler+'_', dir=self.pch_dir)
+		header = os.path.join(cwd, 'pch.h')
+		with open(header, 'w') as ff:
+			ff.write(''.join(f'#include <{h}>\n' for h in self.headers))
+		out = header + ('.gch' if compiler == 'g++' else '.pch')
+		r = self.comp._run(compiler, args=flags + ['-x', 'c++-header', 'pch.h', '-o', out], cwd=cwd)
+		if r.returncode != 0:
+			print(f"WARN: failed to build precompiled header for {compiler} {' '.join(flags)}")
+			return None
+		# g++ picks up pch.h.gch next to an included pch.h, clang++ needs to be told explicitly
+		if compiler == 'g++': return ['-include', header]
+		else:                 return ['-include-pch', out]
 
 class Compiler:
-	def __init__(self, working_dir):
+	def __init__(self, working_dir, cache_bytes: int = 256 * 1024 * 1024, pch_headers: list = None, quota_bytes: int = 1024 * 1024 * 1024,
+				 limits: Limits = None, compile_limits: Limits = None, executor=None, workers=None, check_cache_bytes: int = 16 * 1024 * 1024):
 		self.allowed_flags = [f'-O{ii}' for ii in range(4)]
 		self.allowed_flags += ['-g', '-Wall']
 		self.allowed_flags += [f'-fsanitize={name}' for name in ['address', 'thread', 'memory', 'undefined', 'leak']]
 		self.allowed_flags += ['-fno-sanitize=all']
 		# https://github.com/google/sanitizers/wiki/SanitizerCommonFlags
 		self.options = {f'{key}_OPTIONS': "color=always" for key in ['ASAN', 'TSAN', 'MSAN', 'LSAN', 'UBSAN']}
+		# what students may add to `options` when running a binary again
+		self.allowed_options = {
+			'ASAN_OPTIONS': ['detect_leaks', 'detect_stack_use_after_return', 'check_initialization_order', 'strict_init_order',
+							 'strict_string_checks', 'detect_invalid_pointer_pairs', 'halt_on_error'],
+			'UBSAN_OPTIONS': ['print_stacktrace', 'halt_on_error', 'report_error_type'],
+			'MSAN_OPTIONS': ['poison_in_dtor', 'halt_on_error'],
+			'LSAN_OPTIONS': ['report_objects', 'max_leaks'],
+			'TSAN_OPTIONS': ['halt_on_error', 'report_signal_unsafe'],
+		}
+		self.limits = limits or Limits()
+		# precompiled headers (e.g. of iostream with -g) are larger than the 16 MiB that programs may write
+		self.compile_limits = compile_limits or Limits(wall_time=60.0, cpu_time=60, address_space=None, file_size=256 * 1024 * 1024)
 		self.working_dir = os.path.abspath(working_dir)
+		# an executor.Executor starts the processes instead of the server itself
+		self.executor = executor
+		# a worker.Workers pool compiles and runs everything on other machines
+		self.workers = workers
 		self.versions = self.test()
+		self.workspaces = Workspaces(self.working_dir, quota_bytes=quota_bytes)
+		self.cache = CompileCache(max_bytes=cache_bytes, release=self.workspaces.release)
+		self.workspaces.reclaim = self.cache.shrink
+		# results of `check`, students re-check the same text while undoing or switching flags
+		self.checks = CompileCache(max_bytes=check_cache_bytes)
+		self.pch = PrecompiledHeaders(self, ['iostream'] if pch_headers is None else pch_headers)
+		self.use_pch = True
 
 	def test(self):
 		# ensure working dir exists
@@ -31,6 +505,7 @@ class Compiler:
 			assert os.path.isdir(root_dir), f"{root_dir} does not exists"
 			os.mkdir(self.working_dir)
 		assert os.path.isdir(self.working_dir), f"{self.working_dir} does not exist"
+		if self.workers is not None: return self.workers.versions
 
 		# ensure compiler is available
 		versions = {}
@@ -41,56 +516,247 @@ class Compiler:
 			versions[comp] = version
 		return versions
 
-	def _run(self, compiler, args, cwd=None):
+	def _run(self, compiler, args, cwd=None, on_output=None):
 		assert compiler in {'g++', 'clang++'}
 		if cwd is None: cwd = self.working_dir
 		assert os.path.isdir(cwd)
 		if not isinstance(args, list): args = [args]
+		return self.execute(**self._compile_step(compiler, args, cwd, on_output))
+
+	def _compile_step(self, compiler, args: list, cwd, on_output=None) -> dict:
 		if compiler == 'g++':
 			cmd = [compiler, "-fdiagnostics-color"] + args
 		else:
 			cmd = [compiler, "-fcolor-diagnostics"] + args
-		PIPE=subprocess.PIPE
-		ret = subprocess.run(cmd, cwd=cwd, stderr=PIPE, stdout=PIPE)
-		return ret
+		return dict(cmd=cmd, cwd=cwd, on_output=on_output, limits=self.compile_limits)
+
+	def execute(self, cmd, cwd, env=None, **kwargs):
+		""" `execute` in the executor if there is one; `env` holds the variables that are added to the environment """
+		if self.executor is not None: return self.executor.execute(cmd, cwd, env=env, **kwargs)
+		return execute(cmd, cwd, env=None if env is None else dict(os.environ, **env), **kwargs)
+
+	async def execute_async(self, cmd, cwd, env=None, **kwargs):
+		if self.executor is not None: return await self.executor.execute_async(cmd, cwd, env=env, **kwargs)
+		return await execute_async(cmd, cwd, env=None if env is None else dict(os.environ, **env), **kwargs)
 
-	def compile(self, compiler, flags, source: str, exe: str):
+	# The `_*_steps` generators hold everything about compiling and running but the waiting:
+	# they yield the keyword arguments of `execute` (or a function that may block) and are sent
+	# back the result, `_drive` runs them in this thread and `_drive_async` on asyncio.
+
+	def _drive(self, steps):
+		send, value = steps.send, None
+		while True:
+			try: step = send(value)
+			except StopIteration as stop: return stop.value
+			try: send, value = steps.send, step() if callable(step) else self.execute(**step)
+			except BaseException as ee: send, value = steps.throw, ee
+
+	async def _drive_async(self, steps):
+		""" `_drive` for asyncio, cancelling it kills the running process """
+		send, value = steps.send, None
+		while True:
+			try: step = send(value)
+			except StopIteration as stop: return stop.value
+			try: send, value = steps.send, await (asyncio.to_thread(step) if callable(step) else self.execute_async(**step))
+			except BaseException as ee: send, value = steps.throw, ee
+
+	def check_args(self, compiler, flags) -> bool:
 		assert isinstance(flags, list)
 		if compiler not in {'g++', 'clang++'}:
 			print(f"ERROR: invalid compiler: {compiler}")
-			return None, None
+			return False
 		for flag in flags:
 			if flag not in self.allowed_flags:
 				print(f"ERROR: invalid flag: {flag}")
-				return None, None
+				return False
+		return True
+
+	def parse_options(self, text: str):
+		""" "ASAN_OPTIONS=detect_leaks=0:halt_on_error=1 UBSAN_OPTIONS=..." -> dict, None if not allowed """
+		options = {}
+		for item in text.split():
+			env, _, values = item.partition('=')
+			for value in values.split(':'):
+				name, _, val = value.partition('=')
+				if name not in self.allowed_options.get(env, []) or re.fullmatch(r'\d{1,6}|true|false', val) is None:
+					print(f"ERROR: invalid sanitizer option: {env}={value}")
+					return None
+			options[env] = values if env not in options else options[env] + ':' + values
+		return options
+
+	def cache_key(self, compiler, flags, source: str) -> tuple:
+		# flags keep their order: later ones may override earlier ones (-O levels, -fno-...)
+		source_hash = hashlib.sha256(source.encode('utf-8')).hexdigest()
+		return (compiler, self.versions[compiler], tuple(flags), source_hash,
+				tuple(sorted(self.options.items())))
+
+	def compile(self, compiler, flags, source: str, exe: str, on_line=None):
+		if not self.check_args(compiler, flags):
+			return None, None
+		return self._drive(self._compile_steps(compiler, flags, source, exe, on_line))
+
+	def _compile_steps(self, compiler, flags, source: str, exe: str, on_line=None):
 		# get working directory
-		cwd = tempfile.mkdtemp(prefix=compiler+'_', dir=self.working_dir)
+		cwd = self.workspaces.acquire(prefix=compiler+'_')
 		print(cwd)
-		# generate c++ file
-		program_cpp = 'program.cpp'
-		with open(os.path.join(cwd, program_cpp), 'w') as ff: ff.write(source)
-		# create argument list
-		args = flags + [program_cpp, '-o', exe]
-		# compile program
-		r = self._run(compiler, args=args, cwd=cwd)
+		try:
+			# generate c++ file
+			program_cpp = 'program.cpp'
+			with open(os.path.join(cwd, program_cpp), 'w') as ff: ff.write(source)
+			# the first use of a precompiled header builds it, which blocks
+			pch_args = (yield functools.partial(self.pch.args, compiler, flags, source)) if self.use_pch else []
+			with metrics.timed('compile', compiler=compiler, flags=flag_label(flags)):
+				r = yield from self._compile_lines(compiler, flags + pch_args + [program_cpp, '-o', exe], cwd, on_line)
+				if r.returncode != 0 and len(pch_args) > 0 and b'precompiled' in r.stderr:
+					# the precompiled header could not be used after all -> compile without it
+					r = yield from self._compile_lines(compiler, flags + [program_cpp, '-o', exe], cwd, on_line)
+			metrics.inc('compiles_total', compiler=compiler, flags=flag_label(flags), result='ok' if r.returncode == 0 else 'error')
+		except BaseException:
+			self.workspaces.release(cwd)
+			raise
 		if r.returncode == 0:
 			assert os.path.isfile(os.path.join(cwd, exe))
+		self.workspaces.track(cwd)
 		return cwd, ret_to_dict(r, cwd=cwd)
 
-	def run_program(self, cwd, exe):
-		PIPE = subprocess.PIPE
-		cmd = [os.path.join(cwd, exe)]
-		my_env = os.environ.copy()
-		my_env.update(self.options)
-		ret = subprocess.run(cmd, cwd=cwd, stderr=PIPE, stdout=PIPE, env=my_env)
+	def _compile_lines(self, compiler, args, cwd, on_line):
+		lines = None if on_line is None else OutputLines(on_line, 'compile', cwd=cwd, max_bytes=self.compile_limits.output_head)
+		r = yield self._compile_step(compiler, args, cwd, on_output=lines)
+		if lines is not None: lines.flush()
+		return r
+
+	def sanitized(self, flags) -> bool:
+		""" True if the flags enable a sanitizer that reserves a huge shadow memory """
+		return any(f in flags for f in ['-fsanitize=address', '-fsanitize=memory', '-fsanitize=thread', '-fsanitize=leak'])
+
+	def run_options(self, sanitized: bool, options: dict = None) -> dict:
+		""" environment for a run, `options` (see `parse_options`) are appended to the defaults """
+		env = dict(self.options)
+		for key, value in (options or {}).items(): env[key] += ':' + value
+		if not sanitized or self.limits.address_space is None: return env
+		rss_mb = self.limits.address_space // (1024 * 1024)
+		return {key: f'{value}:hard_rss_limit_mb={rss_mb}' for key, value in env.items()}
+
+	def run_program(self, cwd, exe, on_line=None, flags=None, compiler=None, args=None, stdin=None, options=None):
+		return self._drive(self._run_steps(cwd, exe, on_line, flags, compiler, args, stdin, options))
+
+	def _run_steps(self, cwd, exe, on_line=None, flags=None, compiler=None, args=None, stdin=None, options=None):
+		cmd = [os.path.join(cwd, exe)] + (args or [])
+		sanitized = self.sanitized(flags or [])
+		lines = None if on_line is None else OutputLines(on_line, 'run', cwd=cwd, max_bytes=self.limits.output_head)
+		with metrics.timed('run', compiler=compiler, flags=flag_label(flags)):
+			ret = yield dict(cmd=cmd, cwd=cwd, env=self.run_options(sanitized, options), on_output=lines, limits=self.limits,
+							 sanitized=sanitized, stdin=None if stdin is None else stdin.encode('utf-8'))
+			if lines is not None: lines.flush()
+		metrics.inc('runs_total', compiler=compiler, flags=flag_label(flags), limit=ret.limit or 'none')
 		return ret
 
-	def compile_and_run(self, compiler, flags, source):
+	def compile_and_run(self, compiler, flags, source, on_line=None):
+		""" on_line(phase, stream, line) is called for every line of compiler and program output
+		    as it is produced (not for cached results); on_line('reset', phase, None) voids the lines
+		    so far of a phase, or of all phases if it is None (a compile worker failed and the build
+		    starts over on another one) """
 		#print(f'compile_and_run({compiler}, {flags}, {source})')
+		if not self.check_args(compiler, flags): return None
+		key = self.cache_key(compiler, flags, source)
+		if self.workers is None: build = lambda: self._compile_and_run(compiler, flags, source, on_line)
+		else:                    build = lambda: (None, self.workers.compile_and_run(key, compiler, flags, source, on_line))
+		try:
+			return self.cache.get_or_build(key, build)
+		except QuotaExceeded as ee:
+			print(f"ERROR: {ee}")
+			return unavailable("The server is out of space for compiling programs right now, please try again in a minute.")
+		except WorkersUnavailable as ee:
+			print(f"ERROR: {ee}")
+			return unavailable("The compile servers are not reachable right now, please try again in a minute.")
+
+	def rerun(self, compiler, flags, source, args=None, stdin=None, options=None, on_line=None):
+		""" runs the binary of an earlier `compile_and_run` again with other arguments, stdin or sanitizer
+		    options; it is only rebuilt if it was evicted from the cache in the meantime """
+		if not self.check_args(compiler, flags): return None
+		key = self.cache_key(compiler, flags, source)
+		if self.workers is not None:
+			# the worker keeps the binary and counts the rebuilds
+			try:
+				return self.workers.rerun(key, compiler, flags, source, args, stdin, options, on_line)
+			except WorkersUnavailable as ee:
+				print(f"ERROR: {ee}")
+				return unavailable("The compile servers are not reachable right now, please try again in a minute.")
+		pinned = self._pin_rerun(key)
+		if pinned is None:
+			rr = self.compile_and_run(compiler, flags, source)
+			pinned = self.cache.pin(key)
+			if pinned is None: return rr
+		cwd, result = pinned
+		if cwd is None: return result  # did not compile
+		try:
+			return self._drive(self._rerun_steps(cwd, result, compiler, flags, args, stdin, options, on_line))
+		finally:
+			self.cache.unpin(cwd)
+
+	def _pin_rerun(self, key):
+		pinned = self.cache.pin(key)
+		metrics.inc('reruns_total', rebuilt='no' if pinned is not None else 'yes')
+		return pinned
+
+	def _rerun_steps(self, cwd, result, compiler, flags, args, stdin, options, on_line):
+		""" runs the pinned binary in `cwd` again """
+		ret = yield from self._run_steps(cwd, 'program', on_line=on_line, flags=flags, compiler=compiler,
+										 args=args, stdin=stdin, options=options)
+		self.workspaces.track(cwd)
+		result['run'] = run_to_dict(ret, cwd=cwd)
+		return result
+
+	def check_cmd(self, compiler, flags, pch_args: list = None) -> list:
+		""" only the front end: parses and type checks the source given on stdin, no code generation or linking """
+		return [compiler, '-fsyntax-only'] + flags + (pch_args or []) + ['-x', 'c++', '-']
+
+	def check(self, compiler, flags, source: str):
+		""" errors and warnings of `source` for the compiler and flags (see `check_to_dict`),
+		    cached by source; None for invalid arguments """
+		if not self.check_args(compiler, flags): return None
+		key = self.cache_key(compiler, flags, source)
+		if self.workers is None: build = lambda: (None, {'check': self._drive(self._check_steps(compiler, flags, source))})
+		else:                    build = lambda: (None, {'check': self.workers.check(compiler, flags, source)})
+		try:
+			return self.checks.get_or_build(key, build)['check']
+		except WorkersUnavailable as ee:
+			print(f"ERROR: {ee}")
+			return {'ret': -1, 'stderr': "The compile servers are not reachable right now.", 'diagnostics': []}
+
+	def cached_check(self, compiler, flags, source: str):
+		""" the result of an earlier `check`, None on a miss (which the following `check` counts) """
+		if not self.check_args(compiler, flags): return None
+		rr = self.checks.get(self.cache_key(compiler, flags, source), count_miss=False)
+		return None if rr is None else rr['check']
+
+	def _check_steps(self, compiler, flags, source: str):
+		pch_args = (yield functools.partial(self.pch.args, compiler, flags, source)) if self.use_pch else []
+		stdin = source.encode('utf-8')
+		with metrics.timed('check', compiler=compiler, flags=flag_label(flags)):
+			r = yield dict(cmd=self.check_cmd(compiler, flags, pch_args), cwd=self.working_dir, limits=self.compile_limits,
+						   stdin=stdin)
+			if r.returncode != 0 and len(pch_args) > 0 and b'precompiled' in r.stderr:
+				r = yield dict(cmd=self.check_cmd(compiler, flags), cwd=self.working_dir, limits=self.compile_limits,
+							   stdin=stdin)
+		metrics.inc('checks_total', compiler=compiler, result='ok' if r.returncode == 0 else 'error')
+		return check_to_dict(r)
+
+	def _compile_and_run(self, compiler, flags, source, on_line=None):
+		return self._drive(self._compile_and_run_steps(compiler, flags, source, on_line))
+
+	def _compile_and_run_steps(self, compiler, flags, source, on_line=None):
+		""" -> (workspace of the binary or None, result) """
 		exe = 'program'
-		cwd, cc = self.compile(compiler=compiler, flags=flags, source=source, exe=exe)
-		if cc is None: return None
+		cwd, cc = yield from self._compile_steps(compiler, flags, source, exe, on_line)
 		if cc['ret'] != 0:
-			return {'compile': cc, 'run': {}}
-		ret = self.run_program(cwd=cwd, exe=exe)
-		return {'compile': cc, 'run': ret_to_dict(ret, cwd=cwd)}
+			# nothing to keep around for failed builds
+			self.workspaces.release(cwd)
+			return None, {'compile': cc, 'run': {}}
+		try:
+			ret = yield from self._run_steps(cwd, exe, on_line=on_line, flags=flags, compiler=compiler)
+		except BaseException:
+			self.workspaces.release(cwd)
+			raise
+		self.workspaces.track(cwd)
+		return cwd, {'compile': cc, 'run': run_to_dict(ret, cwd=cwd)}
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import asyncio, functools, os, queue, signal, subprocess, sys, threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from metrics import metrics
+from compiler import execute, spawn, _communicate
+
+class Process:
+	""" the process a helper started for a job, it can be killed from the server """
+	def __init__(self):
+		self.pid = None
+		self.killed = False
+		self.lock = threading.Lock()
+
+	def started(self, pid):
+		with self.lock:
+			self.pid = pid
+			if self.killed: self._kill()
+
+	def finished(self):
+		# the helper reaped it, the pid may be reused
+		with self.lock: self.pid = None
+
+	def kill(self):
+		with self.lock:
+			self.killed = True
+			self._kill()
+
+	def lost(self):
+		""" the helper died: kill what it left behind, the job itself goes on elsewhere """
+		with self.lock:
+			self._kill()
+			self.pid = None
+
+	def _kill(self):
+		if self.pid is None: return
+		try: os.killpg(self.pid, signal.SIGKILL)
+		except ProcessLookupError: pass
+
+class Helper:
+	""" A small, long-lived Python process that starts the compilers and programs of one job
+	    at a time. Forking it is cheap compared to forking the server with all of its caches. """
+	def __init__(self):
+		job_r, job_w = os.pipe()
+		result_r, result_w = os.pipe()
+		self.proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), str(job_r), str(result_w)],
+									 pass_fds=(job_r, result_w), stdin=subprocess.DEVNULL)
+		os.close(job_r)
+		os.close(result_w)
+		self.jobs = Connection(job_w, readable=False)
+		self.results = Connection(result_r, writable=False)
+		self.count = 0
+
+	def execute(self, cmd, cwd, env, on_output, limits, sanitized, stdin, process: Process):
+		""" ('done', CompletedProcess) or ('error', OSError), raises EOFError/OSError if the helper died """
+		self.count += 1
+		self.jobs.send((cmd, cwd, env, limits, sanitized, stdin, on_output is not None))
+		while True:
+			msg = self.results.recv()
+			if msg[0] == 'output': on_output(msg[1], msg[2])
+			elif msg[0] == 'started': process.started(msg[1])
+			else:
+				process.finished()
+				return msg
+
+	def close(self):
+		self.jobs.close()
+		self.results.close()
+		try:
+			self.proc.wait(timeout=5.0)
+		except subprocess.TimeoutExpired:
+			self.proc.kill()
+			self.proc.wait()
+
+class Executor:
+	""" Runs `compiler.execute` in a pool of `size` helper processes that are started right away.
+	    Jobs are sent over a pipe and their output streams back as it arrives. `env` only holds the
+	    variables that are added to the helper's environment (the server's when the pool was started).
+	    A helper that dies is replaced and its job runs in the server process instead. """
+	def __init__(self, size: int = None):
+		self.size = size or os.cpu_count() or 1
+		self.helpers = [Helper() for _ in range(self.size)]
+		self.idle = queue.SimpleQueue()
+		for helper in self.helpers: self.idle.put(helper)
+		# waits for the helpers of `execute_async` jobs
+		self.threads = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix='executor')
+		self.restarts = 0
+		self.lock = threading.Lock()
+
+	def execute(self, cmd, cwd, env=None, on_output=None, limits=None, sanitized=False, stdin: bytes = None,
+				process: Process = None):
+		process = process or Process()
+		helper = self.idle.get()
+		if helper.proc.poll() is not None: helper = self._restart(helper)
+		metrics.add('subprocesses_in_flight', 1)
+		try:
+			msg = helper.execute(cmd, cwd, env, on_output, limits, sanitized, stdin, process)
+		except (EOFError, OSError) as ee:
+			print(f"ERROR: executor helper {helper.proc.pid} failed: {ee!r}")
+			process.lost()
+			helper = self._restart(helper)
+			msg = None
+		finally:
+			metrics.add('subprocesses_in_flight', -1)
+			self.idle.put(helper)
+		if msg is None:
+			if process.killed:
+				# cancelled anyway, report it like a process that was killed
+				ret = subprocess.CompletedProcess(cmd, -signal.SIGKILL, b'', b'')
+				ret.limit = None
+				return ret
+			# the helper may have streamed some output already
+			if on_output is not None: on_output('reset', None)
+			return execute(cmd, cwd, env=None if env is None else dict(os.environ, **env), on_output=on_output,
+						   limits=limits, sanitized=sanitized, stdin=stdin)
+		if msg[0] == 'error': raise msg[1]
+		return msg[1]
+
+	async def execute_async(self, cmd, cwd, env=None, on_output=None, limits=None, sanitized=False, stdin: bytes = None):
+		""" `execute` for asyncio: cancelling the calling task kills the whole process group """
+		loop = asyncio.get_running_loop()
+		process = Process()
+		def forward(name, data):
+			if not process.killed: loop.call_soon_threadsafe(on_output, name, data)
+		job = functools.partial(self.execute, cmd, cwd, env=env, on_output=None if on_output is None else forward,
+								limits=limits, sanitized=sanitized, stdin=stdin, process=process)
+		future = loop.run_in_executor(self.threads, job)
+		try:
+			return await asyncio.shield(future)
+		except asyncio.CancelledError:
+			# the helper notices that the process died and is then free for the next job
+			process.kill()
+			raise
+
+	def _restart(self, helper: Helper) -> Helper:
+		try: helper.proc.kill()
+		except OSError: pass
+		helper.close()
+		new = Helper()
+		with self.lock:
+			self.helpers[self.helpers.index(helper)] = new
+			self.restarts += 1
+		metrics.inc('executor_restarts_total')
+		return new
+
+	def stats(self) -> dict:
+		with self.lock:
+			return {'size': self.size, 'idle': self.idle.qsize(), 'jobs': sum(hh.count for hh in self.helpers),
+					'restarts': self.restarts}
+
+	def close(self):
+		for _ in range(self.size): self.idle.get().close()
+		self.threads.shutdown()
+
+def helper_main(job_fd: int, result_fd: int):
+	jobs, results = Connection(job_fd, writable=False), Connection(result_fd, readable=False)
+	# ctrl-c in a terminal is for the server, which then closes the pipe
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	while True:
+		try:
+			cmd, cwd, env, limits, sanitized, stdin, stream = jobs.recv()
+		except EOFError:
+			return
+		try:
+			proc = spawn(cmd, cwd, env=None if env is None else dict(os.environ, **env), limits=limits,
+						 sanitized=sanitized, stdin=stdin)
+		except OSError as ee:
+			results.send(('error', ee))
+			continue
+		results.send(('started', proc.pid))
+		on_output = (lambda name, data: results.send(('output', name, data))) if stream else None
+		results.send(('done', _communicate(proc, cmd, on_output, limits, stdin)))
+
+if __name__ == '__main__':
+	helper_main(int(sys.argv[1]), int(sys.argv[2]))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import argparse, csv, io, json, re, sys
+from datetime import datetime, timezone
+from store import Store, open_store
+from sanitizers import run_findings
+
+ansi_re = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+error_re = re.compile(r'ERROR: |runtime error: |WARNING: \w+Sanitizer|error: ')
+
+columns = ['kind', 'uid', 'part', 'step', 'time', 'answer', 'compiler', 'flags', 'compile_ret', 'run_ret', 'limit', 'error', 'findings']
+
+def parse_time(text):
+	""" unix timestamp or ISO 8601 date/time (local time unless an offset is given) """
+	if text is None or text == '': return None
+	try:
+		return float(text)
+	except ValueError:
+		return datetime.fromisoformat(text).timestamp()
+
+def first_error(*outputs) -> str:
+	""" the first line of compiler or sanitizer output that reports an error """
+	for out in outputs:
+		for line in ansi_re.sub('', out or '').splitlines():
+			if error_re.search(line): return line.strip()
+	return ''
+
+def summarize(rec: dict) -> dict:
+	""" one flat row per answer or run """
+	row = {'kind': rec['kind'], 'uid': rec['uid'], 'part': rec['part'], 'step': rec['step'],
+		   'time': None if rec['time'] is None else datetime.fromtimestamp(rec['time'], timezone.utc).isoformat()}
+	if rec['kind'] == 'answer':
+		row['answer'] = rec['answer']
+	else:
+		run = rec['run']
+		cc, rr = run.get('compile', {}), run.get('run', {})
+		row.update({'compiler': run.get('compiler'), 'flags': ' '.join(run.get('flags', [])),
+					'compile_ret': cc.get('ret'), 'run_ret': rr.get('ret'), 'limit': rr.get('limit') or cc.get('limit'),
+					'error': first_error(cc.get('stderr'), rr.get('stderr')),
+					'findings': ' '.join(sorted({ff['kind'] for ff in run_findings(run)}))})
+	return row
+
+def to_csv(rows):
+	buf = io.StringIO()
+	out = csv.DictWriter(buf, fieldnames=columns, extrasaction='ignore')
+	out.writeheader()
+	for row in rows:
+		out.writerow(row)
+		yield buf.getvalue().encode('utf-8')
+		buf.seek(0)
+		buf.truncate()
+	if buf.tell() > 0: yield buf.getvalue().encode('utf-8')
+
+def to_jsonl(rows):
+	for row in rows:
+		yield (json.dumps(row) + '\n').encode('utf-8')
+
+formats = {'csv': ('text/csv; charset=utf-8', to_csv), 'jsonl': ('application/x-ndjson', to_jsonl)}
+
+def chunked(chunks, size: int = 64 * 1024):
+	""" joins small chunks into ones of about `size` bytes """
+	buf = []
+	length = 0
+	for chunk in chunks:
+		buf.append(chunk)
+		length += len(chunk)
+		if length >= size:
+			yield b''.join(buf)
+			buf, length = [], 0
+	if length > 0: yield b''.join(buf)
+
+def export(store: Store, fmt: str = 'csv', part=None, step=None, since=None, until=None):
+	""" yields the encoded export chunk by chunk while reading the store one record at a time """
+	_, encode = formats[fmt]
+	rows = (summarize(rec) for rec in store.iter_records(part=part, step=step, since=since, until=until))
+	return chunked(encode(rows))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='export student answers and run summaries')
+	parser.add_argument('path', help='student directory, log directory or sqlite file')
+	parser.add_argument('--store', choices=['json', 'log', 'sqlite'], default='json')
+	parser.add_argument('--format', choices=sorted(formats), default='csv')
+	parser.add_argument('--part', help='only this part, e.g. program2')
+	parser.add_argument('--step', help='only this step, e.g. step2')
+	parser.add_argument('--since', help='only records from this time on (ISO date/time or unix time)')
+	parser.add_argument('--until', help='only records before this time')
+	args = parser.parse_args()
+	store = open_store(args.store, args.path)
+	for chunk in export(store, args.format, part=args.part, step=args.step,
+						since=parse_time(args.since), until=parse_time(args.until)):
+		sys.stdout.buffer.write(chunk)
+	sys.stdout.flush()
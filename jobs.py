@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import json, re, secrets, threading, time, asyncio
+from collections import OrderedDict
+from ansi2html import Ansi2HTMLConverter
+
+sgr_re = re.compile(r'\x1b\[([0-9;]*)m')
+
+class AnsiLines:
+	""" converts one output stream line by line; colours that are still on at the end of a line
+	    (e.g. a multi-line sanitizer report) are carried over to the next one """
+	def __init__(self):
+		self.conv = Ansi2HTMLConverter()
+		self.carry = []  # SGR sequences since the last reset
+
+	def convert(self, line: str) -> str:
+		html = self.conv.convert(''.join(self.carry) + line, full=False)
+		for match in sgr_re.finditer(line):
+			params = match.group(1).split(';')
+			resets = [ii for ii, pp in enumerate(params) if pp in ('', '0')]
+			if len(resets) > 0:
+				self.carry, params = [], params[resets[-1] + 1:]
+			if len(params) > 0: self.carry.append(f"\x1b[{';'.join(params)}m")
+		del self.carry[:-16]
+		return html
+
+class RunJob:
+	""" output of an asynchronous compile & run, kept as a list of events that
+	    any number of readers can follow """
+	def __init__(self, student: str, part: str, step: str):
+		self.uid = secrets.token_urlsafe(12)
+		self.student = student
+		self.part = part
+		self.step = step
+		self.streams = {}  # (phase, stream) -> AnsiLines
+		self.events = []
+		self.finished = None
+		self.cond = threading.Condition()
+		self.waiters = set()  # (loop, asyncio.Event) of asynchronous followers
+
+	def _push(self, event: str, data: dict):
+		with self.cond:
+			self.events.append((event, data))
+			self.cond.notify_all()
+			waiters, self.waiters = self.waiters, set()
+		for loop, changed in waiters:
+			loop.call_soon_threadsafe(changed.set)
+
+	def on_line(self, phase: str, stream: str, line: str):
+		if phase == 'reset':
+			# `stream` is the phase that starts over, None if the whole build does (on another
+			# compile worker); readers drop what they have shown of it
+			self.streams = {key: lines for key, lines in self.streams.items() if stream is not None and key[0] != stream}
+			self._push('reset', {'phase': stream})
+			return
+		html = self.streams.setdefault((phase, stream), AnsiLines()).convert(line)
+		self._push('output', {'phase': phase, 'stream': stream, 'html': html})
+
+	def finish(self, status: str):
+		self._push('done', {'status': status})
+		with self.cond:
+			self.finished = time.monotonic()
+
+	def follow(self, timeout: float = 15.0):
+		""" yields all events, blocking for new ones until the job is done;
+		    yields None as a keep-alive when nothing happened for `timeout` seconds """
+		pos = 0
+		while True:
+			with self.cond:
+				if pos >= len(self.events):
+					self.cond.wait(timeout)
+				events = self.events[pos:]
+			if len(events) == 0:
+				yield None
+			for event, data in events:
+				yield event, data
+				if event == 'done': return
+			pos += len(events)
+
+	async def follow_async(self, timeout: float = 15.0):
+		""" `follow` for asyncio, waits without blocking the event loop """
+		loop = asyncio.get_running_loop()
+		pos = 0
+		while True:
+			changed = asyncio.Event()
+			with self.cond:
+				events = self.events[pos:]
+				if len(events) == 0: self.waiters.add((loop, changed))
+			if len(events) == 0:
+				try:
+					await asyncio.wait_for(changed.wait(), timeout)
+				except asyncio.TimeoutError:
+					pass
+				with self.cond:
+					self.waiters.discard((loop, changed))
+					events = self.events[pos:]
+			if len(events) == 0:
+				yield None
+			for event, data in events:
+				yield event, data
+				if event == 'done': return
+			pos += len(events)
+
+	def sse(self):
+		""" the job's events encoded as server-sent events """
+		for ev in self.follow():
+			yield sse_event(ev)
+
+	async def sse_async(self):
+		async for ev in self.follow_async():
+			yield sse_event(ev)
+
+def sse_event(ev) -> bytes:
+	if ev is None: return b': keep-alive\n\n'
+	event, data = ev
+	return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf8')
+
+class JobStore:
+	def __init__(self, keep_seconds: float = 600.0):
+		self.keep_seconds = keep_seconds
+		self.jobs = OrderedDict()
+		self.lock = threading.Lock()
+
+	def add(self, job: RunJob) -> RunJob:
+		with self.lock:
+			self._expire()
+			self.jobs[job.uid] = job
+		return job
+
+	def get(self, uid: str):
+		with self.lock:
+			return self.jobs.get(uid, None)
+
+	def _expire(self):
+		now = time.monotonic()
+		for uid, job in list(self.jobs.items()):
+			if job.finished is not None and now - job.finished > self.keep_seconds:
+				del self.jobs[uid]
+
+class Latest:
+	""" Numbers the requests of each student, a request is superseded as soon as a newer one
+	    of the same student arrives (e.g. checks of code that was edited in the meantime). """
+	def __init__(self):
+		self.latest = {}  # student -> number of its newest request
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def start(self, student: str) -> int:
+		with self.lock:
+			self.count += 1
+			self.latest[student] = self.count
+			return self.count
+
+	def superseded(self, student: str, number: int) -> bool:
+		with self.lock:
+			return self.latest.get(student) != number
+
+	def finish(self, student: str, number: int):
+		with self.lock:
+			if self.latest.get(student) == number: del self.latest[student]
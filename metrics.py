@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import bisect, contextvars, json, os, threading, time
+from contextlib import contextmanager
+
+# seconds, from a cached page to a program that runs into its wall time limit
+latency_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+class Histogram:
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+	def observe(self, value: float):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+# stage durations of the request that is being handled in this thread / asyncio task
+current_request = contextvars.ContextVar('current_request', default=None)
+
+def format_labels(labels) -> str:
+	if len(labels) == 0: return ''
+	escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+	return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+def flag_label(flags) -> str:
+	return ' '.join(sorted(flags)) if flags else 'none'
+
+class Metrics:
+	""" Counters, gauges and latency histograms in the Prometheus text format.
+	    `collect` registers functions that report the current state of other components
+	    (queue depth, cache statistics, ...) when the metrics are rendered. """
+	prefix = 'cppunit_'
+	def __init__(self):
+		self.counters = {}    # name -> labels -> value
+		self.gauges = {}      # name -> labels -> value
+		self.histograms = {}  # name -> labels -> Histogram
+		self.help = {}
+		self.collectors = []
+		self.log = None
+		self.log_lock = threading.Lock()
+		self.lock = threading.Lock()
+
+	def describe(self, name: str, text: str):
+		self.help[name] = text
+
+	def inc(self, name: str, value: float = 1, **labels):
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			family = self.counters.setdefault(name, {})
+			family[key] = family.get(key, 0) + value
+
+	def add(self, name: str, value: float, **labels):
+		""" changes a gauge """
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			family = self.gauges.setdefault(name, {})
+			family[key] = family.get(key, 0) + value
+
+	def observe(self, name: str, value: float, **labels):
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			family = self.histograms.setdefault(name, {})
+			if key not in family: family[key] = Histogram(latency_buckets)
+			family[key].observe(value)
+
+	@contextmanager
+	def timed(self, stage: str, **labels):
+		""" records the duration as `<stage>_seconds` and adds it to the current request's stages """
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			duration = time.perf_counter() - start
+			self.observe(stage + '_seconds', duration, **labels)
+			request = current_request.get()
+			if request is not None:
+				request['stages'][stage] = request['stages'].get(stage, 0.0) + duration
+
+	@contextmanager
+	def request(self, method: str, endpoint: str, path: str):
+		""" times a request; yields a dict in which the handler fills in the `status` """
+		request = {'method': method, 'endpoint': endpoint, 'path': path, 'status': None, 'stages': {}}
+		token = current_request.set(request)
+		start = time.perf_counter()
+		try:
+			yield request
+		finally:
+			current_request.reset(token)
+			duration = time.perf_counter() - start
+			self.observe('request_seconds', duration, method=method, endpoint=endpoint, status=request['status'])
+			if self.log is not None:
+				self.write_log(request, start=time.time() - duration, duration=duration)
+
+	def open_log(self, filename: str):
+		""" append one JSON line per request to `filename` """
+		self.log = open(filename, 'a', buffering=1)
+
+	def write_log(self, request: dict, start: float, duration: float):
+		rec = {'time': round(start, 6), 'pid': os.getpid(), 'method': request['method'], 'endpoint': request['endpoint'],
+			   'path': request['path'], 'status': request['status'], 'seconds': round(duration, 6),
+			   'stages': {stage: round(tt, 6) for stage, tt in request['stages'].items()}}
+		line = json.dumps(rec) + '\n'
+		with self.log_lock:
+			self.log.write(line)
+
+	def collect(self, fn):
+		""" `fn()` returns a list of (name, type, labels dict, value) that is added when rendering """
+		self.collectors.append(fn)
+
+	def render(self) -> str:
+		samples = {}  # name -> (type, [(labels, value)])
+		with self.lock:
+			for kind, families in [('counter', self.counters), ('gauge', self.gauges)]:
+				for name, family in families.items():
+					samples[name] = (kind, [(key, value) for key, value in family.items()])
+			histograms = {name: [(key, hh.buckets, list(hh.counts), hh.sum, hh.count) for key, hh in family.items()]
+						  for name, family in self.histograms.items()}
+		for fn in self.collectors:
+			for name, kind, labels, value in fn():
+				samples.setdefault(name, (kind, []))[1].append((tuple(sorted(labels.items())), value))
+		lines = []
+		def header(name, kind):
+			if name in self.help: lines.append(f"# HELP {self.prefix}{name} {self.help[name]}")
+			lines.append(f"# TYPE {self.prefix}{name} {kind}")
+		for name, (kind, values) in sorted(samples.items()):
+			header(name, kind)
+			for key, value in sorted(values, key=lambda kv: kv[0]):
+				lines.append(f"{self.prefix}{name}{format_labels(key)} {value}")
+		for name, values in sorted(histograms.items()):
+			header(name, 'histogram')
+			for key, buckets, counts, total, count in sorted(values, key=lambda vv: str(vv[0])):
+				key = tuple((kk, '' if vv is None else vv) for kk, vv in key)
+				cumulative = 0
+				for le, cc in zip(buckets + ['+Inf'], counts):
+					cumulative += cc
+					lines.append(f"{self.prefix}{name}_bucket{format_labels(key + (('le', le),))} {cumulative}")
+				lines.append(f"{self.prefix}{name}_sum{format_labels(key)} {total}")
+				lines.append(f"{self.prefix}{name}_count{format_labels(key)} {count}")
+		return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('request_seconds', 'time from reading a request to sending the response')
+metrics.describe('parse_post_seconds', 'reading and decoding POST bodies')
+metrics.describe('compile_seconds', 'compiler invocations (including the fallback without precompiled header)')
+metrics.describe('check_seconds', 'syntax checks of the code in the editor (compiler front end only)')
+metrics.describe('run_seconds', 'execution of compiled student programs')
+metrics.describe('ansi_seconds', 'ANSI to HTML conversion of program and compiler output')
+metrics.describe('render_seconds', 'template rendering of a step')
+metrics.describe('store_save_seconds', 'writing student data to the store')
+metrics.describe('subprocesses_in_flight', 'compiler and program processes that are currently running')
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import threading, time, itertools, queue
+from scheduler import QueueFull
+
+def common_flag_sets() -> list:
+	""" the flag combinations a student is most likely to pick in app.html """
+	opt = [f'-O{ii}' for ii in range(4)]
+	debug = [[], ['-g']]
+	sanitize = ['-fno-sanitize=all', '-fsanitize=address', '-fsanitize=undefined', '-fsanitize=memory']
+	return [[o] + g + [s] for o, g, s in itertools.product(opt, debug, sanitize)]
+
+class Prewarm:
+	""" compiles and runs every (program, compiler, flags) combination in the background
+	    so that the results are already in the compile cache when students ask for them.
+	    The builds are background jobs of the server's scheduler: up to one per worker is in
+	    flight, but a worker only starts one when no student's job is waiting. Each of them
+	    belongs to its own pseudo-student `~prewarm<slot>` so the per-student limit does not apply. """
+	student = '~prewarm'
+
+	def __init__(self, comp, scheduler, programs: list, flag_sets: list = None, compilers: list = None):
+		self.comp = comp
+		self.scheduler = scheduler
+		flag_sets = flag_sets or common_flag_sets()
+		compilers = compilers or ['g++', 'clang++']
+		self.todo = [(src, cc, flags) for src in programs for cc in compilers for flags in flag_sets]
+		self.done = 0
+		self.failed = 0
+		self.started = None
+		self.finished = None
+		self.lock = threading.Lock()
+
+	def start(self):
+		self.started = time.monotonic()
+		thread = threading.Thread(target=self._run, name='prewarm', daemon=True)
+		thread.start()
+		return thread
+
+	def _run(self):
+		slots = queue.SimpleQueue()
+		for slot in range(self.scheduler.workers): slots.put(slot)
+		for job in self.todo:
+			slot = slots.get()
+			while True:
+				try:
+					self.scheduler.submit(f'{self.student}{slot}', lambda job=job, slot=slot: self._one(job, slots, slot),
+										  background=True)
+					break
+				except QueueFull as ee:
+					time.sleep(ee.retry_after)
+		# wait for the last builds
+		for _ in range(self.scheduler.workers): slots.get()
+		self.finished = time.monotonic()
+		print(f"prewarm: done, {self.done}/{len(self.todo)} ({self.failed} failed) in {self.finished - self.started:.1f}s")
+
+	def _one(self, job, slots, slot):
+		try:
+			self._build(*job)
+		finally:
+			slots.put(slot)
+
+	def _build(self, src, compiler, flags):
+		try:
+			ok = self.comp.compile_and_run(compiler=compiler, flags=flags, source=src) is not None
+		except Exception as ee:
+			print(f"prewarm: {compiler} {' '.join(flags)}: {ee}")
+			ok = False
+		with self.lock:
+			self.done += 1
+			if not ok: self.failed += 1
+			done = self.done
+		if done % 50 == 0:
+			print(f"prewarm: {done}/{len(self.todo)}")
+
+	def stats(self) -> dict:
+		with self.lock:
+			total = len(self.todo)
+			elapsed = 0.0 if self.started is None else (self.finished or time.monotonic()) - self.started
+			return {'total': total, 'done': self.done, 'failed': self.failed,
+					'coverage': self.done / total if total > 0 else 1.0,
+					'elapsed': elapsed, 'finished': self.finished is not None}
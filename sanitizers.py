@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import re, threading
+from metrics import flag_label
+
+ansi_re = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+# ==123==ERROR: AddressSanitizer: heap-use-after-free on address ... / WARNING: ThreadSanitizer: data race (pid=123)
+header_re = re.compile(r'(?:==\d+==)?(?:ERROR|WARNING): (\w+)Sanitizer: (.*)$')
+leak_re = re.compile(r'^(Direct|Indirect) leak of (\d+) byte\(s\) in (\d+) object')
+ubsan_re = re.compile(r'^(\S+?):(\d+):(?:\d+:)? runtime error: (.*)$')
+access_re = re.compile(r'\b(READ|WRITE|Read|Write) of size (\d+)')
+signal_access_re = re.compile(r'caused by a (READ|WRITE) memory access')
+# #0 0x55d0c1a3a320 in main program.cpp:6   /   #2 0x7fcd2bc45304 in __libc_start_main (/lib/x86_64-linux-gnu/libc.so.6+0x27304)
+frame_re = re.compile(r'^\s*#(\d+) 0x[0-9a-f]+\s+(?:in (.+?) )?(?:\((\S+)\)|(\S+?):(\d+)(?::\d+)?)$')
+
+kinds = [
+	# AddressSanitizer messages that do not start with the kind
+	(r'attempting double-free', 'double-free'),
+	(r'attempting free on address which was not malloc', 'bad-free'),
+	(r'hard rss limit exhausted', 'rss-limit-exceeded'),
+	(r'(allocator is )?out of memory', 'out-of-memory'),
+	(r'requested allocation size', 'allocation-size-too-big'),
+	(r'detected memory leaks', 'memory-leak'),
+	# UndefinedBehaviorSanitizer runtime errors
+	(r'signed integer overflow', 'signed-integer-overflow'),
+	(r'unsigned integer overflow', 'unsigned-integer-overflow'),
+	(r'index .* out of bounds', 'out-of-bounds-index'),
+	(r'.* with insufficient space for an object', 'object-size'),
+	(r'(load|store|member access) .*misaligned address', 'misaligned-access'),
+	(r'.*null pointer', 'null-dereference'),
+	(r'(shift exponent|left shift)', 'shift-out-of-bounds'),
+	(r'division by zero', 'division-by-zero'),
+	(r'load of value .* not a valid value', 'invalid-value'),
+	(r'execution reached the end of a value-returning function', 'missing-return'),
+	(r'execution reached an unreachable program point', 'unreachable'),
+	(r'(pointer index expression|applying .* offset)', 'pointer-overflow'),
+	(r'variable length array bound', 'vla-bound'),
+	(r'.* is outside the range of representable values', 'float-cast-overflow'),
+	(r'implicit conversion', 'implicit-conversion'),
+]
+kinds = [(re.compile(pattern), kind) for pattern, kind in kinds]
+
+def error_kind(message: str, default: str = None) -> str:
+	for pattern, kind in kinds:
+		if pattern.match(message): return kind
+	if default is not None: return default
+	# e.g. "heap-use-after-free on address ..." or "SEGV on unknown address ..."
+	return re.match(r'[\w-]*', message).group(0) or 'unknown'
+
+def parse(stderr: str, max_findings: int = 32, max_frames: int = 16) -> list:
+	""" Sanitizer reports in a program's stderr as a list of findings:
+	    {'sanitizer', 'kind', 'access' (READ/WRITE or None), 'size' (bytes or None),
+	     'location' ('program.cpp:6' or None), 'frames': [{'function', 'file', 'line'}], 'message'}.
+	    Only the first stack trace of a report is kept, i.e. where the error happened
+	    (or, for leaks, where the memory was allocated). """
+	findings = []
+	current = None
+	stack = None  # the frames of `current` while its first stack trace is being read
+	def start(**finding):
+		nonlocal current, stack
+		current = dict({'access': None, 'size': None, 'location': None, 'frames': []}, **finding)
+		stack = current['frames']
+		findings.append(current)
+	for line in ansi_re.sub('', stderr or '').splitlines():
+		if len(findings) >= max_findings and stack is None: break
+		mm = header_re.search(line)
+		if mm is not None:
+			sanitizer, message = mm.group(1).lower().replace('undefinedbehavior', 'undefined'), mm.group(2).strip()
+			kind = error_kind(message)
+			# a leak report lists every leak on its own
+			if kind == 'memory-leak': current = stack = None
+			else: start(sanitizer=sanitizer, kind=kind, message=line[mm.start():].strip())
+			continue
+		mm = leak_re.match(line)
+		if mm is not None:
+			start(sanitizer='leak', kind='memory-leak', size=int(mm.group(2)), message=line.strip())
+			continue
+		mm = ubsan_re.match(line)
+		if mm is not None:
+			start(sanitizer='undefined', kind=error_kind(mm.group(3), default='undefined-behavior'),
+				  location=f'{mm.group(1)}:{mm.group(2)}', message=f'runtime error: {mm.group(3)}')
+			if mm.group(3).startswith('load of'): current['access'] = 'READ'
+			elif mm.group(3).startswith('store to'): current['access'] = 'WRITE'
+			continue
+		if current is None: continue
+		mm = frame_re.match(line)
+		if mm is not None:
+			if stack is not None and mm.group(2) is not None and len(stack) < max_frames:
+				stack.append({'function': mm.group(2), 'file': mm.group(4),
+							  'line': int(mm.group(5)) if mm.group(5) is not None else None})
+			continue
+		if stack is not None and len(stack) > 0:
+			stack = None
+		if current['access'] is None:
+			mm = access_re.search(line) or signal_access_re.search(line)
+			if mm is not None:
+				current['access'] = mm.group(1).upper()
+				if mm.re is access_re: current['size'] = int(mm.group(2))
+	for finding in findings:
+		if finding['location'] is None:
+			# the first frame in code that is not part of the sanitizer runtime
+			for frame in finding['frames']:
+				if frame['file'] is not None and 'sanitizer' not in frame['file']:
+					finding['location'] = f"{frame['file']}:{frame['line']}"
+					break
+	return findings[:max_findings]
+
+def run_findings(run: dict) -> list:
+	""" findings of a stored run, parsing older runs that were saved without them """
+	rr = run.get('run') or {}
+	if 'findings' in rr: return rr['findings']
+	return parse(rr.get('stderr', ''))
+
+def configurations(run: dict):
+	""" (compiler, flags label, findings) of a stored run and, for a comparison, of all of its configurations """
+	configs = {(run['compiler'], flag_label(run['flags'])): run_findings(run)}
+	for row in run.get('compare', []):
+		configs.setdefault((row['compiler'], flag_label(row['flags'])), row.get('findings', []))
+	for (compiler, flags), findings in configs.items():
+		yield compiler, flags, findings
+
+def matches(key, part=None, step=None, compiler=None, flags=None, kind=None) -> bool:
+	return all(value is None or value == kk for kk, value in zip(key, [part, step, compiler, flags, kind]))
+
+class FindingsIndex:
+	""" The findings of every student's latest run of each step by (part, step, compiler, flags, kind).
+	    Every configuration that was run is also recorded under the kind '' so that
+	    summaries can tell how many students tried it. """
+	def __init__(self):
+		self.entries = {}  # (part, step, compiler, flags, kind) -> {uid: [findings]}
+		self.keys = {}     # (uid, part, step) -> keys with an entry for the student
+		self.lock = threading.Lock()
+
+	def put(self, uid: str, part: str, step: str, run: dict):
+		with self.lock:
+			for key in self.keys.pop((uid, part, step), []):
+				del self.entries[key][uid]
+				if len(self.entries[key]) == 0: del self.entries[key]
+			keys = self.keys[(uid, part, step)] = []
+			for compiler, flags, findings in configurations(run):
+				for finding in [None] + findings:
+					key = (part, step, compiler, flags, '' if finding is None else finding['kind'])
+					if key not in keys: keys.append(key)
+					found = self.entries.setdefault(key, {}).setdefault(uid, [])
+					if finding is not None: found.append(finding)
+
+	def query(self, part=None, step=None, compiler=None, flags=None, kind=None, limit: int = 1000) -> list:
+		rows = []
+		with self.lock:
+			for key, students in sorted(self.entries.items()):
+				if key[4] == '' or not matches(key, part, step, compiler, flags, kind): continue
+				for uid, findings in sorted(students.items()):
+					for finding in findings:
+						if len(rows) >= limit: return rows
+						rows.append(dict(finding, uid=uid, part=key[0], step=key[1], compiler=key[2], flags=key[3]))
+		return rows
+
+	def summary(self, part=None, step=None) -> list:
+		""" number of students per (part, step, compiler, flags, kind) """
+		with self.lock:
+			return [{'part': key[0], 'step': key[1], 'compiler': key[2], 'flags': key[3], 'kind': key[4], 'students': len(students)}
+					for key, students in sorted(self.entries.items()) if matches(key, part, step)]
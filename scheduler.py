@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import os, threading, time, contextvars
+from collections import deque, OrderedDict
+
+class QueueFull(Exception):
+	def __init__(self, retry_after: int):
+		super().__init__(f"queue full, retry in {retry_after}s")
+		self.retry_after = retry_after
+
+class Job:
+	def __init__(self, student: str, fn, group=None, background: bool = False):
+		self.student = student
+		self.fn = fn
+		self.group = group  # jobs of one group share a single per-student slot
+		self.background = background
+		# run in the submitter's context, e.g. to attribute timings to its request
+		self.context = contextvars.copy_context()
+		self.submitted = time.monotonic()
+		self.started = None
+		self.result = None
+		self.error = None
+		self.done = threading.Event()
+
+	def wait(self):
+		self.done.wait()
+		if self.error is not None: raise self.error
+		return self.result
+
+class Scheduler:
+	""" Runs compile/run jobs on a fixed number of worker threads.
+	    Jobs are queued per student and dispatched round-robin across students,
+	    while each student can only have `per_student` jobs running at once
+	    (a group of jobs submitted together counts as one). Background jobs (e.g. prewarming)
+	    only start when no student's job could. """
+	def __init__(self, workers: int = None, max_queue: int = 256, per_student: int = 1):
+		self.workers = workers or os.cpu_count() or 1
+		self.max_queue = max_queue
+		self.per_student = per_student
+		self.queues = OrderedDict()  # student -> deque of jobs, in round-robin order
+		self.running = {}            # student -> number of running jobs (or groups)
+		self.groups = {}             # group -> number of its jobs that are running
+		self.depth = 0
+		self.active = 0
+		self.completed = 0
+		self.waits = deque(maxlen=1000)  # recent queue wait times in seconds
+		self.cond = threading.Condition()
+		self.threads = [threading.Thread(target=self._work, name=f'scheduler{ii}', daemon=True)
+						for ii in range(self.workers)]
+		for tt in self.threads: tt.start()
+
+	def submit(self, student: str, fn, background: bool = False) -> Job:
+		job = Job(student, fn, background=background)
+		with self.cond:
+			if self.depth >= self.max_queue:
+				raise QueueFull(self.retry_after())
+			self.queues.setdefault(student, deque()).append(job)
+			self.depth += 1
+			self.cond.notify()
+		return job
+
+	def submit_group(self, student: str, fns) -> list:
+		""" jobs that may run in parallel on different workers, e.g. several builds of one request """
+		group = object()
+		jobs = [Job(student, fn, group) for fn in fns]
+		with self.cond:
+			if self.depth + len(jobs) > self.max_queue:
+				raise QueueFull(self.retry_after())
+			self.queues.setdefault(student, deque()).extend(jobs)
+			self.depth += len(jobs)
+			self.cond.notify_all()
+		return jobs
+
+	def run(self, student: str, fn):
+		return self.submit(student, fn).wait()
+
+	def retry_after(self) -> int:
+		# rough estimate: time until the queue in front of a new job has drained
+		waits = list(self.waits)
+		avg = sum(waits) / len(waits) if len(waits) > 0 else 1.0
+		return max(1, int(avg * self.depth / self.workers) + 1)
+
+	def _next_job(self):
+		# round-robin: take the first student that may run another job and move them to the back
+		for background in (False, True):
+			for student, queue in self.queues.items():
+				if queue[0].background != background: continue
+				if self.running.get(student, 0) < self.per_student or queue[0].group in self.groups:
+					job = queue.popleft()
+					del self.queues[student]
+					if len(queue) > 0: self.queues[student] = queue
+					return job
+		return None
+
+	def _work(self):
+		while True:
+			with self.cond:
+				job = self._next_job()
+				while job is None:
+					self.cond.wait()
+					job = self._next_job()
+				self.depth -= 1
+				self.active += 1
+				if job.group not in self.groups:
+					self.running[job.student] = self.running.get(job.student, 0) + 1
+				if job.group is not None:
+					self.groups[job.group] = self.groups.get(job.group, 0) + 1
+				job.started = time.monotonic()
+				self.waits.append(job.started - job.submitted)
+			try:
+				job.result = job.context.run(job.fn)
+			except BaseException as ee:
+				# even SystemExit or KeyboardInterrupt is the submitter's to handle, the worker goes on
+				job.error = ee
+			finally:
+				with self.cond:
+					self.active -= 1
+					self.completed += 1
+					if job.group is not None:
+						self.groups[job.group] -= 1
+						if self.groups[job.group] == 0: del self.groups[job.group]
+					if job.group not in self.groups:
+						self.running[job.student] -= 1
+						if self.running[job.student] == 0: del self.running[job.student]
+					# a student that was capped may be able to run again
+					self.cond.notify_all()
+				job.done.set()
+
+	def stats(self) -> dict:
+		with self.cond:
+			waits = sorted(self.waits)
+			return {
+				'workers': self.workers, 'depth': self.depth, 'active': self.active,
+				'completed': self.completed, 'students_waiting': len(self.queues),
+				'wait_avg': sum(waits) / len(waits) if len(waits) > 0 else 0.0,
+				'wait_max': waits[-1] if len(waits) > 0 else 0.0,
+			}
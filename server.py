@@ -3,15 +3,36 @@
 
 # Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
 
-import json, os, sys, urllib
+import json, os, sys, urllib, gzip, shlex, hmac
 import http.server
 from urllib.parse import urlparse
 from typing import List, Optional
 from functools import reduce, total_ordering
-import operator
+import operator, threading, signal, time, traceback
+from collections import OrderedDict
 from jinja2 import Template
 from compiler import Compiler
-from ansi2html import Ansi2HTMLConverter
+from executor import Executor
+from worker import Workers
+from scheduler import Scheduler, QueueFull
+from jobs import RunJob, JobStore, Latest
+from prewarm import Prewarm
+from store import Store, JsonStore
+from viewcache import AnsiToHtml, ViewCache
+from static import StaticFiles
+from metrics import metrics, current_request, flag_label
+import export
+
+def admin_token():
+	""" the instructors' token from CPPUNIT_ADMIN_TOKEN, without it the admin endpoints are disabled """
+	return os.environ.get('CPPUNIT_ADMIN_TOKEN') or None
+
+def is_admin(token, authorization: str) -> bool:
+	""" whether the request's `Authorization: Bearer <token>` header holds the admin token; students
+	    reach the server through a reverse proxy on the same machine, so the peer address says nothing """
+	if token is None or authorization is None: return False
+	scheme, _, given = authorization.strip().partition(' ')
+	return scheme.lower() == 'bearer' and hmac.compare_digest(given.strip().encode('utf-8'), token.encode('utf-8'))
 
 def assert_uids(items):
 	uids = {s.uid for s in items}
@@ -77,37 +98,56 @@ class Part:
 		if next_pos >= self.step_count: return None
 		return self.pos_to_step[next_pos]
 
-def load_step_specific_data(data):
-	return {tuple(entry[0]): entry[1] for entry in data}
-def save_step_specific_data(data):
-	return [(key,value) for key,value in data.items()]
-
 class Student:
-	def __init__(self, uid, progress, answers, runs):
+	__slots__ = ['uid', 'progress', 'answers', 'runs', 'version']
+	def __init__(self, uid, progress, answers, runs, version=None):
 		assert isinstance(progress, int)
 		self.uid = uid
 		self.progress = progress
 		self.answers = answers
 		self.runs = runs
-	@staticmethod
-	def load(filename: str, start):
-		assert filename.endswith('.json')
-		expected_uid = os.path.basename(filename)[:-len('.json')]
-		with open(filename) as ff:
-			dd = json.load(ff)
-		assert dd['uid'] == expected_uid, f"{dd['uid']} != {expected_uid}"
-		if dd['progress'] is None: dd['progress'] = start
-		dd['answers'] = load_step_specific_data(dd.get('answers', []))
-		dd['runs'] = load_step_specific_data(dd.get('runs', []))
-		return Student(**dd)
-	def save(self, student_dir: str):
-		assert os.path.isdir(student_dir)
-		filename = os.path.join(student_dir, self.uid + ".json")
-		answers = save_step_specific_data(self.answers)
-		runs = save_step_specific_data(self.runs)
-		dd = {'uid': self.uid, 'progress': self.progress, 'answers': answers, 'runs': runs}
-		with open(filename, 'w') as ff:
-			json.dump(dd, ff, indent=2)
+		self.version = version  # of the student's data in the store when it was loaded
+
+class Students:
+	""" All known students by uid. Only the ids are read at startup, a student's data is
+	    loaded from the store when it is first needed and up to `max_loaded` students are
+	    kept in memory. With a shared store, students changed by another process are reloaded. """
+	def __init__(self, store: Store, start_progress: int, max_loaded: int = 1024):
+		self.store = store
+		self.start_progress = start_progress
+		self.max_loaded = max_loaded
+		self.ids = set(store.ids())
+		self.loaded = OrderedDict()
+		self.lock = threading.Lock()
+	def __contains__(self, uid):
+		return uid in self.ids
+	def __len__(self):
+		return len(self.ids)
+	def __iter__(self):
+		return iter(self.ids)
+	def __getitem__(self, uid) -> Student:
+		with self.lock:
+			stud = self.loaded.get(uid)
+			if stud is not None: self.loaded.move_to_end(uid)
+		if stud is not None and not (self.store.shared and self.store.version(uid) != stud.version):
+			return stud
+		if uid not in self.ids: raise KeyError(uid)
+		# queued writes need to be on disk before we can read the student back
+		self.store.wait(uid)
+		# read the version first: a write that happens while loading leads to another reload
+		version = self.store.version(uid)
+		dd = self.store.load(uid)
+		if dd['progress'] is None: dd['progress'] = self.start_progress
+		fresh = Student(**dd, version=version)
+		with self.lock:
+			# another thread might have loaded the student in the meantime
+			current = self.loaded.get(uid)
+			stud = fresh if current is None or current is stud else current
+			self.loaded[uid] = stud
+			self.loaded.move_to_end(uid)
+			while len(self.loaded) > self.max_loaded:
+				self.loaded.popitem(last=False)
+		return stud
 
 class Error:
 	def __init__(self, msg):
@@ -115,8 +155,9 @@ class Error:
 	def __str__(self):
 		return f"Error({self.msg})"
 class Success:
-	def __init__(self, dat):
+	def __init__(self, dat, content_type=None):
 		self.dat = dat
+		self.content_type = content_type
 	def __str__(self):
 		return f"Success({self.dat})"
 class Redirect:
@@ -124,6 +165,22 @@ class Redirect:
 		self.path = path
 	def __str__(self):
 		return f"Redirect({self.path})"
+class Stream:
+	def __init__(self, chunks, content_type='text/event-stream'):
+		self.chunks = chunks
+		self.content_type = content_type
+	def __str__(self):
+		return "Stream()"
+class Static:
+	def __init__(self, asset):
+		self.asset = asset
+	def __str__(self):
+		return f"Static({self.asset.filename})"
+class Busy:
+	def __init__(self, retry_after):
+		self.retry_after = retry_after
+	def __str__(self):
+		return f"Busy({self.retry_after})"
 
 def is_error(e): return isinstance(e, Error)
 def is_redirect(e): return isinstance(e, Redirect)
@@ -162,14 +219,35 @@ def selected_flags(rr):
 	#print(dd)
 	return dd
 
+# a comparison builds and runs at most this many configurations
+max_compare = 16
+# limits on the input of a program that is run again
+max_args = 32
+max_stdin = 64 * 1024
+
+def check_response(rr) -> 'Success':
+	""" a check result as JSON, None if a newer check of the same student replaced it """
+	return Success(json.dumps(rr if rr is not None else {'superseded': True}), content_type='application/json')
+
+def compare_row(compiler, flags, rr, seconds, max_output: int = 2048) -> dict:
+	""" one line of the side-by-side comparison table """
+	cc, run = rr['compile'], rr['run']
+	stdout = run.get('stdout', '')
+	if len(stdout) > max_output: stdout = stdout[:max_output] + '\n...'
+	return {'compiler': compiler, 'flags': flags, 'compile': cc['ret'], 'run': run.get('ret'),
+			'limit': run.get('limit'), 'error': export.first_error(cc['stderr'], run.get('stderr')),
+			'stdout': stdout, 'seconds': round(seconds, 3), 'findings': run.get('findings', [])}
+
 class App:
-	def __init__(self, parts: List[Part], student_dir, compiler_dir):
+	def __init__(self, parts: List[Part], student_dir, compiler_dir, store: Optional[Store] = None, executors: int = 0,
+				 compile_workers: Optional[List[str]] = None, processes: int = 1):
 		assert_uids(parts)
 		self.part_to_pos = {p: ii for ii, p in enumerate(parts)}
 		self.pos_to_part = parts
 		self.part_count = len(parts)
 		self.parts = {p.uid: p for p in parts}
 		self.students = {}
+		self.answers_loaded = {}  # step id -> store.step_version when the answers were loaded
 		# make uids comparable
 		uids = reduce(operator.add, ([(p.uid, s.uid) for s in p.steps.values()] for p in parts))
 		self.start = uids[0]
@@ -177,14 +255,31 @@ class App:
 		print(self.uid_progress)
 		self.app_html: Optional[Template] = None
 		# command list
-		self.cmds = {'next': self.next, 'answer': self.answer, 'run': self.run}
+		self.cmds = {'next': self.next, 'answer': self.answer, 'run': self.run, 'start': self.run_async,
+					 'compare': self.compare, 'rerun': self.rerun, 'check': self.check}
 		# student directory
 		assert os.path.isdir(student_dir)
 		self.student_dir = student_dir
+		self.store = store
 		# compiler
-		self.comp = Compiler(working_dir=compiler_dir)
+		# with `executors` > 0 compilers and programs are started by that many helper processes
+		# `compile_workers` (HOST:PORT of worker.py daemons) compile and run everything instead
+		workers = Workers(compile_workers) if compile_workers else None
+		self.comp = Compiler(working_dir=compiler_dir, executor=Executor(executors) if executors > 0 else None, workers=workers)
+		# `processes` server processes (see `serve_workers`) share the cores or compile workers
+		capacity = workers.capacity() if workers is not None else os.cpu_count() or 1
+		self.scheduler = Scheduler(workers=max(1, capacity // processes))
+		self.jobs = JobStore()
+		# needed for the endpoints that show data of all students or server internals (export, findings, status, metrics)
+		self.admin_token = admin_token()
+		# syntax checks bypass the scheduler, they are short and only the newest one of a student matters
+		self.checking = Latest()
+		self.check_slots = threading.Semaphore(self.scheduler.workers)
+		self.prewarmer = None
 		# converter
-		self.conv = Ansi2HTMLConverter()
+		self.conv = AnsiToHtml()
+		self.views = ViewCache()
+		metrics.collect(self.collect_metrics)
 
 	# load
 
@@ -193,16 +288,28 @@ class App:
 		with open(app_html) as ff:
 			self.app_html = Template(ff.read())
 
-	def load_students(self, student_dir):
-		assert os.path.isdir(student_dir)
+	def load_students(self, student_dir, max_loaded: int = 1024):
 		assert len(self.students) == 0, "cannot load students twice!"
-		_, _, files = next(os.walk(student_dir))
-		for filename in files:
-			if filename.endswith('.json'):
-				stud = Student.load(os.path.join(student_dir, filename), self.start)
-				self.students[stud.uid] = stud
-				for (part, step), answer in stud.answers.items():
-					self.parts[part].steps[step].answers[stud.uid] = answer
+		if self.store is None:
+			self.store = JsonStore(student_dir)
+		self.store.hold()
+		self.students = Students(self.store, self.uid_progress[self.start], max_loaded=max_loaded)
+
+	def load_answers(self, part, step):
+		""" QuestionSteps show everybody's answers, which are only loaded once somebody gets there
+		    (and again whenever another process changed them) """
+		if not isinstance(step, QuestionStep): return
+		step_id = (part.uid, step.uid)
+		version = self.store.step_version(step_id) if self.store.shared else None
+		if step_id in self.answers_loaded and self.answers_loaded[step_id] == version: return
+		answers = self.store.step_answers(step_id)
+		if step_id in self.answers_loaded:
+			step.answers.update(answers)
+			self.views.bump(step_id)
+		else:
+			# answers given since we started loading are newer
+			for uid, text in answers.items(): step.answers.setdefault(uid, text)
+		self.answers_loaded[step_id] = version
 
 	# run
 
@@ -229,7 +336,7 @@ class App:
 		if len(ret) == 0: return ret
 		#print(f"ret2html({ret})")
 		def escape(out):
-			return self.conv.convert(out, full=False)
+			return self.conv.convert(out)
 		return {
 			'ret': ret['ret'],
 			'stdout': escape(ret['stdout']),
@@ -241,6 +348,12 @@ class App:
 		rr = dict(run)
 		rr['compile'] = self.ret2html(run['compile'])
 		rr['run'] = self.ret2html(run['run'])
+		if 'compare' in run:
+			rr['compare'] = [dict(row, stdout=self.conv.convert(row['stdout'])) for row in run['compare']]
+		if 'input' in run:
+			inputs = run['input']
+			rr['input'] = {'args': shlex.join(inputs['args']), 'stdin': inputs['stdin'] or '',
+						   'options': ' '.join(f'{env}={value}' for env, value in inputs['options'].items())}
 		return rr
 
 
@@ -249,6 +362,13 @@ class App:
 		if is_error(ret): return ret
 		else: student, part, step = ret.dat
 		rr = student.runs.get((part.uid, step.uid), None)
+		self.load_answers(part, step)
+		# unless a student has run or answered something, the page is the same for everybody
+		personal = rr is not None or (part.uid, step.uid) in student.answers
+		key = (student_id if personal else None, part.uid, step.uid)
+		version = (self.views.version(key), self.views.version((part.uid, step.uid)), student.version if personal else None)
+		page = self.views.get(key, version)
+		if page is not None: return Success(page)
 		dd = {'student_id': student_id,
 			  'part': part.to_dict(),
 			  'step': step.to_dict(),
@@ -256,7 +376,10 @@ class App:
 			  'flags': selected_flags(rr),
 			  'version': self.comp.versions,
 			  }
-		return Success(self.app_html.render(dd))
+		with metrics.timed('render'):
+			page = self.app_html.render(dd)
+		self.views.put(key, version, page)
+		return Success(page)
 
 	def exec(self, cmd, student_id, path_list, content):
 		ret = self.parse_student_path(student_id, path_list)
@@ -264,21 +387,236 @@ class App:
 		if cmd not in self.cmds: return Error(f"unknown command: {cmd}")
 		return self.cmds[cmd](*ret.dat, content)
 
-	def run(self, student, part, step, content):
+	def run_args(self, part, step, content):
 		can_run = isinstance(step, RunStep) or isinstance(step, ModifyStep)
 		if not can_run: return Error("cannot run in this step")
 		if isinstance(step, RunStep): main_src = part.program
 		else:                         main_src = content['code'][0]
 		compiler = content['compiler'][0]
 		flags = content.get('flag', [])
-		rr = self.comp.compile_and_run(compiler=compiler, flags=flags, source=main_src)
-		if rr is None: return Error(f'Invalid compile and run command: {content}')
+		return Success((compiler, flags, main_src))
+
+	def compare_args(self, part, step, content):
+		""" every combination of the selected compilers, optimization levels and sanitizers,
+		    each with the common flags (-g, -Wall) """
+		if not isinstance(step, (RunStep, ModifyStep)): return Error("cannot run in this step")
+		main_src = part.program if isinstance(step, RunStep) else content['code'][0]
+		common = content.get('flag', [])
+		configs = []
+		for compiler in content.get('compiler', []):
+			for opt in content.get('opt', []) or [None]:
+				for sanitize in content.get('sanitize', []) or [None]:
+					flags = [ff for ff in [opt, sanitize] if ff is not None] + common
+					if (compiler, flags) not in configs: configs.append((compiler, flags))
+		if len(configs) == 0: return Error("select at least one compiler to compare")
+		if len(configs) > max_compare: return Error(f"cannot compare more than {max_compare} configurations at once")
+		for compiler, flags in configs:
+			if not self.comp.check_args(compiler, flags): return Error(f"invalid configuration: {compiler} {flags}")
+		return Success((configs, main_src))
+
+	def rerun_args(self, student, part, step, content):
+		""" the step's last build and the arguments, stdin and sanitizer options to run it with """
+		rr = student.runs.get((part.uid, step.uid), None)
+		if rr is None: return Error("nothing to run again, compile the program first")
+		arg = lambda name: content.get(name, [''])[0]
+		try:
+			args = shlex.split(arg('args'))
+		except ValueError as ee:
+			return Error(f"invalid arguments: {ee}")
+		stdin = arg('stdin').replace('\r\n', '\n')
+		if len(args) > max_args or len(stdin) > max_stdin: return Error("too many arguments or too much input")
+		options = self.comp.parse_options(arg('options'))
+		if options is None: return Error(f"invalid sanitizer options: {arg('options')}")
+		inputs = {'args': args, 'stdin': stdin if len(stdin) > 0 else None, 'options': options}
+		return Success((rr['compiler'], rr['flags'], rr['source'], inputs))
+
+	def compile_and_run(self, student, part, step, compiler, flags, main_src, on_line=None):
+		rr = self.comp.compile_and_run(compiler=compiler, flags=flags, source=main_src, on_line=on_line)
+		if rr is None: return None
+		return self.record_run(student, part, step, compiler, flags, main_src, rr)
+
+	def record_run(self, student, part, step, compiler, flags, main_src, rr):
 		rr.update({'flags': flags, 'source': main_src, 'compiler': compiler})
+		# a long job may outlive the student's place in `students`: record on the current object
+		student = self.students[student.uid]
 		step_id = (part.uid, step.uid)
 		student.runs[step_id] = rr
-		student.save(self.student_dir)
+		self.store.save_run(student, step_id)
+		# convert the output to HTML now, while it is likely to be viewed next
+		self.run2html(rr)
+		self.views.bump((student.uid, part.uid, step.uid))
+		return rr
+
+	def run(self, student, part, step, content):
+		ret = self.run_args(part, step, content)
+		if is_error(ret): return ret
+		compiler, flags, main_src = ret.dat
+		try:
+			rr = self.scheduler.run(student.uid, lambda: self.compile_and_run(student, part, step, compiler, flags, main_src))
+		except QueueFull as ee:
+			return Busy(ee.retry_after)
+		if rr is None: return Error(f'Invalid compile and run command: {content}')
+		return Redirect('/'.join(['', student.uid, part.uid, step.uid]))
+
+	def rerun(self, student, part, step, content):
+		""" runs the binary of the step's last build again with other inputs, without recompiling it """
+		ret = self.rerun_args(student, part, step, content)
+		if is_error(ret): return ret
+		compiler, flags, main_src, inputs = ret.dat
+		try:
+			rr = self.scheduler.run(student.uid, lambda: self.comp.rerun(compiler, flags, main_src, **inputs))
+		except QueueFull as ee:
+			return Busy(ee.retry_after)
+		if rr is None: return Error(f'Invalid run command: {content}')
+		self.record_run(student, part, step, compiler, flags, main_src, dict(rr, input=inputs))
+		return Redirect('/'.join(['', student.uid, part.uid, step.uid]))
+
+	# a check that has not started after this many seconds is dropped if the student edited the code again
+	check_delay = 0.2
+
+	def check_args(self, part, step, content):
+		""" only the code of a ModifyStep changes while the student edits it """
+		if not isinstance(step, ModifyStep): return Error("nothing to check in this step")
+		ret = self.run_args(part, step, content)
+		if is_error(ret): return ret
+		compiler, flags, _ = ret.dat
+		if not self.comp.check_args(compiler, flags): return Error(f'Invalid check command: {content}')
+		return ret
+
+	def check(self, student, part, step, content):
+		""" errors and warnings of the code in the editor from the compiler front end, see `Compiler.check`;
+		    nothing is stored and the view does not change """
+		ret = self.check_args(part, step, content)
+		if is_error(ret): return ret
+		compiler, flags, source = ret.dat
+		rr = self.comp.cached_check(compiler, flags, source)
+		if rr is not None: return check_response(rr)
+		number = self.checking.start(student.uid)
+		try:
+			time.sleep(self.check_delay)
+			while not self.checking.superseded(student.uid, number):
+				if self.check_slots.acquire(timeout=0.05): break
+			else:
+				return check_response(None)
+			try:
+				rr = self.comp.check(compiler, flags, source)
+			finally:
+				self.check_slots.release()
+		finally:
+			self.checking.finish(student.uid, number)
+		return check_response(rr)
+
+	def compare(self, student, part, step, content):
+		""" builds and runs several configurations in parallel and stores them as one side-by-side table """
+		ret = self.compare_args(part, step, content)
+		if is_error(ret): return ret
+		configs, main_src = ret.dat
+		def build(compiler, flags):
+			start = time.perf_counter()
+			rr = self.comp.compile_and_run(compiler=compiler, flags=flags, source=main_src)
+			return rr, time.perf_counter() - start
+		try:
+			jobs = self.scheduler.submit_group(student.uid, [lambda cc=cc, ff=ff: build(cc, ff) for cc, ff in configs])
+		except QueueFull as ee:
+			return Busy(ee.retry_after)
+		self.record_compare(student, part, step, configs, main_src, [job.wait() for job in jobs])
 		return Redirect('/'.join(['', student.uid, part.uid, step.uid]))
 
+	def record_compare(self, student, part, step, configs, main_src, results):
+		""" the table is saved as the step's run, whose output is that of the first configuration """
+		rows = [compare_row(compiler, flags, rr, seconds) for (compiler, flags), (rr, seconds) in zip(configs, results)]
+		compiler, flags = configs[0]
+		rr = dict(results[0][0], compare=rows)
+		return self.record_run(student, part, step, compiler, flags, main_src, rr)
+
+	def run_async(self, student, part, step, content):
+		""" asynchronous version of `run`: returns a job id whose output can be followed with `stream` """
+		ret = self.run_args(part, step, content)
+		if is_error(ret): return ret
+		compiler, flags, main_src = ret.dat
+		job = RunJob(student.uid, part.uid, step.uid)
+		def work():
+			try:
+				rr = self.compile_and_run(student, part, step, compiler, flags, main_src, on_line=job.on_line)
+				job.finish('ok' if rr is not None else 'invalid')
+			except Exception:
+				job.finish('error')
+				raise
+		try:
+			self.scheduler.submit(student.uid, work)
+		except QueueFull as ee:
+			return Busy(ee.retry_after)
+		self.jobs.add(job)
+		url = '/'.join(['', student.uid, part.uid, step.uid, 'stream', job.uid])
+		return Success(json.dumps({'job': job.uid, 'stream': url}), content_type='application/json')
+
+	def stream(self, student_id, path_list, job_id):
+		ret = self.parse_student_path(student_id, path_list)
+		if is_error(ret): return ret
+		job = self.jobs.get(job_id)
+		if job is None or job.student != student_id: return Error(f"unknown job: {job_id}")
+		return Stream(job.sse())
+
+	def prewarm(self, flag_sets=None):
+		""" fill the compile cache for all RunStep programs in the background """
+		assert self.prewarmer is None, "already prewarming"
+		programs = [p.program for p in self.pos_to_part if any(isinstance(s, RunStep) for s in p.pos_to_step)]
+		self.prewarmer = Prewarm(self.comp, self.scheduler, programs, flag_sets=flag_sets)
+		print(f"prewarm: compiling {len(self.prewarmer.todo)} configurations of {len(programs)} programs")
+		return self.prewarmer.start()
+
+	def status(self):
+		dd = {'scheduler': self.scheduler.stats(), 'cache': self.comp.cache.stats(), 'checks': self.comp.checks.stats(),
+			  'views': self.views.stats(), 'html': self.conv.cache.stats(), 'blobs': self.store.blobs.stats()}
+		if self.prewarmer is not None: dd['prewarm'] = self.prewarmer.stats()
+		if self.comp.executor is not None: dd['executor'] = self.comp.executor.stats()
+		if self.comp.workers is not None: dd['workers'] = self.comp.workers.stats()
+		return Success(json.dumps(dd), content_type='application/json')
+
+	def export(self, query: dict):
+		""" answers and run summaries as CSV or JSONL, see export.py """
+		arg = lambda name: query.get(name, [None])[0]
+		fmt = arg('format') or 'csv'
+		if fmt not in export.formats: return Error(f"unknown export format: {fmt}")
+		try:
+			since, until = export.parse_time(arg('since')), export.parse_time(arg('until'))
+		except ValueError as ee:
+			return Error(f"invalid time: {ee}")
+		content_type, _ = export.formats[fmt]
+		return Stream(export.export(self.store, fmt, part=arg('part'), step=arg('step'), since=since, until=until),
+					  content_type=content_type)
+
+	def findings(self, query: dict, summary: bool = False):
+		""" sanitizer findings as JSON, filtered by part, step, compiler, flags and kind;
+		    the summary counts students per configuration and kind """
+		arg = lambda name: query.get(name, [None])[0]
+		part, step = arg('part'), arg('step')
+		if summary:
+			return Success(json.dumps(self.store.findings_summary(part, step)), content_type='application/json')
+		flags = arg('flags')
+		try:
+			limit = int(arg('limit') or 1000)
+		except ValueError:
+			return Error(f"invalid limit: {arg('limit')}")
+		rows = self.store.findings(part, step, compiler=arg('compiler'), kind=arg('kind'), limit=limit,
+								   flags=None if flags is None else flag_label(flags.split()))
+		return Success(json.dumps(rows), content_type='application/json')
+
+	def collect_metrics(self):
+		sched = self.scheduler.stats()
+		dd = [('queue_depth', 'gauge', {}, sched['depth']), ('jobs_running', 'gauge', {}, sched['active']),
+			  ('queue_wait_max_seconds', 'gauge', {}, sched['wait_max']),
+			  ('workspaces_bytes', 'gauge', {}, self.comp.workspaces.stats()['bytes'])]
+		for cache, stats in [('compile', self.comp.cache.stats()), ('check', self.comp.checks.stats()), ('view', self.views.stats()), ('ansi', self.conv.cache.stats())]:
+			dd += [('cache_hits_total', 'counter', {'cache': cache}, stats['hits']),
+				   ('cache_misses_total', 'counter', {'cache': cache}, stats['misses']),
+				   ('cache_entries', 'gauge', {'cache': cache}, stats['entries']),
+				   ('cache_bytes', 'gauge', {'cache': cache}, stats['bytes'])]
+		return dd
+
+	def metrics(self):
+		return Success(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 	def next_part(self, part):
 		next_pos = self.part_to_pos.get(part, self.part_count - 1) + 1
 		if next_pos >= self.part_count: return None
@@ -294,7 +632,9 @@ class App:
 			next_step = next_part.pos_to_step[0]
 		else:
 			next_part = part
-		student.progress = self.uid_progress[(next_part.uid, next_step.uid)]
+		# going back and clicking next again must not take away later steps
+		student.progress = max(student.progress, self.uid_progress[(next_part.uid, next_step.uid)])
+		self.store.save_progress(student)
 		return Redirect('/'.join(['', student.uid, next_part.uid, next_step.uid]))
 
 
@@ -303,106 +643,264 @@ class App:
 		text = content['answer'][0]
 		step_id = (part.uid, step.uid)
 		student.answers[step_id] = text
-		student.save(self.student_dir)
+		self.store.save_answer(student, step_id)
 		step.answers[student.uid] = text
+		self.views.bump((student.uid, part.uid, step.uid))
+		self.views.bump(step_id)
 		return Redirect('/'.join(['', student.uid, part.uid, step.uid]))
 
+def route_GET(server, app, pp, path, admin=False):
+	# get requests are only used for loading views and static content
+	url = urllib.parse.urlsplit(path)
+	if url.path == '/export' and admin:
+		return app.export(urllib.parse.parse_qs(url.query))
+	if url.path in {'/findings', '/findings/summary'} and admin:
+		return app.findings(urllib.parse.parse_qs(url.query), summary=url.path.endswith('/summary'))
+	if len(pp) == 1 and pp[0] in app.students:
+		# if only the student id is given -> redirect to first view
+		return Redirect('/'.join([pp[0]] + list(app.start)))
+	if len(pp) == 3 and pp[0] in app.students:
+		# show view
+		student_id, p0, p1 = pp
+		return app.view(student_id, (p0, p1))
+	if len(pp) == 5 and pp[0] in app.students and pp[3] == 'stream':
+		return app.stream(pp[0], (pp[1], pp[2]), pp[4])
+	if pp == ['status'] and admin:
+		return app.status()
+	if pp == ['metrics'] and admin:
+		return app.metrics()
+	# static
+	asset = server.static.find(path)
+	if asset is not None:
+		return Static(asset)
+	return Error(f"unknown path: {path}")
+
+def endpoint(app, method, pp) -> str:
+	""" what kind of request this is, without the student id (used to label metrics) """
+	if method == 'POST':
+		return pp[3] if len(pp) == 4 and pp[3] in app.cmds else 'invalid'
+	if len(pp) == 3 and pp[0] in app.students: return 'view'
+	if len(pp) == 5 and pp[3] == 'stream': return 'stream'
+	if pp in (['status'], ['metrics']): return pp[0]
+	if len(pp) == 1 and pp[0].split('?')[0] == 'export': return 'export'
+	if pp[0].split('?')[0] == 'findings': return 'findings'
+	return 'static'
+
+def route_POST(app, pp, content):
+	if len(pp) != 4:
+		return Error(f'Invalid POST path: {pp}')
+	return app.exec(cmd=pp[3], student_id=pp[0], path_list=(pp[1],pp[2]), content=content)
+
+def parse_content(raw: bytes) -> dict:
+	raw_content = raw.decode('utf-8')
+	try:
+		return json.loads(raw_content)
+	except json.JSONDecodeError:
+		return urllib.parse.parse_qs(raw_content)
+		#content = {a:b for a,b in (line.split(" ") for line in raw_content.split('\n') if len(line) > 1)}
+
+def http_chunk(data: bytes) -> bytes:
+	""" one chunk of a `Transfer-Encoding: chunked` body """
+	return f'{len(data):x}\r\n'.encode('latin-1') + data + b'\r\n'
+
+def accepts_gzip(accept_encoding: str) -> bool:
+	return any(enc.split(';')[0].strip() == 'gzip' for enc in accept_encoding.split(','))
+
 class Handler(http.server.BaseHTTPRequestHandler):
+	# persistent connections; every response needs a Content-Length (or closes the connection)
+	protocol_version = 'HTTP/1.1'
+	# idle keep-alive connections are closed after this many seconds
+	timeout = 30
+	# headers and body are separate writes, do not let them wait for the delayed ack of the previous response
+	disable_nagle_algorithm = True
+	# dynamic responses smaller than this are not worth compressing
+	gzip_min_size = 1024
+
 	def handle_GET(self, app, pp):
-		# get requests are only used for loading views and static content
-		if len(pp) == 1 and pp[0] in app.students:
-			# if only the student id is given -> redirect to first view
-			return Redirect('/'.join([pp[0]] + list(app.start)))
-		if len(pp) == 3 and pp[0] in app.students:
-			# show view
-			student_id, p0, p1 = pp
-			return app.view(student_id, (p0, p1))
-		# static
-		pdir = os.path.dirname(self.path)
-		for suffix, lib_dir in self.server.lib_dirs.items():
-			if pdir.endswith(suffix):
-				filename = os.path.join(lib_dir, os.path.basename(self.path))
-				with open(filename) as ff:
-					return Success(ff.read())
-		return Error(f"unknown path: {self.path}")
+		return route_GET(self.server, app, pp, self.path, admin=is_admin(app.admin_token, self.headers.get('Authorization')))
 
 	def handle_POST(self, app, pp, content):
-		if len(pp) != 4:
-			return Error(f'Invalid POST path: {pp}')
-		return app.exec(cmd=pp[3], student_id=pp[0], path_list=(pp[1],pp[2]), content=content)
+		return route_POST(app, pp, content)
 
 	def do_GET(self):
-		resp = self.handle_GET(app=self.server.app, pp=self.path.split('/')[1:])
-		return self.do_response(resp)
+		pp = self.path.split('/')[1:]
+		with metrics.request('GET', endpoint(self.server.app, 'GET', pp), self.path):
+			resp = self.handle_GET(app=self.server.app, pp=pp)
+			return self.do_response(resp)
+
+	def log_request(self, code='-', size='-'):
+		request = current_request.get()
+		if request is not None: request['status'] = int(code)
+		super().log_request(code, size)
 
 	def parse_POST(self):
 		if not 'Content-Length' in self.headers:
+			# we cannot tell where the next request would start
+			self.close_connection = True
 			return Error("No Content Length")
 		try:
-			length = int(self.headers['Content-Length'])
-			if length == 0:
-				content = {}
-			else:
-				raw_content = self.rfile.read(length).decode('utf-8')
-				try:
-					content = json.loads(raw_content)
-				except json.JSONDecodeError:
-					content = urllib.parse.parse_qs(raw_content)
-					#print(raw_content)
-					#content = {a:b for a,b in (line.split(" ") for line in raw_content.split('\n') if len(line) > 1)}
+			with metrics.timed('parse_post'):
+				length = int(self.headers['Content-Length'])
+				content = parse_content(self.rfile.read(length)) if length > 0 else {}
 		except Exception as ee:
+			self.close_connection = True
 			return Error(str(ee))
 		#print("POST", content)
 		return self.handle_POST(app=self.server.app, pp=self.path.split('/')[1:], content=content)
 
 	def do_POST(self):
-		resp = self.parse_POST()
-		return self.do_response(resp)
+		pp = self.path.split('/')[1:]
+		with metrics.request('POST', endpoint(self.server.app, 'POST', pp), self.path):
+			resp = self.parse_POST()
+			return self.do_response(resp)
 
 	def do_response(self, resp):
 		if isinstance(resp, Error):
 			print(resp)
 			self.do_404()
 		elif isinstance(resp, Success):
-			self.do_200(resp.dat)
+			self.do_200(resp.dat, resp.content_type)
+		elif isinstance(resp, Stream):
+			self.do_stream(resp)
+		elif isinstance(resp, Static):
+			self.do_static(resp.asset)
 		elif isinstance(resp, Redirect):
 			print(resp)
 			self.do_303(resp.path)
+		elif isinstance(resp, Busy):
+			print(resp)
+			self.do_503(resp.retry_after)
 		else:
 			assert False, f"Invalid response: {resp}"
 
+	def send_body(self, body: bytes, content_type=None, compress=False):
+		""" finishes the headers and sends a body of known length, gzip compressed if the client supports it """
+		if content_type is not None:
+			self.send_header('Content-Type', content_type)
+		if compress:
+			self.send_header('Vary', 'Accept-Encoding')
+			if len(body) >= self.gzip_min_size and self.accepts_gzip():
+				body = gzip.compress(body, compresslevel=5)
+				self.send_header('Content-Encoding', 'gzip')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
 	def do_404(self):
 		self.send_response(404)
-		self.end_headers()
-		self.wfile.write(self.server.html_404)
+		self.send_body(self.server.html_404, 'text/html; charset=utf-8')
 
-	def do_200(self, response):
+	def do_200(self, response, content_type=None):
 		assert isinstance(response, str), response
 		self.send_response(200)
+		self.send_body(response.encode('utf8'), content_type or 'text/html; charset=utf-8', compress=True)
+
+	def accepts_gzip(self) -> bool:
+		return accepts_gzip(self.headers.get('Accept-Encoding', ''))
+
+	def do_static(self, asset):
+		use_gzip = asset.gzip is not None and self.accepts_gzip()
+		not_modified = asset.not_modified(self.headers)
+		if not_modified:
+			self.send_response(304)
+		else:
+			self.send_response(200)
+			self.send_header('Content-Type', asset.content_type)
+			self.send_header('Content-Length', str(len(asset.gzip if use_gzip else asset.data)))
+			if use_gzip: self.send_header('Content-Encoding', 'gzip')
+		self.send_header('ETag', asset.gzip_etag if use_gzip else asset.etag)
+		self.send_header('Last-Modified', asset.last_modified)
+		self.send_header('Cache-Control', self.server.static.cache_control())
+		self.send_header('Vary', 'Accept-Encoding')
+		self.end_headers()
+		if not_modified: return
+		self.wfile.write(asset.gzip if use_gzip else asset.data)
+
+	def do_stream(self, resp):
+		# the length is not known in advance -> chunked transfer encoding, the connection stays usable
+		self.send_response(200)
+		self.send_header('Content-Type', resp.content_type)
+		self.send_header('Cache-Control', 'no-cache')
+		self.send_header('Transfer-Encoding', 'chunked')
 		self.end_headers()
-		self.wfile.write(response.encode('utf8'))
+		try:
+			for chunk in resp.chunks:
+				if len(chunk) == 0: continue  # an empty chunk would end the body
+				self.wfile.write(http_chunk(chunk))
+				self.wfile.flush()
+			self.wfile.write(b'0\r\n\r\n')
+			self.wfile.flush()
+		except (BrokenPipeError, ConnectionResetError):
+			self.close_connection = True
+
+	def do_503(self, retry_after):
+		self.send_response(503, 'Service Unavailable')
+		self.send_header('Retry-After', str(retry_after))
+		body = f"<html><body><h1>Server busy, please retry in {retry_after}s</h1></body></html>"
+		self.send_body(body.encode('utf8'), 'text/html; charset=utf-8')
 
 	def do_303(self, url):
 		self.send_response(303, 'See Other')
 		self.send_header('Location', url)
-		self.end_headers()
-		self.wfile.write(self.server.html_303)
-
-
+		self.send_body(self.server.html_303, 'text/html; charset=utf-8')
+
+
+
+def setup_server(serv, app, student_dir, lib_dirs, app_dir, prewarm=False, watch_static=False):
+	""" loads everything a server needs to answer requests (shared by `Server` and `aserver.AsyncServer`) """
+	assert isinstance(app, App)
+	assert os.path.isdir(app_dir)
+	assert all(os.path.isdir(os.path.join(app_dir, dd)) for dd in lib_dirs)
+	serv.app = app
+	serv.app.load_assets(app_html=os.path.join(app_dir, 'app.html'))
+	serv.app.load_students(student_dir=os.path.join(app_dir, student_dir))
+	serv.lib_dirs = {dd: os.path.join(app_dir, dd) for dd in lib_dirs}
+	serv.static = StaticFiles(serv.lib_dirs, watch=watch_static)
+	with open(os.path.join(app_dir, '404.html')) as ff:
+		serv.html_404 = ff.read().encode('utf8')
+	with open(os.path.join(app_dir, '303.html')) as ff:
+		serv.html_303 = ff.read().encode('utf8')
+	if prewarm: serv.app.prewarm()
 
 class Server(http.server.ThreadingHTTPServer):
-	def __init__(self, address, app, student_dir, lib_dirs, app_dir):
-		assert isinstance(app, App)
-		assert os.path.isdir(app_dir)
-		assert all(os.path.isdir(os.path.join(app_dir, dd)) for dd in lib_dirs)
-		self.app = app
-		self.app.load_assets(app_html=os.path.join(app_dir, 'app.html'))
-		self.app.load_students(student_dir=os.path.join(app_dir, student_dir))
-		self.lib_dirs = {dd: os.path.join(app_dir, dd) for dd in lib_dirs}
-		with open(os.path.join(app_dir, '404.html')) as ff:
-			self.html_404 = ff.read().encode('utf8')
-		with open(os.path.join(app_dir, '303.html')) as ff:
-			self.html_303 = ff.read().encode('utf8')
-
+	def __init__(self, address, app, student_dir, lib_dirs, app_dir, prewarm=False, watch_static=False, reuse_port=False):
+		setup_server(self, app, student_dir, lib_dirs, app_dir, prewarm=prewarm, watch_static=watch_static)
+		# several worker processes listening on the same port
+		self.allow_reuse_port = reuse_port
 		super().__init__(address, Handler)
 
+def serve_workers(workers: int, serve):
+	""" forks `workers` processes that each call `serve(worker)`, which is expected to listen on
+	    the same port with SO_REUSEPORT; workers that die are restarted """
+	children = {}  # pid -> (worker, start time)
+	def spawn(worker):
+		pid = os.fork()
+		if pid == 0:
+			signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+			code = 0
+			try:
+				serve(worker)
+			except (KeyboardInterrupt, SystemExit):
+				pass
+			except BaseException:
+				traceback.print_exc()
+				code = 1
+			sys.stdout.flush()
+			sys.stderr.flush()
+			os._exit(code)
+		children[pid] = (worker, time.monotonic())
+	for worker in range(workers): spawn(worker)
+	signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+	try:
+		while len(children) > 0:
+			pid, status = os.wait()
+			if pid not in children: continue
+			worker, started = children.pop(pid)
+			print(f"worker {worker} (pid {pid}) exited with status {status}, restarting")
+			# do not spin on a worker that fails right at startup
+			if time.monotonic() - started < 1.0: time.sleep(1.0)
+			spawn(worker)
+	finally:
+		for pid in children: os.kill(pid, signal.SIGTERM)
+		for pid in children: os.waitpid(pid, 0)
+
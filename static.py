@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import os, gzip, hashlib, mimetypes, threading
+from email.utils import formatdate, parsedate_to_datetime
+
+class Asset:
+	def __init__(self, filename: str):
+		self.filename = filename
+		self.mtime = os.path.getmtime(filename)
+		with open(filename, 'rb') as ff:
+			self.data = ff.read()
+		digest = hashlib.sha1(self.data).hexdigest()
+		# strong etags have to differ between the plain and the compressed representation
+		self.etag = f'"{digest}"'
+		self.gzip_etag = f'"{digest}-gz"'
+		self.last_modified = formatdate(self.mtime, usegmt=True)
+		content_type, _ = mimetypes.guess_type(filename)
+		content_type = content_type or 'application/octet-stream'
+		if content_type.startswith('text/') or content_type.endswith('javascript'):
+			content_type += '; charset=utf-8'
+		self.content_type = content_type
+		compressed = gzip.compress(self.data, compresslevel=9, mtime=0)
+		# only worth it if it actually saves something
+		self.gzip = compressed if len(compressed) < len(self.data) * 0.9 else None
+
+	def not_modified(self, headers) -> bool:
+		""" conditional GET: True if the client's copy is still current """
+		if_none_match = headers.get('If-None-Match')
+		if if_none_match is not None:
+			return any(tag.strip() in {self.etag, self.gzip_etag, '*'} for tag in if_none_match.split(','))
+		if_modified_since = headers.get('If-Modified-Since')
+		if if_modified_since is not None:
+			try:
+				return int(self.mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+			except (TypeError, ValueError):
+				return False
+		return False
+
+class StaticFiles:
+	""" All files in `lib_dirs` kept in memory (plain and gzip compressed).
+	    With `watch` files are checked for changes on every request. """
+	def __init__(self, lib_dirs: dict, watch: bool = False, max_age: int = 3600):
+		self.lib_dirs = lib_dirs
+		self.watch = watch
+		self.max_age = max_age
+		self.assets = {}
+		self.lock = threading.Lock()
+		for lib_dir in lib_dirs.values():
+			for name in os.listdir(lib_dir):
+				filename = os.path.join(lib_dir, name)
+				if os.path.isfile(filename):
+					self.assets[filename] = Asset(filename)
+
+	def find(self, path: str):
+		path = path.split('?', 1)[0]
+		pdir = os.path.dirname(path)
+		for suffix, lib_dir in self.lib_dirs.items():
+			if pdir.endswith(suffix):
+				filename = os.path.join(lib_dir, os.path.basename(path))
+				return self._get(filename)
+		return None
+
+	def _get(self, filename: str):
+		with self.lock:
+			asset = self.assets.get(filename)
+		if asset is None or not self.watch: return asset
+		try:
+			changed = os.path.getmtime(filename) != asset.mtime
+		except OSError:
+			changed = False
+		if changed:
+			print(f"reloading {filename}")
+			asset = Asset(filename)
+			with self.lock:
+				self.assets[filename] = asset
+		return asset
+
+	def cache_control(self) -> str:
+		return 'no-cache' if self.watch else f'public, max-age={self.max_age}'
@@ -0,0 +1,705 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import json, os, sys, threading, time, queue, sqlite3, argparse, fcntl
+from collections import OrderedDict, Counter
+from metrics import metrics
+from sanitizers import FindingsIndex, configurations
+from blobs import FileBlobs, SqliteBlobs
+
+def step_key(part: str, step: str) -> tuple:
+	# the same few (part, step) keys are used by every student -> share the strings
+	return (sys.intern(part), sys.intern(step))
+
+def load_step_specific_data(data):
+	return {step_key(*entry[0]): entry[1] for entry in data}
+def save_step_specific_data(data):
+	return [(key,value) for key,value in data.items()]
+
+def write_atomic(filename: str, data: str):
+	tmp = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+	with open(tmp, 'w') as ff:
+		ff.write(data)
+	os.replace(tmp, filename)
+
+def fsync_file(filename: str):
+	try:
+		fd = os.open(filename, os.O_RDONLY)
+	except FileNotFoundError:
+		return
+	try: os.fsync(fd)
+	finally: os.close(fd)
+
+class AnswerIndex:
+	""" The answers to each step in `<directory>/<part>.<step>.log`, one JSON line [uid, text] per answer
+	    (a student's last one counts), so that showing a QuestionStep does not load every student.
+	    The index is only trusted if the store was closed cleanly (`complete` marker), otherwise it
+	    is rebuilt from all students once when it is first needed. """
+	def __init__(self, directory: str):
+		self.directory = directory
+		if not os.path.isdir(directory): os.makedirs(directory)
+		self.marker = os.path.join(directory, 'complete')
+		self.complete = os.path.isfile(self.marker)
+		self.marked = self.complete
+		self.dirty = set()
+		self.lock = threading.Lock()
+		# only one rebuild at a time; saves go on meanwhile and are collected in `added`
+		self.rebuilding = threading.Lock()
+		self.added = None
+
+	def filename(self, step_id) -> str:
+		return os.path.join(self.directory, f'{step_id[0]}.{step_id[1]}.log')
+
+	def add(self, uid, step_id, text):
+		with self.lock:
+			if self.marked:
+				# from now on a crash may leave the index behind the students' records
+				os.remove(self.marker)
+				self.marked = False
+			if self.added is not None: self.added.append((uid, step_id, text))
+			with open(self.filename(step_id), 'a') as ff:
+				ff.write(json.dumps([uid, text]) + '\n')
+			self.dirty.add(step_id)
+
+	def get(self, step_id, all_answers) -> dict:
+		""" uid -> answer; `all_answers()` yields (uid, answers) of every student to rebuild the index """
+		if not self.complete: self._rebuild(all_answers)
+		with self.lock:
+			answers, count = {}, 0
+			try:
+				with open(self.filename(step_id)) as ff:
+					for line in ff:
+						try: uid, text = json.loads(line)
+						except ValueError: continue  # torn write at the end
+						answers[uid] = text
+						count += 1
+			except FileNotFoundError:
+				return {}
+			if count > 2 * len(answers) + 16: self._write(step_id, answers)
+			return answers
+
+	def _write(self, step_id, answers):
+		write_atomic(self.filename(step_id), ''.join(json.dumps([uid, text]) + '\n' for uid, text in answers.items()))
+
+	def _rebuild(self, all_answers):
+		with self.rebuilding:
+			if self.complete: return
+			with self.lock: self.added = []
+			try:
+				# without `lock`: reading a student waits for its saves, which add to the index
+				steps = {}
+				for uid, answers in all_answers():
+					for step_id, text in answers.items(): steps.setdefault(step_id, {})[uid] = text
+				with self.lock:
+					# every save adds after writing its record, so the last one added is the newest
+					for uid, step_id, text in self.added: steps.setdefault(step_id, {})[uid] = text
+					for name in os.listdir(self.directory):
+						if name.endswith('.log'): os.remove(os.path.join(self.directory, name))
+					for step_id, answers in steps.items(): self._write(step_id, answers)
+					self.complete = True
+			finally:
+				with self.lock: self.added = None
+
+	def sync(self):
+		with self.lock: dirty, self.dirty = self.dirty, set()
+		for step_id in dirty: fsync_file(self.filename(step_id))
+
+	def close(self):
+		self.sync()
+		with self.lock:
+			if self.complete and not self.marked:
+				with open(self.marker, 'w'): pass
+				self.marked = True
+
+class StoreInUse(Exception):
+	""" raised by `Store.compact` while a server has the store open """
+
+class Store:
+	""" Persistent student state. Writes for the same student are serialized; with
+	    `write_behind` they are queued and applied in batches by a background thread.
+	    Backends implement `ids`, `load`, `_put_progress`, `_put_answer`, `_put_run`,
+	    `_commit` and `_sync`. Progress only ever increases.
+	    A `shared` store is written by several processes at once; readers use `version`
+	    and `step_version` to notice changes made by the others.
+	    The sanitizer findings of all runs are indexed for `findings` and `findings_summary`.
+	    Sources and outputs of runs are kept in the backend's `blobs` and only referenced
+	    by the stored records, backends also implement `_packed_runs` for `compact`.
+	    File based backends keep an `answer_index` for `step_answers`. """
+	answer_index = None
+
+	def __init__(self, write_behind: bool = False, sync_interval: float = 1.0, shared: bool = False):
+		assert not shared or self.can_share, f"{type(self).__name__} cannot be shared between processes"
+		self.shared = shared
+		self.sync_interval = sync_interval
+		self.last_sync = time.monotonic()
+		self.locks = {}
+		self.locks_lock = threading.Lock()
+		self.pending = {}  # uid -> number of queued writes
+		self.pending_cond = threading.Condition()
+		self.findings_index = None  # built on first use
+		self.findings_lock = threading.Lock()
+		self.held = None  # file descriptor of the lock file while a server uses the store
+		self.queue = None
+		if write_behind:
+			self.queue = queue.Queue()
+			self.writer = threading.Thread(target=self._write_behind, name='store-writer', daemon=True)
+			self.writer.start()
+
+	def lock(self, uid: str):
+		with self.locks_lock:
+			if uid not in self.locks: self.locks[uid] = threading.Lock()
+			return self.locks[uid]
+
+	# the data to write is copied right away, so the student may change afterwards
+
+	def save_progress(self, student):
+		progress = student.progress
+		self._submit(student.uid, 'progress', lambda: self._put_progress(student.uid, progress))
+
+	def save_answer(self, student, step_id):
+		text = student.answers[step_id]
+		self._submit(student.uid, 'answer', lambda: self._put_answer(student.uid, step_id, text, time.time()))
+
+	def save_run(self, student, step_id):
+		run = student.runs[step_id]
+		self._index_run(student.uid, step_id, run)
+		self._submit(student.uid, 'run', lambda: self._put_run(student.uid, step_id, run, time.time()))
+
+	def save(self, student):
+		""" write all of a student's state """
+		progress = student.progress
+		answers = dict(student.answers)
+		runs = dict(student.runs)
+		for key, run in runs.items(): self._index_run(student.uid, key, run)
+		def put_all():
+			self._put_progress(student.uid, progress)
+			for key, text in answers.items(): self._put_answer(student.uid, key, text, None)
+			for key, run in runs.items(): self._put_run(student.uid, key, run, None)
+		self._submit(student.uid, 'all', put_all)
+
+	def _submit(self, uid, kind, op):
+		if self.queue is not None:
+			with self.pending_cond:
+				self.pending[uid] = self.pending.get(uid, 0) + 1
+			self.queue.put((uid, kind, op))
+			return
+		with metrics.timed('store_save', op=kind), self.lock(uid):
+			op()
+			self._commit()
+		self._maybe_sync()
+
+	def _write_behind(self):
+		while True:
+			batch = [self.queue.get()]
+			while len(batch) < 256:
+				try: batch.append(self.queue.get_nowait())
+				except queue.Empty: break
+			start = time.perf_counter()
+			for uid, kind, op in batch:
+				try:
+					with self.lock(uid): op()
+				except Exception as ee:
+					print(f"ERROR: failed to store data for {uid}: {ee}")
+			self._commit()
+			# a batch is written at once, each write is charged its share
+			share = (time.perf_counter() - start) / len(batch)
+			for _, kind, _ in batch: metrics.observe('store_save_seconds', share, op=kind)
+			with self.pending_cond:
+				for uid, _, _ in batch:
+					self.pending[uid] -= 1
+					if self.pending[uid] == 0: del self.pending[uid]
+				self.pending_cond.notify_all()
+			self._maybe_sync()
+			for _ in batch: self.queue.task_done()
+
+	def wait(self, uid: str):
+		""" wait until all queued writes for a student have been applied """
+		with self.pending_cond:
+			while uid in self.pending: self.pending_cond.wait()
+
+	def _maybe_sync(self):
+		if time.monotonic() - self.last_sync >= self.sync_interval:
+			self.last_sync = time.monotonic()
+			self._sync()
+
+	def flush(self):
+		""" wait until all queued writes have been applied and synced to disk """
+		if self.queue is not None: self.queue.join()
+		self._sync()
+
+	def close(self):
+		self.flush()
+		if self.answer_index is not None: self.answer_index.close()
+		if self.held is not None:
+			os.close(self.held)
+			self.held = None
+
+	def hold(self):
+		""" marks the store as used by this (server) process until it is closed, several processes
+		    may hold it at once; `compact` refuses to run meanwhile """
+		if self.held is not None: return
+		fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+		fcntl.flock(fd, fcntl.LOCK_SH)
+		self.held = fd
+
+	def load_all(self):
+		for uid in self.ids():
+			yield self.load(uid)
+
+	def iter_records(self, part=None, step=None, since=None, until=None):
+		""" Yields every answer and run as a dict with uid, part, step, kind ('answer' or 'run'), time
+		    and the `answer` text or the `run`, one student at a time. Records without a time
+		    are skipped if `since` or `until` is given. """
+		for uid in sorted(self.ids()):
+			self.wait(uid)
+			dd = self.load(uid)
+			for kind, entries in [('answer', dd['answers']), ('run', dd['runs'])]:
+				for key, value in sorted(entries.items()):
+					rec = {'uid': uid, 'part': key[0], 'step': key[1], 'kind': kind, 'time': None, kind: value}
+					if record_matches(rec, part, step, since, until): yield rec
+
+	def step_answers(self, step_id) -> dict:
+		""" uid -> answer of all students that answered a step """
+		return self.answer_index.get(step_id, self._all_answers)
+
+	def _all_answers(self):
+		for uid in self.ids():
+			self.wait(uid)
+			yield uid, self.load(uid)['answers']
+
+	def _index_run(self, uid, step_id, run):
+		with self.findings_lock:
+			if self.findings_index is not None: self.findings_index.put(uid, *step_id, run)
+
+	def _findings(self) -> FindingsIndex:
+		with self.findings_lock:
+			if self.findings_index is None:
+				index = FindingsIndex()
+				for rec in self.iter_records():
+					if rec['kind'] == 'run': index.put(rec['uid'], rec['part'], rec['step'], rec['run'])
+				self.findings_index = index
+			return self.findings_index
+
+	def findings(self, part=None, step=None, compiler=None, flags=None, kind=None, limit: int = 1000) -> list:
+		""" sanitizer findings in the students' latest runs, each with the uid, part, step, compiler
+		    and flags (a `metrics.flag_label`) of the run """
+		return self._findings().query(part, step, compiler, flags, kind, limit=limit)
+
+	def findings_summary(self, part=None, step=None) -> list:
+		""" number of students per part, step, compiler, flags and finding kind ('' counts all who ran) """
+		return self._findings().summary(part, step)
+
+	def compact(self) -> int:
+		""" Deletes blobs that no run refers to anymore. The references are counted from all stored runs,
+		    the counts kept along the way can be off after a crash (json and log stores sync them apart
+		    from the records). Raises StoreInUse if a server has the store open, it could add references
+		    to blobs that look unused. """
+		self.flush()
+		fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+		try:
+			try:
+				fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				raise StoreInUse(f"{self.lock_path} is held by a running server, stop it first")
+			references = Counter()
+			for run in self._packed_runs(): references.update(self.blobs.references(run))
+			return self.blobs.compact(references)
+		finally:
+			os.close(fd)
+
+	can_share = False
+	def version(self, uid: str):
+		""" changes whenever the student's data in the store changes """
+		return None
+	def step_version(self, step_id):
+		""" changes whenever an answer to the step changes """
+		return None
+
+	def _commit(self): pass
+	def _sync(self): pass
+
+class JsonStore(Store):
+	""" one `<uid>.json` file per student that is rewritten (atomically) on every change """
+	def __init__(self, student_dir: str, max_records: int = 256, **kwargs):
+		assert os.path.isdir(student_dir), f"{student_dir} does not exist"
+		self.student_dir = student_dir
+		self.records = OrderedDict()  # most recently written students
+		self.records_lock = threading.Lock()
+		self.max_records = max_records
+		# written by whoever saves a student (request threads or the writer), taken by `_sync`
+		self.dirty = set()
+		self.dirty_lock = threading.Lock()
+		self.blobs = FileBlobs(os.path.join(student_dir, 'blobs'))
+		self.answer_index = AnswerIndex(os.path.join(student_dir, 'answers'))
+		self.lock_path = os.path.join(student_dir, '.lock')
+		super().__init__(**kwargs)
+
+	def filename(self, uid: str) -> str:
+		return os.path.join(self.student_dir, uid + '.json')
+
+	def ids(self):
+		return [name[:-len('.json')] for name in os.listdir(self.student_dir) if name.endswith('.json')]
+
+	def load(self, uid: str) -> dict:
+		dd = self._read(uid)
+		del dd['times']
+		dd['runs'] = {key: self.blobs.unpack(run) for key, run in dd['runs'].items()}
+		return dd
+
+	def _read(self, uid: str) -> dict:
+		with open(self.filename(uid)) as ff:
+			dd = json.load(ff)
+		assert dd['uid'] == uid, f"{dd['uid']} != {uid}"
+		dd['answers'] = load_step_specific_data(dd.get('answers', []))
+		dd['runs'] = load_step_specific_data(dd.get('runs', []))
+		# (kind, part, step) -> when the answer or run was saved (files written before this was added have none)
+		dd['times'] = {(kind, part, step): t for kind, part, step, t in dd.get('times', [])}
+		return dd
+
+	def iter_records(self, part=None, step=None, since=None, until=None):
+		for uid in sorted(self.ids()):
+			self.wait(uid)
+			dd = self._read(uid)
+			for kind, entries in [('answer', dd['answers']), ('run', dd['runs'])]:
+				for key, value in sorted(entries.items()):
+					rec = {'uid': uid, 'part': key[0], 'step': key[1], 'kind': kind,
+						   'time': dd['times'].get((kind, *key)), kind: value}
+					if not record_matches(rec, part, step, since, until): continue
+					if kind == 'run': rec['run'] = self.blobs.unpack(value)
+					yield rec
+
+	def _packed_runs(self):
+		for uid in self.ids():
+			yield from self._read(uid)['runs'].values()
+
+	def _record(self, uid):
+		# called with the student's lock held
+		with self.records_lock:
+			if uid in self.records:
+				self.records.move_to_end(uid)
+				return self.records[uid]
+		if os.path.isfile(self.filename(uid)):
+			dd = self._read(uid)
+		else:
+			dd = {'uid': uid, 'progress': None, 'answers': {}, 'runs': {}, 'times': {}}
+		with self.records_lock:
+			self.records[uid] = dd
+			while len(self.records) > self.max_records:
+				self.records.popitem(last=False)
+		return dd
+
+	def _write(self, uid):
+		rec = self.records[uid]
+		dd = {'uid': uid, 'progress': rec['progress'],
+			  'answers': save_step_specific_data(rec['answers']), 'runs': save_step_specific_data(rec['runs']),
+			  'times': [[*key, t] for key, t in rec['times'].items()]}
+		write_atomic(self.filename(uid), json.dumps(dd, indent=2))
+		with self.dirty_lock: self.dirty.add(uid)
+
+	def _put_progress(self, uid, progress):
+		rec = self._record(uid)
+		rec['progress'] = max_progress(rec['progress'], progress)
+		self._write(uid)
+	def _put_answer(self, uid, step_id, text, t):
+		rec = self._record(uid)
+		rec['answers'][step_id] = text
+		if t is not None: rec['times'][('answer', *step_id)] = t
+		self._write(uid)
+		self.answer_index.add(uid, step_id, text)
+	def _put_run(self, uid, step_id, run, t):
+		rec = self._record(uid)
+		old = rec['runs'].get(step_id)
+		rec['runs'][step_id] = self.blobs.pack(run)
+		if t is not None: rec['times'][('run', *step_id)] = t
+		self._write(uid)
+		if old is not None: self.blobs.release(old)
+
+	def _sync(self):
+		with self.dirty_lock: dirty, self.dirty = self.dirty, set()
+		for uid in dirty: fsync_file(self.filename(uid))
+		self.answer_index.sync()
+		self.blobs.sync()
+
+class LogStore(Store):
+	""" one append-only `<uid>.log` file per student with one JSON record per change;
+	    logs are compacted when they are loaded and mostly consist of overwritten records """
+	def __init__(self, log_dir: str, **kwargs):
+		if not os.path.isdir(log_dir): os.makedirs(log_dir)
+		self.log_dir = log_dir
+		self.dirty = set()
+		self.dirty_lock = threading.Lock()
+		self.blobs = FileBlobs(os.path.join(log_dir, 'blobs'))
+		self.answer_index = AnswerIndex(os.path.join(log_dir, 'answers'))
+		self.lock_path = os.path.join(log_dir, '.lock')
+		super().__init__(**kwargs)
+
+	def filename(self, uid: str) -> str:
+		return os.path.join(self.log_dir, uid + '.log')
+
+	def ids(self):
+		return [name[:-len('.log')] for name in os.listdir(self.log_dir) if name.endswith('.log')]
+
+	def load(self, uid: str) -> dict:
+		dd = {'uid': uid, 'progress': None, 'answers': {}, 'runs': {}}
+		count = 0
+		overwritten = []  # runs that compacting drops
+		with self.lock(uid):
+			with open(self.filename(uid)) as ff:
+				for line in ff:
+					try: rec = json.loads(line)
+					except json.JSONDecodeError: continue  # torn write at the end of the log
+					count += 1
+					if 'progress' in rec: dd['progress'] = max_progress(dd['progress'], rec['progress'])
+					if 'answer' in rec: dd['answers'][step_key(*rec['answer'][0])] = rec['answer'][1]
+					if 'run' in rec:
+						key = step_key(*rec['run'][0])
+						if key in dd['runs']: overwritten.append(dd['runs'][key])
+						dd['runs'][key] = rec['run'][1]
+			if count > 2 * (len(dd['answers']) + len(dd['runs']) + 1):
+				self._compact(dd)
+				for run in overwritten: self.blobs.release(run)
+		dd['runs'] = {key: self.blobs.unpack(run) for key, run in dd['runs'].items()}
+		return dd
+
+	def iter_records(self, part=None, step=None, since=None, until=None):
+		# unlike `load`, keeps the time of the latest record for every answer and run
+		for uid in sorted(self.ids()):
+			self.wait(uid)
+			latest = {}
+			with self.lock(uid), open(self.filename(uid)) as ff:
+				for line in ff:
+					try: rec = json.loads(line)
+					except json.JSONDecodeError: continue
+					for kind in ['answer', 'run']:
+						if kind in rec: latest[(kind, *rec[kind][0])] = (rec.get('t'), rec[kind][1])
+			for (kind, p, s), (t, value) in sorted(latest.items()):
+				rec = {'uid': uid, 'part': p, 'step': s, 'kind': kind, 'time': t, kind: value}
+				if not record_matches(rec, part, step, since, until): continue
+				if kind == 'run': rec['run'] = self.blobs.unpack(value)
+				yield rec
+
+	def _packed_runs(self):
+		# every run in a log holds its references until the log is compacted
+		for uid in self.ids():
+			with self.lock(uid), open(self.filename(uid)) as ff:
+				for line in ff:
+					try: rec = json.loads(line)
+					except json.JSONDecodeError: continue
+					if 'run' in rec: yield rec['run'][1]
+
+	def _compact(self, dd):
+		lines = [{'progress': dd['progress']}]
+		lines += [{'answer': [key, text]} for key, text in dd['answers'].items()]
+		lines += [{'run': [key, run]} for key, run in dd['runs'].items()]
+		write_atomic(self.filename(dd['uid']), ''.join(json.dumps(ll) + '\n' for ll in lines))
+
+	def _append(self, uid, rec):
+		with open(self.filename(uid), 'a') as ff:
+			ff.write(json.dumps(rec) + '\n')
+		with self.dirty_lock: self.dirty.add(uid)
+
+	def _put_progress(self, uid, progress):
+		self._append(uid, {'progress': progress})
+	def _put_answer(self, uid, step_id, text, t):
+		self._append(uid, {'answer': [step_id, text], 't': t})
+		self.answer_index.add(uid, step_id, text)
+	def _put_run(self, uid, step_id, run, t):
+		self._append(uid, {'run': [step_id, self.blobs.pack(run)], 't': t})
+
+	def _sync(self):
+		with self.dirty_lock: dirty, self.dirty = self.dirty, set()
+		for uid in dirty: fsync_file(self.filename(uid))
+		self.answer_index.sync()
+		self.blobs.sync()
+
+class SqliteStore(Store):
+	""" all students in one SQLite database (WAL mode, commits are batched);
+	    can be shared by several server processes """
+	can_share = True
+	schema = [
+		'CREATE TABLE IF NOT EXISTS students (uid TEXT PRIMARY KEY, progress INTEGER, version INTEGER DEFAULT 0)',
+		'CREATE TABLE IF NOT EXISTS answers (uid TEXT, part TEXT, step TEXT, text TEXT, time REAL, PRIMARY KEY (uid, part, step))',
+		'CREATE TABLE IF NOT EXISTS runs (uid TEXT, part TEXT, step TEXT, data TEXT, time REAL, PRIMARY KEY (uid, part, step))',
+		# see sanitizers.FindingsIndex, `data` is NULL for the rows with kind '' that record which configurations were run
+		'CREATE TABLE IF NOT EXISTS findings (uid TEXT, part TEXT, step TEXT, compiler TEXT, flags TEXT, kind TEXT, data TEXT)',
+		'CREATE INDEX IF NOT EXISTS findings_key ON findings (part, step, compiler, flags, kind)',
+		'CREATE INDEX IF NOT EXISTS findings_student ON findings (uid, part, step)',
+	]
+	def __init__(self, filename: str, **kwargs):
+		self.filename = filename
+		self.lock_path = filename + '.lock'
+		# other processes may hold the write lock for a moment
+		self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level='DEFERRED', timeout=30.0)
+		self.db_lock = threading.RLock()
+		with self.db_lock:
+			self.db.execute('PRAGMA journal_mode=WAL')
+			self.db.execute('PRAGMA synchronous=NORMAL')
+			index_runs = len(self.db.execute("SELECT name FROM sqlite_master WHERE name = 'findings'").fetchall()) == 0
+			for stmt in self.schema + [SqliteBlobs.schema]: self.db.execute(stmt)
+			self.blobs = SqliteBlobs(self.db, self.db_lock)
+			if index_runs:
+				# runs stored before there was a findings table
+				for uid, part, step, data in self.db.execute('SELECT uid, part, step, data FROM runs').fetchall():
+					self._put_findings(uid, (part, step), self.blobs.unpack(json.loads(data)))
+			columns = [row[1] for row in self.db.execute('PRAGMA table_info(students)')]
+			if 'version' not in columns:
+				self.db.execute('ALTER TABLE students ADD COLUMN version INTEGER DEFAULT 0')
+			self.db.commit()
+		super().__init__(**kwargs)
+
+	def _execute(self, sql, args=()):
+		with self.db_lock:
+			return self.db.execute(sql, args).fetchall()
+
+	def ids(self):
+		return [row[0] for row in self._execute('SELECT uid FROM students')]
+
+	def load(self, uid: str) -> dict:
+		rows = self._execute('SELECT progress FROM students WHERE uid = ?', (uid,))
+		if len(rows) == 0: raise KeyError(uid)
+		answers = {step_key(part, step): text for part, step, text in
+				   self._execute('SELECT part, step, text FROM answers WHERE uid = ?', (uid,))}
+		runs = {step_key(part, step): self.blobs.unpack(json.loads(data)) for part, step, data in
+				self._execute('SELECT part, step, data FROM runs WHERE uid = ?', (uid,))}
+		return {'uid': uid, 'progress': rows[0][0], 'answers': answers, 'runs': runs}
+
+	def step_answers(self, step_id) -> dict:
+		if self.queue is not None: self.queue.join()
+		return dict(self._execute('SELECT uid, text FROM answers WHERE part = ? AND step = ?', step_id))
+
+	def iter_records(self, part=None, step=None, since=None, until=None):
+		# a separate read-only connection: reading does not hold up writers (WAL) or other threads
+		db = sqlite3.connect(f'file:{self.filename}?mode=ro', uri=True)
+		try:
+			cond, args = sql_where(('part', part, '='), ('step', step, '='), ('time', since, '>='), ('time', until, '<'))
+			for kind, table, column in [('answer', 'answers', 'text'), ('run', 'runs', 'data')]:
+				for uid, p, s, t, value in db.execute(f'SELECT uid, part, step, time, {column} FROM {table}{cond} '
+														 f'ORDER BY uid, part, step', args):
+					yield {'uid': uid, 'part': p, 'step': s, 'kind': kind, 'time': t,
+						   kind: self.blobs.unpack(json.loads(value)) if kind == 'run' else value}
+		finally:
+			db.close()
+
+	def findings(self, part=None, step=None, compiler=None, flags=None, kind=None, limit: int = 1000) -> list:
+		cond, args = sql_where(('part', part, '='), ('step', step, '='), ('compiler', compiler, '='), ('flags', flags, '='),
+							   ('kind', kind, '='), ('kind', '', '!='))
+		rows = self._execute(f'SELECT uid, part, step, compiler, flags, data FROM findings{cond} '
+							 f'ORDER BY part, step, compiler, flags, kind, uid LIMIT ?', args + [limit])
+		return [dict(json.loads(data), uid=uid, part=p, step=s, compiler=c, flags=f) for uid, p, s, c, f, data in rows]
+
+	def findings_summary(self, part=None, step=None) -> list:
+		cond, args = sql_where(('part', part, '='), ('step', step, '='))
+		rows = self._execute(f'SELECT part, step, compiler, flags, kind, count(DISTINCT uid) FROM findings{cond} '
+							 f'GROUP BY part, step, compiler, flags, kind ORDER BY part, step, compiler, flags, kind', args)
+		return [{'part': p, 'step': s, 'compiler': c, 'flags': f, 'kind': k, 'students': n} for p, s, c, f, k, n in rows]
+
+	def version(self, uid: str):
+		rows = self._execute('SELECT version FROM students WHERE uid = ?', (uid,))
+		return rows[0][0] if len(rows) > 0 else None
+
+	def step_version(self, step_id):
+		# replacing an answer inserts a new row with a higher rowid
+		return tuple(self._execute('SELECT count(*), max(rowid) FROM answers WHERE part = ? AND step = ?', step_id)[0])
+
+	def _touch(self, uid):
+		self._execute('INSERT INTO students (uid, progress, version) VALUES (?, NULL, 1) '
+					  'ON CONFLICT(uid) DO UPDATE SET version = version + 1', (uid,))
+
+	def _put_progress(self, uid, progress):
+		# never lower the progress: another process might have moved the student ahead already
+		self._execute('INSERT INTO students (uid, progress, version) VALUES (?, ?, 1) '
+					  'ON CONFLICT(uid) DO UPDATE SET version = version + 1, '
+					  'progress = coalesce(max(progress, excluded.progress), progress, excluded.progress)', (uid, progress))
+	def _put_answer(self, uid, step_id, text, t):
+		self._execute('INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)', (uid, step_id[0], step_id[1], text, t))
+		self._touch(uid)
+	def _put_run(self, uid, step_id, run, t):
+		old = self._execute('SELECT data FROM runs WHERE uid = ? AND part = ? AND step = ?', (uid, *step_id))
+		packed = self.blobs.pack(run)
+		self._execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)', (uid, step_id[0], step_id[1], json.dumps(packed), t))
+		if len(old) > 0: self.blobs.release(json.loads(old[0][0]))
+		self._put_findings(uid, step_id, run)
+		self._touch(uid)
+
+	def _packed_runs(self):
+		for (data,) in self._execute('SELECT data FROM runs'): yield json.loads(data)
+	def _put_findings(self, uid, step_id, run):
+		rows = [(uid, *step_id, compiler, flags, '' if ff is None else ff['kind'], None if ff is None else json.dumps(ff))
+				for compiler, flags, findings in configurations(run) for ff in [None] + findings]
+		with self.db_lock:
+			self.db.execute('DELETE FROM findings WHERE uid = ? AND part = ? AND step = ?', (uid, *step_id))
+			self.db.executemany('INSERT INTO findings VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+	def _commit(self):
+		with self.db_lock: self.db.commit()
+
+	def close(self):
+		super().close()
+		with self.db_lock: self.db.close()
+
+def sql_where(*conditions):
+	""" ' WHERE column op ? AND ...' and its arguments for the (column, value, op) whose value is not None """
+	where = [f'{column} {op} ?' for column, value, op in conditions if value is not None]
+	args = [value for _, value, _ in conditions if value is not None]
+	return (' WHERE ' + ' AND '.join(where) if len(where) > 0 else ''), args
+
+def record_matches(rec: dict, part=None, step=None, since=None, until=None) -> bool:
+	if part is not None and rec['part'] != part: return False
+	if step is not None and rec['step'] != step: return False
+	if since is None and until is None: return True
+	t = rec['time']
+	return t is not None and (since is None or t >= since) and (until is None or t < until)
+
+def max_progress(a, b):
+	if a is None: return b
+	if b is None: return a
+	return max(a, b)
+
+def open_store(kind: str, path: str, **kwargs) -> Store:
+	if kind == 'json':   return JsonStore(path, **kwargs)
+	if kind == 'log':    return LogStore(path, **kwargs)
+	if kind == 'sqlite': return SqliteStore(path, **kwargs)
+	raise ValueError(f"unknown store: {kind}")
+
+def migrate(src: Store, dst: Store):
+	count = 0
+	for dd in src.load_all():
+		uid = dd['uid']
+		dst._put_progress(uid, dd['progress'])
+		for key, text in dd['answers'].items(): dst._put_answer(uid, key, text, None)
+		for key, run in dd['runs'].items(): dst._put_run(uid, key, run, None)
+		count += 1
+	dst._commit()
+	dst.flush()
+	return count
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='student store tools')
+	sub = parser.add_subparsers(dest='cmd', required=True)
+	mig = sub.add_parser('migrate', help='copy all students from one store into another')
+	mig.add_argument('src', help='source, e.g. students/')
+	mig.add_argument('dst', help='destination, e.g. students.sqlite')
+	mig.add_argument('--from', dest='src_kind', default='json', choices=['json', 'log', 'sqlite'])
+	mig.add_argument('--to', dest='dst_kind', default='sqlite', choices=['json', 'log', 'sqlite'])
+	comp = sub.add_parser('compact', help='delete sources and outputs that no run refers to anymore (the server must be stopped)')
+	comp.add_argument('path', help='student directory, log directory or sqlite file')
+	comp.add_argument('--store', default='json', choices=['json', 'log', 'sqlite'])
+	args = parser.parse_args()
+	if args.cmd == 'compact':
+		store = open_store(args.store, args.path)
+		try:
+			count = store.compact()
+			print(f"deleted {count} blobs, {store.blobs.stats()}", file=sys.stderr)
+		except StoreInUse as ee:
+			print(f"ERROR: {ee}", file=sys.stderr)
+			sys.exit(1)
+		finally:
+			store.close()
+		sys.exit(0)
+	src = open_store(args.src_kind, args.src)
+	dst = open_store(args.dst_kind, args.dst)
+	count = migrate(src, dst)
+	dst.close()
+	print(f"migrated {count} students from {args.src} to {args.dst}", file=sys.stderr)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import os, shutil, tempfile, threading, unittest
+from store import JsonStore, LogStore
+
+class Student:
+	def __init__(self, uid: str, answers: dict):
+		self.uid = uid
+		self.progress = 0
+		self.answers = answers
+		self.runs = {}
+
+step = ('program2', 'step2')
+
+class AnswerIndexTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+	def tearDown(self):
+		shutil.rmtree(self.dir, ignore_errors=True)
+
+	def rebuild_while_saving(self, open_store, students: int = 300, saves: int = 20):
+		""" the first `step_answers` rebuilds the index while other threads keep saving answers """
+		store = open_store()
+		for ii in range(students): store.save_answer(Student(f's{ii}', {step: 'first'}), step)
+		store.close()
+		store = open_store()
+		self.assertFalse(store.answer_index.complete)
+		def save(first: int):
+			for round in range(saves):
+				for ii in range(first, students, 4): store.save_answer(Student(f's{ii}', {step: f'round {round}'}), step)
+		savers = [threading.Thread(target=save, args=(ii,), daemon=True) for ii in range(4)]
+		for tt in savers: tt.start()
+		reader = threading.Thread(target=store.step_answers, args=(step,), daemon=True)
+		reader.start()
+		reader.join(timeout=60)
+		for tt in savers: tt.join(timeout=60)
+		self.assertFalse(reader.is_alive() or any(tt.is_alive() for tt in savers), "deadlock")
+		store.flush()
+		self.assertEqual(store.step_answers(step), {f's{ii}': f'round {saves - 1}' for ii in range(students)})
+		store.close()
+
+	def test_json_write_behind(self):
+		self.rebuild_while_saving(lambda: JsonStore(self.dir, write_behind=True))
+
+	def test_log(self):
+		self.rebuild_while_saving(lambda: LogStore(os.path.join(self.dir, 'log')))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import hashlib, threading
+from collections import OrderedDict
+from ansi2html import Ansi2HTMLConverter
+from metrics import metrics
+
+class LRU:
+	""" bounded by the total `size(value)` of its entries, the newest one is always kept """
+	def __init__(self, max_bytes: int, size=len):
+		self.max_bytes = max_bytes
+		self.size = size
+		self.bytes = 0
+		self.entries = OrderedDict()  # key -> (value, size)
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	def get(self, key, default=None):
+		with self.lock:
+			if key in self.entries:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return self.entries[key][0]
+			self.misses += 1
+			return default
+
+	def put(self, key, value):
+		size = self.size(value)
+		with self.lock:
+			old = self.entries.pop(key, None)
+			if old is not None: self.bytes -= old[1]
+			self.entries[key] = (value, size)
+			self.bytes += size
+			while self.bytes > self.max_bytes and len(self.entries) > 1:
+				self.bytes -= self.entries.popitem(last=False)[1][1]
+
+	def stats(self) -> dict:
+		with self.lock:
+			return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses}
+
+class AnsiToHtml:
+	""" ANSI to HTML conversion memoized by content: most students see the exact same output """
+	def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+		self.conv = Ansi2HTMLConverter()
+		self.conv_lock = threading.Lock()
+		self.cache = LRU(max_bytes)
+
+	def convert(self, text: str) -> str:
+		key = hashlib.sha1(text.encode('utf-8', errors='replace')).digest()
+		html = self.cache.get(key)
+		if html is None:
+			with metrics.timed('ansi'), self.conv_lock:
+				html = self.conv.convert(text, full=False)
+			self.cache.put(key, html)
+		return html
+
+class ViewCache:
+	""" Rendered pages by (student, part, step), tagged with version numbers that are bumped
+	    whenever a student's run or answer or the answers shown on a step change.
+	    Pages that do not depend on the student are shared by everybody. """
+	def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+		self.pages = LRU(max_bytes, size=lambda entry: len(entry[1]))
+		self.versions = {}
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	def bump(self, key):
+		with self.lock:
+			self.versions[key] = self.versions.get(key, 0) + 1
+
+	def version(self, key) -> int:
+		with self.lock:
+			return self.versions.get(key, 0)
+
+	def get(self, key, version):
+		entry = self.pages.get(key)
+		hit = entry is not None and entry[0] == version
+		with self.lock:
+			if hit: self.hits += 1
+			else:   self.misses += 1
+		return entry[1] if hit else None
+
+	def put(self, key, version, page: str):
+		self.pages.put(key, (version, page))
+
+	def stats(self) -> dict:
+		with self.lock:
+			return {'entries': len(self.pages.entries), 'bytes': self.pages.bytes, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+""" Compile workers: `python worker.py --address HOST:PORT` runs a daemon that compiles and runs
+    programs for servers started with `--compile-workers HOST:PORT ...`.
+    Both sides need the same secret in the CPPUNIT_WORKER_KEY environment variable,
+    since whoever knows it can run arbitrary programs on the worker. """
+
+import argparse, asyncio, os, socket, struct, sys, threading, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection, AuthenticationError, answer_challenge, deliver_challenge
+from compiler import Compiler, WorkersUnavailable
+from executor import Executor
+from metrics import metrics
+
+def authkey() -> bytes:
+	key = os.environ.get('CPPUNIT_WORKER_KEY', '')
+	assert len(key) > 0, "CPPUNIT_WORKER_KEY needs to be set for compile workers"
+	return key.encode('utf-8')
+
+def parse_address(text: str) -> tuple:
+	host, _, port = text.rpartition(':')
+	return host or 'localhost', int(port)
+
+class WorkerDaemon:
+	""" Answers ('hello',), ('compile_and_run', compiler, flags, source, stream), ('check', compiler, flags, source, False)
+	    and ('rerun', compiler, flags, source, args, stdin, options, stream) on each connection,
+	    one request after the other. While a job runs its output lines are sent as
+	    ('line', phase, stream, line) if asked for, then ('result', result, queue depth). """
+	def __init__(self, address, comp: Compiler, max_procs: int = None):
+		self.comp = comp
+		self.max_procs = max_procs or os.cpu_count() or 1
+		self.slots = threading.Semaphore(self.max_procs)
+		self.depth = 0  # jobs waiting or running
+		self.lock = threading.Lock()
+		self.key = authkey()
+		self.sock = socket.create_server(address, backlog=128)
+		self.address = self.sock.getsockname()
+
+	def info(self) -> dict:
+		return {'versions': self.comp.versions, 'max_procs': self.max_procs, 'queue': self.depth}
+
+	def serve_forever(self):
+		while True:
+			sock, _ = self.sock.accept()
+			threading.Thread(target=self.handle, args=(sock,), daemon=True).start()
+
+	def handle(self, sock):
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		# clients that do not answer the handshake within 10s are dropped
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack('ll', 10, 0))
+		with sock, Connection(os.dup(sock.fileno())) as conn:
+			# the same handshake as multiprocessing.connection.Listener, but not in the accepting thread
+			try:
+				deliver_challenge(conn, self.key)
+				answer_challenge(conn, self.key)
+			except (AuthenticationError, EOFError, OSError) as ee:
+				print(f"ERROR: rejected connection: {ee!r}")
+				return
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack('ll', 0, 0))
+			while True:
+				try:
+					request = conn.recv()
+				except (EOFError, ConnectionError):
+					return
+				if request[0] == 'hello':
+					conn.send(('hello', self.info()))
+					continue
+				on_line = (lambda phase, stream, line: conn.send(('line', phase, stream, line))) if request[-1] else None
+				with self.lock: self.depth += 1
+				try:
+					with self.slots:
+						if request[0] == 'compile_and_run':
+							result = self.comp.compile_and_run(*request[1:4], on_line=on_line)
+						elif request[0] == 'check':
+							result = self.comp.check(*request[1:4])
+						else:
+							result = self.comp.rerun(*request[1:7], on_line=on_line)
+				finally:
+					with self.lock: self.depth -= 1
+				try:
+					conn.send(('result', result, self.depth))
+				except ConnectionError:
+					return
+
+class Attempts:
+	""" `on_line` of a request that may be tried several times: the lines of a try that failed
+	    were already forwarded, so the next try starts with ('reset', None, None) to void them all """
+	def __init__(self, on_line):
+		self.on_line = on_line
+		self.forwarded = False
+
+	def line(self, *line):
+		if line[0] != 'reset': self.forwarded = True
+		# a reset of all phases from a retry further down leaves nothing on the screen
+		elif line[1] is None: self.forwarded = False
+		self.on_line(*line)
+
+	def retry(self):
+		if self.forwarded: self.on_line('reset', None, None)
+		self.forwarded = False
+
+class RemoteWorker:
+	""" connections to one worker daemon and what the server knows about its load """
+	def __init__(self, address, key: bytes, timeout: float):
+		self.address = address
+		self.name = f'{address[0]}:{address[1]}'
+		self.key = key
+		self.timeout = timeout
+		self.idle = []  # connections
+		self.info = None
+		self.inflight = 0  # jobs of this server
+		self.others = 0    # jobs of other servers at the last answer
+		self.down_until = 0.0
+		self.lock = threading.Lock()
+
+	def connect(self) -> Connection:
+		with socket.create_connection(self.address, timeout=10.0) as sock:
+			sock.settimeout(None)
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack('ll', 10, 0))
+			conn = Connection(os.dup(sock.fileno()))
+			try:
+				answer_challenge(conn, self.key)
+				deliver_challenge(conn, self.key)
+			except BaseException:
+				conn.close()
+				raise
+			# answers to jobs are waited for with `poll`
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack('ll', 0, 0))
+		return conn
+
+	def call(self, request, on_line=None):
+		""" raises OSError/EOFError if the worker cannot be reached or went away """
+		with self.lock: conn = self.idle.pop() if len(self.idle) > 0 else None
+		attempts = None if on_line is None else Attempts(on_line)
+		try:
+			msg = self._call(conn or self.connect(), request, attempts and attempts.line)
+		except (EOFError, ConnectionError):
+			if conn is None: raise
+			# the worker may have been restarted since the connection was used
+			if attempts is not None: attempts.retry()
+			msg = self._call(self.connect(), request, attempts and attempts.line)
+		return msg
+
+	def _call(self, conn, request, on_line):
+		try:
+			conn.send(request)
+			while True:
+				if not conn.poll(self.timeout): raise TimeoutError(f"no answer from {self.name} in {self.timeout}s")
+				msg = conn.recv()
+				if msg[0] != 'line': break
+				if on_line is not None: on_line(*msg[1:])
+		except BaseException:
+			conn.close()
+			raise
+		with self.lock: self.idle.append(conn)
+		return msg
+
+	def load(self) -> float:
+		return (self.inflight + self.others) / self.info['max_procs']
+
+class Workers:
+	""" Sends builds to the worker with the shortest queue, counting the jobs of other servers
+	    that the worker reported last time. A worker that fails is skipped for `retry_interval`
+	    seconds and the job goes to the next one. Workers have to agree on the compiler versions
+	    (they are part of the cache key); reruns prefer the worker that still has the binary. """
+	retry_interval = 5.0
+	def __init__(self, addresses: list, timeout: float = 300.0):
+		key = authkey()
+		self.workers = [RemoteWorker(parse_address(aa) if isinstance(aa, str) else aa, key, timeout) for aa in addresses]
+		self.versions = None
+		self.built = OrderedDict()  # cache key -> worker that built it
+		self.lock = threading.Lock()
+		for worker in self.workers: self.hello(worker)
+		if self.versions is None: raise WorkersUnavailable("no compile worker is reachable")
+		# waits for the workers of `*_async` calls
+		self.threads = ThreadPoolExecutor(max_workers=max(8, 2 * self.capacity()), thread_name_prefix='workers')
+
+	def hello(self, worker: RemoteWorker) -> bool:
+		try:
+			info = worker.call(('hello',))[1]
+		except (OSError, EOFError, AuthenticationError) as ee:
+			print(f"ERROR: compile worker {worker.name} is not reachable: {ee!r}")
+			worker.down_until = time.monotonic() + self.retry_interval
+			return False
+		with self.lock:
+			if self.versions is None: self.versions = info['versions']
+			if info['versions'] != self.versions:
+				print(f"ERROR: compile worker {worker.name} has compilers {info['versions']}, expected {self.versions}")
+				worker.down_until = float('inf')
+				return False
+			worker.info, worker.others, worker.down_until = info, info['queue'], 0.0
+		return True
+
+	def capacity(self) -> int:
+		return sum(ww.info['max_procs'] for ww in self.workers if ww.info is not None) or 1
+
+	def _pick(self, tried: set, prefer=None):
+		now = time.monotonic()
+		for worker in self.workers:
+			if worker not in tried and worker.down_until != float('inf') and 0 < worker.down_until <= now:
+				self.hello(worker)
+		with self.lock:
+			up = [ww for ww in self.workers if ww not in tried and ww.info is not None and ww.down_until == 0.0]
+			if len(up) == 0: return None
+			worker = prefer if prefer in up and prefer.load() < 1.0 else min(up, key=RemoteWorker.load)
+			worker.inflight += 1
+			return worker
+
+	def call(self, request, on_line=None, key=None):
+		""" the result of the first worker that answers, raises WorkersUnavailable if none does """
+		tried = set()
+		attempts = None if on_line is None else Attempts(on_line)
+		while True:
+			with self.lock: prefer = self.built.get(key)
+			worker = self._pick(tried, prefer)
+			if worker is None: raise WorkersUnavailable(f"none of the {len(self.workers)} compile workers answered")
+			try:
+				if attempts is not None: attempts.retry()
+				_, result, depth = worker.call(request, attempts and attempts.line)
+			except (OSError, EOFError, AuthenticationError) as ee:
+				print(f"ERROR: compile worker {worker.name} failed: {ee!r}")
+				metrics.inc('worker_jobs_total', worker=worker.name, result='failed')
+				with self.lock:
+					worker.inflight -= 1
+					worker.down_until = time.monotonic() + self.retry_interval
+				tried.add(worker)
+				continue
+			metrics.inc('worker_jobs_total', worker=worker.name, result='ok')
+			with self.lock:
+				worker.inflight -= 1
+				worker.others = max(0, depth - worker.inflight)
+				if key is not None:
+					self.built[key] = worker
+					self.built.move_to_end(key)
+					while len(self.built) > 4096: self.built.popitem(last=False)
+			return result
+
+	def compile_and_run(self, key, compiler, flags, source, on_line=None):
+		return self.call(('compile_and_run', compiler, flags, source, on_line is not None), on_line, key=key)
+
+	def check(self, compiler, flags, source):
+		return self.call(('check', compiler, flags, source, False))
+
+	def rerun(self, key, compiler, flags, source, args=None, stdin=None, options=None, on_line=None):
+		return self.call(('rerun', compiler, flags, source, args, stdin, options, on_line is not None), on_line, key=key)
+
+	async def call_async(self, fn, *args, on_line=None):
+		""" `fn(*args, on_line)` on a thread, with `on_line` called on the event loop """
+		loop = asyncio.get_running_loop()
+		forward = None if on_line is None else lambda *line: loop.call_soon_threadsafe(on_line, *line)
+		return await loop.run_in_executor(self.threads, lambda: fn(*args, on_line=forward))
+
+	def stats(self) -> dict:
+		now = time.monotonic()
+		with self.lock:
+			return {ww.name: {'up': ww.info is not None and ww.down_until == 0.0, 'inflight': ww.inflight, 'others': ww.others,
+							  'max_procs': None if ww.info is None else ww.info['max_procs'],
+							  'retry_in': None if ww.down_until in (0.0, float('inf')) else max(0.0, ww.down_until - now)}
+					for ww in self.workers}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='compiles and runs programs for the server (needs CPPUNIT_WORKER_KEY)')
+	parser.add_argument('--address', default='localhost:7001', help='HOST:PORT to listen on')
+	parser.add_argument('--working-dir', default='worker', help='where programs are compiled')
+	parser.add_argument('--max-procs', type=int, help='concurrent builds (default: number of cpus)')
+	parser.add_argument('--executors', type=int, default=0, help='start compilers and programs from helper processes')
+	parser.add_argument('--cache-mb', type=int, default=256, help='size of the compile cache')
+	args = parser.parse_args()
+	comp = Compiler(working_dir=args.working_dir, cache_bytes=args.cache_mb * 1024 * 1024,
+					executor=Executor(args.executors) if args.executors > 0 else None)
+	daemon = WorkerDaemon(parse_address(args.address), comp, max_procs=args.max_procs)
+	print(f"compile worker on {daemon.address[0]}:{daemon.address[1]} with {comp.versions}")
+	sys.stdout.flush()
+	try:
+		daemon.serve_forever()
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+import os, shutil, tempfile, threading
+
+class QuotaExceeded(Exception):
+	pass
+
+def dir_size(path: str) -> int:
+	total = 0
+	for root, _, files in os.walk(path):
+		for name in files:
+			try: total += os.path.getsize(os.path.join(root, name))
+			except OSError: pass
+	return total
+
+def pid_alive(pid: int) -> bool:
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
+
+def ram_dir(name: str):
+	""" a directory on a RAM backed file system if one is available """
+	shm = '/dev/shm'
+	if os.path.isdir(shm) and os.access(shm, os.W_OK | os.X_OK):
+		return os.path.join(shm, name)
+	return None
+
+class Workspaces:
+	""" Hands out compile directories from `<root>/run-<pid>`, preferably on tmpfs.
+	    Released directories are emptied and kept for reuse, the total size of all
+	    directories in use is limited by `quota_bytes`. """
+	def __init__(self, base_dir: str, quota_bytes: int = 1024 * 1024 * 1024, pool_size: int = 32, use_ram: bool = True):
+		self.base_dir = os.path.abspath(base_dir)
+		ram = ram_dir(f'cpp-unit-{os.path.basename(self.base_dir)}-{os.getuid()}') if use_ram else None
+		self.top_dir = ram or self.base_dir
+		self.quota_bytes = quota_bytes
+		self.pool_size = pool_size
+		self.reclaim = None  # optional callback(bytes_needed) that releases workspaces
+		self.sweep()
+		self.root = os.path.join(self.top_dir, f'run-{os.getpid()}')
+		os.makedirs(self.root, exist_ok=True)
+		self.free = []
+		self.sizes = {}  # workspace in use -> size in bytes when last measured
+		self.lock = threading.Lock()
+
+	def sweep(self):
+		""" remove directories left behind by earlier (or crashed) servers """
+		for top in {self.top_dir, self.base_dir}:
+			if not os.path.isdir(top): continue
+			for name in os.listdir(top):
+				path = os.path.join(top, name)
+				if name.startswith('run-') and name[4:].isdigit():
+					if int(name[4:]) == os.getpid() or pid_alive(int(name[4:])): continue
+				elif not (name.startswith('g++_') or name.startswith('clang++_')):
+					continue
+				print(f"removing stale workspace {path}")
+				shutil.rmtree(path, ignore_errors=True)
+
+	def usage(self) -> int:
+		with self.lock:
+			return sum(self.sizes.values())
+
+	def acquire(self, prefix: str = 'ws_') -> str:
+		used = self.usage()
+		if used > self.quota_bytes and self.reclaim is not None:
+			self.reclaim(used - self.quota_bytes)
+			used = self.usage()
+		if used > self.quota_bytes:
+			raise QuotaExceeded(f"workspaces use {used} of {self.quota_bytes} bytes")
+		with self.lock:
+			path = self.free.pop() if len(self.free) > 0 else tempfile.mkdtemp(prefix=prefix, dir=self.root)
+			self.sizes[path] = 0
+		return path
+
+	def track(self, path: str):
+		""" re-measure a workspace after files were written to it """
+		size = dir_size(path)
+		with self.lock:
+			if path in self.sizes: self.sizes[path] = size
+
+	def release(self, path: str):
+		with self.lock:
+			self.sizes.pop(path, None)
+			recycle = len(self.free) < self.pool_size
+		if recycle:
+			for name in os.listdir(path):
+				child = os.path.join(path, name)
+				if os.path.isdir(child) and not os.path.islink(child): shutil.rmtree(child, ignore_errors=True)
+				else: os.unlink(child)
+			with self.lock:
+				self.free.append(path)
+		else:
+			shutil.rmtree(path, ignore_errors=True)
+
+	def close(self):
+		shutil.rmtree(self.root, ignore_errors=True)
+
+	def stats(self) -> dict:
+		with self.lock:
+			return {'root': self.root, 'in_use': len(self.sizes), 'free': len(self.free),
+					'bytes': sum(self.sizes.values()), 'quota': self.quota_bytes}